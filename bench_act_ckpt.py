@@ -0,0 +1,104 @@
+"""
+Peak memory and throughput of ControlVAR training steps under the activation checkpointing policies of
+models/act_ckpt.py, on random inputs:
+
+    python bench_act_ckpt.py --depth 24 --batch_size 16 --policies none attn every:2 all budget:20
+"""
+import argparse
+from time import perf_counter
+
+import torch
+
+from models import VQVAE, build_control_var
+from models.act_ckpt import apply_activation_checkpointing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=16, help="depth of the var")
+    parser.add_argument("--batch_size", type=int, default=8, help="per device batch size")
+    parser.add_argument("--policies", type=str, nargs='+', default=['none', 'attn', 'every:2', 'all'], help="activation checkpointing policies to compare")
+    parser.add_argument("--steps", type=int, default=10, help="timed steps per policy")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed steps per policy")
+    parser.add_argument("--device", type=str, default='cuda', choices=['cuda', 'hpu'])
+    parser.add_argument("--mixed_precision", type=str, default='bf16', choices=['no', 'bf16'])
+    parser.add_argument("--separator", action='store_true', help='separator tokens between the scales')
+    parser.add_argument("--v_patch_nums", type=int, nargs='+', default=[1, 2, 3, 4, 5, 6, 8, 10, 13, 16])
+    parser.add_argument("--vocab_size", type=int, default=4096)
+    parser.add_argument("--z_channels", type=int, default=32)
+    parser.add_argument("--ch", type=int, default=160)
+    return parser.parse_args()
+
+
+class Device(object):
+    """The few device calls the benchmark needs, for cuda and hpu (lazy mode)."""
+    def __init__(self, name):
+        self.name = name
+        if name == 'hpu':
+            import habana_frameworks.torch.core as htcore
+            self.mark_step = htcore.mark_step
+            self.memory = torch.hpu
+        else:
+            self.mark_step = lambda: None
+            self.memory = torch.cuda
+
+    def synchronize(self):
+        self.mark_step()
+        self.memory.synchronize()
+
+
+def main():
+    args = parse_args()
+    device = Device(args.device)
+    vqvae = VQVAE(vocab_size=args.vocab_size, z_channels=args.z_channels, ch=args.ch, test_mode=True,
+                  share_quant_resi=4, v_patch_nums=args.v_patch_nums)
+    var = build_control_var(vae=vqvae, depth=args.depth, patch_nums=args.v_patch_nums, mask_type='interleave_append',
+                            separator=args.separator).to(args.device)
+    var.train()
+    optimizer = torch.optim.AdamW(var.parameters(), lr=1e-5, fused=args.device == 'cuda')
+
+    B = args.batch_size
+    num_inputs = sum(pn ** 2 * 2 for pn in args.v_patch_nums[1:])
+    label_B = torch.randint(0, var.num_classes, (B,), device=args.device)
+    cond_type = torch.zeros(B, dtype=torch.long, device=args.device)
+    x_BLCv = torch.randn(B, num_inputs, var.Cvae, device=args.device)
+    target_BL = torch.randint(0, var.V, (B, var.L), device=args.device)
+
+    def step():
+        with torch.autocast(device_type=args.device, dtype=torch.bfloat16, enabled=args.mixed_precision == 'bf16'):
+            loss = var(label_B, x_BLCv, cond_type, target_BL=target_BL) / target_BL.numel()
+        loss.backward()
+        device.mark_step()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        device.mark_step()
+
+    print(f'd{args.depth}, batch {B} x {var.L} tokens, {args.mixed_precision}, {args.device}')
+    print(f'{"policy":<14s}{"blocks":>8s}{"attn":>6s}{"peak GiB":>10s}{"img/s":>10s}')
+    for policy in args.policies:
+        modes = apply_activation_checkpointing(var.blocks, policy, batch_size=B, seq_len=var.L,
+                                               dtype_bytes=4 if args.mixed_precision == 'no' else 2)
+        try:
+            for _ in range(args.warmup):
+                step()
+            device.synchronize()
+            device.memory.reset_peak_memory_stats()
+            t0 = perf_counter()
+            for _ in range(args.steps):
+                step()
+            device.synchronize()
+            seconds = perf_counter() - t0
+            peak = f'{device.memory.max_memory_allocated() / 2 ** 30:10.2f}'
+            speed = f'{args.steps * B / seconds:10.1f}'
+        except RuntimeError as e:  # out of memory
+            if 'out of memory' not in str(e).lower():
+                raise
+            optimizer.zero_grad(set_to_none=True)
+            peak, speed = f'{"OOM":>10s}', f'{"-":>10s}'
+        print(f'{policy:<14s}{sum(m == "block" for m in modes):8d}{sum(m == "attn" for m in modes):6d}{peak}{speed}')
+        if args.device == 'cuda':
+            torch.cuda.empty_cache()
+
+
+if __name__ == '__main__':
+    main()
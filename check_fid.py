@@ -0,0 +1,90 @@
+"""
+CPU check of the FID statistics of utils/fid.py on random images, with the tiny feature extractor and two
+simulated ranks (threads) for the all-reduce:
+
+    python check_fid.py
+"""
+import threading
+
+import numpy as np
+import torch
+
+from utils.fid import InceptionMetrics, build_feature_extractor, frechet_distance
+
+
+class _ThreadGroup(object):
+    """Sum all-reduce between objects of one process that are each driven by their own thread, one per 'rank'."""
+    def __init__(self, world_size):
+        self.barrier = threading.Barrier(world_size)
+        self.slots = [None] * world_size
+
+    def allreduce(self, rank, t):
+        self.slots[rank] = t.clone()
+        self.barrier.wait()
+        t.copy_(torch.stack(self.slots).sum(0))
+        self.barrier.wait()     # no slot is overwritten before every rank has summed
+
+
+class _RankMetrics(InceptionMetrics):
+    def __init__(self, extractor, group, rank):
+        super().__init__(extractor)
+        self.group, self.rank = group, rank
+
+    def _allreduce(self, t):
+        self.group.allreduce(self.rank, t)
+
+
+def _stats_on_ranks(metrics):
+    results, errors = [None] * len(metrics), []
+
+    def run(r):
+        try:
+            results[r] = metrics[r].stats()
+        except Exception as e:
+            errors.append(e)
+            metrics[r].group.barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(r,)) for r in range(len(metrics))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def check_on_cpu(num_images=160, batch_size=24, seed=0):
+    """
+    CPU check of the FID pipeline with TinyFeatureExtractor. The moments accumulated by
+    update() over several batches, on one rank and split over two simulated ranks (float32 all-reduce included),
+    must match a single-pass numpy mean and covariance of all features, and the FID of these statistics with
+    themselves must be ~0.
+    """
+    images = torch.rand(num_images, 3, 32, 32, generator=torch.Generator().manual_seed(seed))
+    extractor = build_feature_extractor('tiny')
+    with torch.no_grad():
+        features = extractor(images)[0].double().numpy()
+    mu_ref, sigma_ref = features.mean(0), np.cov(features, rowvar=False)
+
+    single = InceptionMetrics(extractor)
+    for batch in images.split(batch_size):
+        single.update(batch)
+    group = _ThreadGroup(2)
+    ranks = [_RankMetrics(extractor, group, r) for r in range(2)]
+    for rank, shard in zip(ranks, images.tensor_split([num_images // 3])):     # uneven shards
+        for batch in shard.split(batch_size):
+            rank.update(batch)
+
+    for n, mu, sigma in [single.stats()] + _stats_on_ranks(ranks):
+        assert n == num_images, f'{n} samples, expected {num_images}'
+        np.testing.assert_allclose(mu, mu_ref, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(sigma, sigma_ref, rtol=1e-3, atol=1e-6)
+
+    fid = frechet_distance(mu_ref, sigma_ref, mu_ref, sigma_ref)
+    assert abs(fid) < 1e-6 * np.trace(sigma_ref), f'FID of a distribution with itself is {fid}'
+    print(f'[fid] moments of {num_images} samples match numpy on 1 and 2 ranks, self-FID {fid:.2e}')
+
+
+if __name__ == '__main__':
+    check_on_cpu()
@@ -1 +1,2 @@
-from .build import create_dataset
\ No newline at end of file
+from .build import create_dataset, create_sampler
+from .sampler import data_state_dict, set_data_position
\ No newline at end of file
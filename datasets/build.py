@@ -1,16 +1,14 @@
+import sys
+
 import torch 
 from torch.utils.data import Dataset
-from torchvision.datasets import ImageFolder
-from .coco import MSCOCOMaskDataset
-from .sa1b import SA1BMaskDataset
-from .imagenetS import ImagenetSDataset
-from .imagenetC import ImagenetCDataset
-from .imagenetM import ImagenetMDataset
-from .entityS import EntitySegDataset
 import torchvision.transforms as transforms
-from torch.utils.data import ConcatDataset
+from torch.utils.data import ConcatDataset, IterableDataset
+from .sampler import ResumableDistributedSampler
 from .transforms_image import create_image_mask_transforms
 
+# dataset modules (and their dependencies: pycocotools, cv2, torchdata, ...) are imported by the branch that needs them
+
 
 def create_transforms(image_size):
     
@@ -25,20 +23,31 @@ def create_transforms(image_size):
 
 
 def create_dataset(dataset_name, args, split='train'):
-    
-    if dataset_name == "imagenet":
+    # with gpu_aug the workers return fixed-size uint8 tensors, crop/flip/normalize run in train_epoch
+    gpu_aug = getattr(args, 'gpu_aug', False)
+    # with uint8_batch the workers return uint8 tensors, normalization runs in train_epoch (see collate_uint8)
+    uint8 = getattr(args, 'uint8_batch', False)
+    # per condition type sampling weights for ImageNetC, in COND_TYPES order (mask, canny, depth, normal)
+    cond_weights = None
+    if dataset_name.startswith('imagenetC') and getattr(args, 'cond_weights', None):
+        from .imagenetC import COND_TYPES
+        cond_weights = dict(zip(COND_TYPES, args.cond_weights))
 
+    if dataset_name == "imagenet":
+        from torchvision.datasets import ImageFolder
         dataset = ImageFolder(args.data_dir, transform=create_transforms(args.image_size))
     
     elif dataset_name == "coco":
-
+        from .coco import MSCOCOMaskDataset
         dataset = MSCOCOMaskDataset(args)
 
     elif dataset_name == "SA1B":
         assert args.uncond, 'must be uncond generation'
-        dataset = SA1BMaskDataset(args.data_dir, create_image_mask_transforms(args.image_size))
+        from .sa1b import SA1BMaskDataset
+        dataset = SA1BMaskDataset(args.data_dir, create_image_mask_transforms(args.image_size, uint8_output=uint8))
 
     elif dataset_name == "imagenetS":
+        from .imagenetS import ImagenetSDataset
         dataset_train = ImagenetSDataset(args.data_dir, split='train-semi', image_size=(args.image_size, args.image_size),
                                          transform=create_image_mask_transforms(args.image_size))
         dataset_val = ImagenetSDataset(args.data_dir, split='validation', image_size=args.image_size,
@@ -46,22 +55,54 @@ def create_dataset(dataset_name, args, split='train'):
         dataset = ConcatDataset([dataset_train, dataset_val])
 
     elif dataset_name == "imagenetM":
+        from .imagenetM import ImagenetMDataset
         dataset = ImagenetMDataset(args.data_dir, split='train', image_size=args.image_size,
-                                         transform=create_image_mask_transforms(args.image_size, True),
+                                         transform=create_image_mask_transforms(args.image_size, True, gpu_aug=gpu_aug, uint8_output=uint8),
                                          v_patch_nums=args.v_patch_nums, separator=args.separator,)
     elif dataset_name == "imagenetC":
+        from .imagenetC import ImagenetCDataset
         dataset = ImagenetCDataset(args.data_dir, split=split, image_size=args.image_size,
-                                         transform=create_image_mask_transforms(args.image_size, split=='train'),
-                                         v_patch_nums=args.v_patch_nums, separator=args.separator, val_cond=args.val_cond)
+                                         transform=create_image_mask_transforms(args.image_size, split=='train',
+                                                                                gpu_aug=gpu_aug and split == 'train',
+                                                                                uint8_output=uint8 and split == 'train'),
+                                         v_patch_nums=args.v_patch_nums, separator=args.separator, val_cond=args.val_cond,
+                                         cond_weights=cond_weights)
+
+    elif dataset_name == "imagenetC_wds":
+        # args.data_dir holds the tar shards written by datasets/imagenetC_wds.py
+        from .imagenetC_wds import ImagenetCShardDataset
+        dataset = ImagenetCShardDataset(args.data_dir, split=split, image_size=args.image_size,
+                                        transform=create_image_mask_transforms(args.image_size, split=='train',
+                                                                               gpu_aug=gpu_aug and split == 'train',
+                                                                               uint8_output=uint8 and split == 'train'),
+                                        v_patch_nums=args.v_patch_nums, separator=args.separator, val_cond=args.val_cond,
+                                        batch_size=args.batch_size, seed=args.seed, cond_weights=cond_weights)
 
     elif dataset_name == "entityS":
+        from .entityS import EntitySegDataset
         dataset = EntitySegDataset(args.data_dir, split='train', image_size=args.image_size,
-                                   transform=create_image_mask_transforms(args.image_size, True),
+                                   transform=create_image_mask_transforms(args.image_size, True, gpu_aug=gpu_aug,
+                                                                          uint8_output=uint8),
                                    v_patch_nums=args.v_patch_nums, separator=args.separator, )
 
     else:
         raise NotImplementedError
 
     return dataset
-        
-        
\ No newline at end of file
+
+
+def create_sampler(dataset, args, split='train', num_replicas=None, rank=None):
+    """
+    ImageNetC trains on (image, cond_type) pairs drawn by CondTypeSampler. With num_replicas set, every other
+    map-style dataset gets a DistributedSampler; without it (accelerate shards the batches itself) they get None.
+    Streaming datasets split their shards across ranks themselves and never get a sampler.
+    """
+    if isinstance(dataset, IterableDataset):
+        return None
+    # an ImageNetC dataset means its module is loaded already
+    imagenetC = sys.modules.get(f'{__package__}.imagenetC')
+    if imagenetC is not None and isinstance(dataset, imagenetC.ImagenetCDataset) and split == 'train':
+        return imagenetC.CondTypeSampler(dataset, num_replicas=num_replicas or 1, rank=rank or 0, seed=args.seed)
+    if num_replicas is not None:
+        return ResumableDistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=split == 'train')
+    return None
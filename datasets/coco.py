@@ -97,13 +97,14 @@ def apply_mask_and_propagate_colors(image, mask, iterations=64, kernel_size=(13,
 
 
 class MSCOCOMaskDataset(Dataset):
-    def __init__(self, annotation_path, img_dir, image_size, transform=None, min_area=3000):
+    def __init__(self, annotation_path, img_dir, image_size, transform=None, min_area=3000, cache_dir=None):
         """
         Args:
             annotation_path (string): Path to the MSCOCO annotation file.
             image_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied on a sample.
             min_area (int): Minimum area to consider an object as large.
+            cache_dir (string, optional): Directory to store the rendered condition maps, one subdirectory per min_area.
         """
         self.coco = COCO(annotation_path)
         self.img_dir = img_dir
@@ -116,6 +117,10 @@ class MSCOCOMaskDataset(Dataset):
             self.transforms = transform
         self.ids = sorted(self.coco.imgs.keys())
         self.min_area = min_area
+        self.cache_dir = None if cache_dir is None else os.path.join(cache_dir, f'min_area_{min_area}')
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.build_index()
         # for img_id in sorted(self.coco.imgs.keys()):
         #     ann_ids = self.coco.getAnnIds(imgIds=img_id, areaRng=[min_area, float('inf')])
         #     for ann_id in ann_ids:
@@ -123,35 +128,63 @@ class MSCOCOMaskDataset(Dataset):
         #         if ann['area'] >= min_area:  # Ensure the annotation meets the area requirement
         #             self.ids.append((img_id, ann_id))
 
+    def build_index(self):
+        """
+        Precompute the filtered and centerness-sorted polygons of every image as flat arrays:
+        polygons of image i are poly_ranges[i, 0]:poly_ranges[i, 1], polygon j has the points
+        poly_coords[poly_offsets[j]:poly_offsets[j + 1]] and is filled with mask_colormap[poly_colors[j]].
+        """
+        coords, offsets, colors, ranges = [], [0], [], []
+        for img_id in self.ids:
+            # same filter as getAnnIds(imgIds=img_id, areaRng=[min_area, inf], iscrowd=0)
+            anns = [ann for ann in self.coco.imgToAnns[img_id]
+                    if ann['area'] > self.min_area and ann['iscrowd'] == 0 and ann.get('segmentation')]
+            centroids = np.asarray([np.concatenate([np.asarray(seg, dtype=np.float64) for seg in ann['segmentation']])
+                                    .reshape(-1, 2).mean(axis=0) for ann in anns]).reshape(-1, 2)
+            # sort by y (descending) and then x (ascending)
+            order = np.lexsort((centroids[:, 0], -centroids[:, 1]))
+            begin = len(colors)
+            for index, k in enumerate(order):
+                for seg in anns[k]['segmentation']:
+                    coords.append(np.asarray(seg, dtype=np.float32).reshape(-1, 2))
+                    offsets.append(offsets[-1] + len(coords[-1]))
+                    colors.append(index % (len(mask_colormap) - 1) + 1)
+            ranges.append((begin, len(colors)))
+        self.poly_coords = np.concatenate(coords) if coords else np.zeros((0, 2), dtype=np.float32)
+        self.poly_offsets = np.asarray(offsets, dtype=np.int64)
+        self.poly_colors = np.asarray(colors, dtype=np.int64)
+        self.poly_ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+
+    def render_mask(self, idx, size):
+        mask = Image.new('RGB', size, (0, 0, 0))
+        draw = ImageDraw.Draw(mask)
+        begin, end = self.poly_ranges[idx]
+        for j in range(begin, end):
+            polygon = self.poly_coords[self.poly_offsets[j]:self.poly_offsets[j + 1]]
+            draw.polygon(polygon.ravel().tolist(), fill=tuple(mask_colormap[self.poly_colors[j]].tolist()))
+        return mask
+
     def __len__(self):
         return len(self.ids)
 
     def __getitem__(self, idx):
         img_id = self.ids[idx]  # Unpack the tuple
 
-        path = self.coco.loadImgs(img_id)[0]['file_name']
+        path = self.coco.imgs[img_id]['file_name']
         image = Image.open(os.path.join(self.img_dir, path)).convert('RGB')
 
-        ann_ids = self.coco.getAnnIds(imgIds=img_id, areaRng=[self.min_area, float('inf')], iscrowd=0)
-
-        annotations = self.coco.loadAnns(ann_ids)
-
-        annotations = sort_annotations_by_centerness(annotations)
-
-        mask = Image.new('RGB', image.size, (0, 0, 0))
-
-        for index, ann in enumerate(annotations):
-            # if ann['iscrowd'] == 1:
-            #     binary_mask = self.coco.annToMask(ann)
-            #     mask = Image.fromarray(binary_mask * 255).convert('RGB')
-            #     break
-            # For polygonal annotations (COCO's 'segmentation' format)
-            for seg in ann['segmentation']:
-                draw = ImageDraw.Draw(mask)
-                # Assuming 'seg' is a flat list of [x1,y1,x2,y2,...], convert to [(x1,y1),(x2,y2),...]
-                polygon = [(seg[i], seg[i+1]) for i in range(0, len(seg), 2)]
-                draw.polygon(polygon, fill=tuple(mask_colormap[index+1]))
-
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, f'{img_id}.png')
+            if os.path.exists(cache_path):
+                mask = Image.open(cache_path).convert('RGB')
+            else:
+                mask = self.render_mask(idx, image.size)
+                # per-process temporary name, so other workers and ranks never open a half-written png
+                tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+                mask.save(tmp_path, format='PNG')
+                os.replace(tmp_path, cache_path)
+        else:
+            mask = self.render_mask(idx, image.size)
 
         if self.transforms:
             image = self.transforms(image)
@@ -10,19 +10,22 @@ import json
 from pycocotools import mask as mask_utils
 import torch
 from torch.nn import functional as F
+from .transforms_image import open_image, create_image_mask_transforms, build_ignore_masks
 
 
-def process_anns(anns, image, colormap):
-    mask = np.zeros_like(image)
+def process_anns(anns, height, width, colormap):
+    mask = np.zeros((height, width, 3), dtype=np.uint8)
     for i, ann in enumerate(anns):
         if ann['area'] < 5000:
             continue
         m = ann['segmentation']
         m = mask_utils.decode(m)
         X, Y = m.shape[1], m.shape[0]
-        index = np.where(m == 1)
-        x = int(np.mean(index[1]) // (X / 11))
-        y = int(np.mean(index[0]) // (Y / 11))
+        # first moments only, instead of the coordinates of every pixel
+        rows, cols = m.sum(axis=1), m.sum(axis=0)
+        area = rows.sum()
+        x = int((cols @ np.arange(X)) / area // (X / 11))
+        y = int((rows @ np.arange(Y)) / area // (Y / 11))
         m = m.astype(bool)
         assert x * y < 124
         mask[m] = colormap[(x * y) % len(colormap)]
@@ -38,7 +41,7 @@ def create_color_map():
 
 class EntitySegDataset(Dataset):
     def __init__(self, root: str, split: str = "train", transform=None, image_size=256,
-                 v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16), separator=False, **kwargs):
+                 v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16), separator=False, cache_dir=None, **kwargs):
         if transform is None:
             self.transforms = transforms.Compose([
                 transforms.Resize(image_size, interpolation=transforms.InterpolationMode.BICUBIC),
@@ -58,56 +61,48 @@ class EntitySegDataset(Dataset):
         self.separator = separator
         self.colormap = create_color_map()
         self.ids = sorted(self.coco.imgs.keys())
+        # condition maps are rasterized once at full resolution and stored by image id
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
         print(f'EntitySegmentation dataset init: total images {len(self.ids)}')
 
 
+    def load_mask(self, img_id, height, width):
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, f'{img_id}.png')
+            if os.path.exists(cache_path):
+                return Image.open(cache_path).convert('RGB')
+        annotations = self.coco.imgToAnns[img_id]
+        mask = Image.fromarray(process_anns(annotations, height, width, self.colormap))
+        if self.cache_dir is not None:
+            # per-process temporary name, so other workers and ranks never open a half-written png
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            mask.save(tmp_path, format='PNG')
+            os.replace(tmp_path, cache_path)
+        return mask
+
     def __len__(self):
         return len(self.ids)
 
     def __getitem__(self, idx: int):
         img_id = self.ids[idx]  # Unpack the tuple
 
-        path = self.coco.loadImgs(img_id)[0]['file_name']
-        image = cv2.imread(os.path.join(self.img_dir, path), cv2.COLOR_BGR2RGB).astype(np.uint8)
-        ann_ids = self.coco.getAnnIds(imgIds=img_id)
-        annotations = self.coco.loadAnns(ann_ids)
-        mask = process_anns(annotations, image, self.colormap).astype(np.uint8)
-        image = Image.fromarray(image)
-        mask = Image.fromarray(mask)
-        
+        img_info = self.coco.imgs[img_id]
+        image = open_image(os.path.join(self.img_dir, img_info['file_name']), getattr(self.transforms, 'draft_size', None))
+        mask = self.load_mask(img_id, img_info['height'], img_info['width'])
+        if mask.size != image.size:
+            mask = mask.resize(image.size, Image.NEAREST)
+
         if self.transforms:
             image, mask = self.transforms(image, mask)
 
-        ignore_mask = torch.ones_like(mask.sum(dim=0))
-
-        ignore_mask[mask.sum(dim=0)==-3] = 0
-        ignore_masks = []
-        ignore_masks_ = []
-        for si, pm in enumerate(self.v_patch_nums):
-            num_sp_tokens = 1 if (si != 0 and self.separator) else 0
-            if si < 5:  # [1, 2, 3, 4, 5, 6,]
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-
-            else:
-                ignore_mask_ = F.interpolate(ignore_mask[None, None, :, :], (pm, pm), mode='nearest')\
-                    .permute((0, 2, 3, 1)).reshape((-1,))
-                if self.separator:
-                    ignore_mask_ = torch.concat((torch.ones(1,), ignore_mask_), dim=0)
-
-                ignore_masks.append(ignore_mask_)  # mask ignore
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                ignore_masks_.append(ignore_mask_)  # mask ignore
-
-        ignore_masks = torch.concat(ignore_masks, dim=0)
-        ignore_masks_ = torch.concat(ignore_masks_, dim=0)
+        sample = {'image': image, 'mask': mask, 'cls': 1000}
+        if mask.dtype == torch.uint8:  # uint8 batches get their ignore masks on the device
+            return sample
 
-        sample = {'image': image, 'mask': mask, 'cls': 1000, 'ignore_mask': ignore_masks, 'ignore_mask_': ignore_masks_}
+        ignore_masks, ignore_masks_ = build_ignore_masks(mask[None], self.v_patch_nums, self.separator)
+        sample.update({'ignore_mask': ignore_masks[0], 'ignore_mask_': ignore_masks_[0]})
         return sample
 
 
@@ -1,9 +1,11 @@
 import glob
+import math
 import random
 
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torchvision.transforms as transforms
+from torchvision.transforms import InterpolationMode
 import os
 from PIL import Image
 import json
@@ -11,6 +13,7 @@ from pycocotools import mask as mask_utils
 import torch
 from torch.nn import functional as F
 from tqdm import tqdm
+from .transforms_image import open_image, build_ignore_masks
 
 def process_anns(anns, image_size, colormap):
     mask = np.zeros((image_size, image_size, 3))
@@ -49,29 +52,102 @@ def find_classes(directory):
     class_to_idx = {cls_name: i for i, cls_name in enumerate(classes)}
     return classes, class_to_idx
 
+
+COND_IDX = {'mask': 0, 'canny': 1, 'depth': 2, 'normal': 3}
+COND_TYPES = list(COND_IDX)
+
+
+def decode_cond(cond_type, fp, colormap):
+    """Load a condition map from a path or file object; masks are stored as COCO RLE json."""
+    if cond_type == 'mask':
+        if isinstance(fp, str):
+            with open(fp, 'r') as f:
+                mask_info = json.load(f)
+        else:
+            mask_info = json.load(fp)
+        mask = process_anns(mask_info, 512, colormap).astype(np.uint8)  # 512 is fixed during the labelling
+        return Image.fromarray(mask)
+    return Image.open(fp).convert('RGB')
+
+
+def build_sample(image, cond, cond_type, cls, transforms, v_patch_nums, separator):
+    # palette masks keep their colours (nearest), the continuous canny/depth/normal maps are area-resized; with
+    # transforms, their Resize takes the condition from its native size to the image's in a single pass
+    if transforms:
+        image, cond = transforms(image, cond, mask_interpolation=InterpolationMode.NEAREST if cond_type == 'mask'
+                                 else InterpolationMode.BOX)
+    else:
+        cond = cond.resize(image.size, Image.NEAREST if cond_type == 'mask' else Image.BOX)
+
+    sample = {'image': image, 'mask': cond, 'cls': cls, 'type': torch.tensor(COND_IDX[cond_type])}
+    if cond.dtype == torch.uint8:  # uint8 batches get their ignore masks on the device
+        return sample
+
+    if cond_type == 'mask':
+        ignore_masks, ignore_masks_ = build_ignore_masks(cond[None], v_patch_nums, separator)
+        ignore_masks, ignore_masks_ = ignore_masks[0], ignore_masks_[0]
+    else:
+        ignore_masks = torch.ones((1378,)) if separator else torch.ones((1360,))
+        ignore_masks_ = torch.ones((1378,)) if separator else torch.ones((1360,))
+
+    sample.update({'ignore_mask': ignore_masks, 'ignore_mask_': ignore_masks_})
+    return sample
+
+
 class ImagenetCDataset(Dataset):
+    """
+    Every item is one image. An index is either an image index, in which case the condition type is drawn from the
+    conditions available for that image, or an (image index, cond_type index) pair as produced by CondTypeSampler.
+    """
     def __init__(self, root: str, split: str = "train", transform=None, image_size=256,
-                 v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16), separator=False, val_cond='depth', **kwargs):
+                 v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16), separator=False, val_cond='depth',
+                 cond_weights=None, **kwargs):
 
         self.transforms = transform
         self.split = split
+        self.val_cond = val_cond
         self.load_dataset(root)
         classes, class_to_idx = find_classes(os.path.join(root, split))
         self.cond = {'mask': self.mask_paths, 'canny': self.canny_paths,
                      'depth': self.depth_paths, 'normal': self.normal_paths}
-        self.cond_idx = {'mask': 0, 'canny': 1, 'depth': 2, 'normal': 3}
+        self.cond_idx = COND_IDX
         self.class_to_idx = class_to_idx
         print('Use ImageFolder Class to IDX')
+        self.cond_weights = cond_weights or {cond_type: 0.25 for cond_type in COND_TYPES}
+        self.build_index()
         self.v_patch_nums = v_patch_nums
         self.image_size = image_size
         self.separator = separator
         self.colormap = create_color_map()
-        print(f'ImagenetC dataset init: total images '
-              f'{max(len(self.mask_paths), len(self.canny_paths), len(self.depth_paths), len(self.normal_paths))}')
+        print(f'ImagenetC dataset init: total images {len(self.image_paths)}')
         if self.split == 'val':
-            self.val_cond = val_cond
             print(f'Warning: Only use {self.val_cond} during the evaluation')
 
+    def build_index(self):
+        """
+        Group the condition lists by image: image_paths[i] has the conditions set in the bit mask cond_bits[i]
+        (bit COND_IDX[cond_type]). Images without any condition of non-zero weight are left out.
+        """
+        bits = {}
+        for cond_type, paths in self.cond.items():
+            bit = 1 << COND_IDX[cond_type]
+            for cond_path in paths:
+                image_path = self.image_path(cond_type, cond_path)
+                bits[image_path] = bits.get(image_path, 0) | bit
+        if self.split == 'val':
+            allowed = 1 << COND_IDX[self.val_cond]
+        else:
+            allowed = sum(1 << COND_IDX[cond_type] for cond_type, w in self.cond_weights.items() if w > 0)
+        self.image_paths = sorted(path for path, b in bits.items() if b & allowed)
+        self.cond_bits = np.asarray([bits[path] & allowed for path in self.image_paths], dtype=np.uint8)
+        self.labels = np.asarray([self.class_to_idx[path.split('/')[-2]] for path in self.image_paths], dtype=np.int64)
+
+    def cond_probs(self):
+        """(N, 4) probabilities of drawing each condition type for each image."""
+        available = (self.cond_bits[:, None] >> np.arange(len(COND_TYPES))) & 1
+        probs = available * np.asarray([self.cond_weights[cond_type] for cond_type in COND_TYPES], dtype=np.float64)
+        return probs / probs.sum(axis=1, keepdims=True)
+
     def load_dataset(self, root):
         if 'ceph' in root:
             cond_info_path = os.path.join(root, f'{self.split}_cond_info_mpi.json')
@@ -122,70 +198,70 @@ class ImagenetCDataset(Dataset):
                 json.dump(data, file)
 
 
-    def __len__(self):
-        return max(len(self.mask_paths), len(self.canny_paths), len(self.depth_paths), len(self.normal_paths))
+    def image_path(self, cond_type, cond_path):
+        return cond_path.replace(self.split+'_'+cond_type, self.split).replace('.json', '.JPEG').replace('.jpeg', '.JPEG')
 
-    def __getitem__(self, index: int):
-        cond_type = random.choices(['mask', 'canny', 'normal', 'depth'], [0.25, 0.25, 0.25, 0.25], k=1)[0]
-        # TODO: add mask val dataset
-        if self.split == 'val':
-            cond_type = self.val_cond
-            # print(f'Warning: Only use {cond_type} during the evaluation')
+    def cond_path(self, cond_type, image_path):
+        head, folder, name = image_path.rsplit('/', 2)
+        ext = '.json' if cond_type == 'mask' else '.jpeg'
+        return f'{head}_{cond_type}/{folder}/{os.path.splitext(name)[0]}{ext}'
 
-        cond_path = self.cond[cond_type][index % len(self.cond[cond_type])]
-        image_path = cond_path.replace(self.split+'_'+cond_type, self.split).replace('.json', '.JPEG').replace('.jpeg', '.JPEG')
-        cls = self.class_to_idx[(image_path.split('/')[-2])]
-        image = Image.open(image_path).convert('RGB')
+    def __len__(self):
+        return len(self.image_paths)
 
-        if cond_type == 'mask':
-            with open(cond_path, 'r') as f:
-                mask_info = json.load(f)
-            mask = process_anns(mask_info, 512, self.colormap).astype(np.uint8)  # 512 is fixed during the labelling
-            cond = Image.fromarray(mask)
+    def __getitem__(self, index):
+        if isinstance(index, (tuple, list)):
+            index, cond_type = index[0], COND_TYPES[index[1]]
+        elif self.split == 'val':
+            cond_type = self.val_cond
         else:
-            cond = Image.open(cond_path).convert('RGB')
-        cond = cond.resize(image.size)
+            available = [t for t in COND_TYPES if self.cond_bits[index] >> COND_IDX[t] & 1]
+            cond_type = random.choices(available, [self.cond_weights[t] for t in available], k=1)[0]
 
-        if self.transforms:
-            image, cond = self.transforms(image, cond)
+        image_path = self.image_paths[index]
+        cls = int(self.labels[index])
+        image = open_image(image_path, getattr(self.transforms, 'draft_size', None))
+        cond = decode_cond(cond_type, self.cond_path(cond_type, image_path), self.colormap)
+        return build_sample(image, cond, cond_type, cls, self.transforms, self.v_patch_nums, self.separator)
 
-        if cond_type == 'mask':
-            ignore_mask = torch.ones_like(cond.sum(dim=0))
 
-            ignore_mask[cond.sum(dim=0)==-3] = 0
-            ignore_masks = []
-            ignore_masks_ = []
-            for si, pm in enumerate(self.v_patch_nums):
-                num_sp_tokens = 1 if (si != 0 and self.separator) else 0
-                if si < 5:  # [1, 2, 3, 4, 5, 6,]
-                    ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-                    ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-
-                    ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                    ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-
-                else:
-                    ignore_mask_ = F.interpolate(ignore_mask[None, None, :, :], (pm, pm), mode='nearest')\
-                        .permute((0, 2, 3, 1)).reshape((-1,))
-                    if self.separator:
-                        ignore_mask_ = torch.concat((torch.ones(1,), ignore_mask_), dim=0)
-
-                    ignore_masks.append(ignore_mask_)  # mask ignore
-                    ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
+class CondTypeSampler(Sampler):
+    """
+    Draws one (image index, cond_type index) pair per image and epoch, with the condition type picked among the
+    ones available for the image in proportion to dataset.cond_weights. Like DistributedSampler, the permutation
+    depends on seed + epoch only and is split across num_replicas; call set_epoch before each epoch. A start_index
+    given to set_epoch resumes the epoch at that position of this rank's share.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        self.probs = torch.from_numpy(dataset.cond_probs())
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_index = 0
+        n = len(self.probs)
+        self.num_samples = n // num_replicas if drop_last else math.ceil(n / num_replicas)
+        self.total_size = self.num_samples * num_replicas
 
-                    ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                    ignore_masks_.append(ignore_mask_)  # mask ignore
+    def __len__(self):
+        return self.num_samples
 
-            ignore_masks = torch.concat(ignore_masks, dim=0)
-            ignore_masks_ = torch.concat(ignore_masks_, dim=0)
-        else:
-            ignore_masks = torch.ones((1378,)) if self.separator else torch.ones((1360,))
-            ignore_masks_ = torch.ones((1378,)) if self.separator else torch.ones((1360,))
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
 
-        sample = {'image': image, 'mask': cond, 'cls': cls, 'ignore_mask': ignore_masks, 'ignore_mask_': ignore_masks_,
-                  'type': torch.tensor(self.cond_idx[cond_type])}
-        # print(cond_path)
-        return sample
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        n = len(self.probs)
+        order = torch.randperm(n, generator=g) if self.shuffle else torch.arange(n)
+        cond_types = torch.multinomial(self.probs, 1, generator=g)[:, 0]
+        if self.total_size > n:
+            order = torch.cat([order, order[:self.total_size - n]])
+        order = order[self.rank:self.total_size:self.num_replicas][self.start_index:]
+        return iter(zip(order.tolist(), cond_types[order].tolist()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+import io
+import os
+import json
+import random
+import tarfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from .utils import build_datapipe
+from .transforms_image import open_image
+from .imagenetC import COND_IDX, ImagenetCDataset, create_color_map, decode_cond, build_sample
+
+# member suffix of every condition type inside a shard sample
+COND_EXT = {'mask': '.mask.json', 'canny': '.canny.jpg', 'depth': '.depth.jpg', 'normal': '.normal.jpg'}
+
+
+def shard_index_path(root, split):
+    return os.path.join(root, f'{split}_shards.json')
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _write_imagenetC_shard(job):
+    shard_path, items = job
+    tmp_path = shard_path + '.tmp'
+    bit_counts = {}
+    with tarfile.open(tmp_path, 'w') as tar:
+        for image_path, cls, conds in items:
+            # webdataset groups members by the name before the first dot
+            key = os.path.splitext(os.path.basename(image_path))[0]
+            with open(image_path, 'rb') as f:
+                _add_member(tar, key + '.jpg', f.read())
+            _add_member(tar, key + '.cls', str(cls).encode())
+            for cond_type, cond_path in conds.items():
+                with open(cond_path, 'rb') as f:
+                    _add_member(tar, key + COND_EXT[cond_type], f.read())
+            bits = str(sum(1 << COND_IDX[cond_type] for cond_type in conds))
+            bit_counts[bits] = bit_counts.get(bits, 0) + 1
+    os.replace(tmp_path, shard_path)
+    # number of samples per set of available conditions (bit COND_IDX[cond_type]), to count the usable samples
+    return os.path.basename(shard_path), len(items), bit_counts
+
+
+def write_imagenetC_shards(root, out_dir, split='train', shard_size=1000, num_workers=16, seed=0):
+    """
+    Pack ImageNetC into tar shards of shard_size images. Each sample holds the JPEG, the class index and every
+    condition map available for the image. Samples are shuffled globally before packing, so a small shuffle buffer
+    is enough while streaming. The shard list is written to {out_dir}/{split}_shards.json.
+    """
+    dataset = ImagenetCDataset(root, split=split)
+    items = [(image_path, int(cls), {cond_type: dataset.cond_path(cond_type, image_path)
+                                     for cond_type in COND_EXT if bits >> COND_IDX[cond_type] & 1})
+             for image_path, cls, bits in zip(dataset.image_paths, dataset.labels, dataset.cond_bits)]
+    random.Random(seed).shuffle(items)
+
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(os.path.join(out_dir, f'{split}-{i // shard_size:06d}.tar'), items[i:i + shard_size])
+            for i in range(0, len(items), shard_size)]
+    with ProcessPoolExecutor(num_workers) as executor:
+        shards = list(tqdm(executor.map(_write_imagenetC_shard, jobs), total=len(jobs)))
+
+    with open(shard_index_path(out_dir, split), 'w') as f:
+        json.dump({'shards': shards, 'num_samples': len(items)}, f)
+    return shards
+
+
+def read_member(item):
+    key, value = item
+    return key, value.file_obj.read()
+
+
+def shuffle_buffer(samples, buffer_size, rng):
+    if buffer_size <= 1:
+        yield from samples
+        return
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def split_shards(shards, index, num):
+    """Take every num-th shard from index; with fewer shards than consumers, share them from a rotated start."""
+    part = shards[index::num]
+    if not part:
+        start = index % len(shards)
+        part = shards[start:] + shards[:start]
+    return part
+
+
+class ImagenetCShardDataset(IterableDataset):
+    """
+    Streams ImageNetC from the tar shards written by write_imagenetC_shards.
+
+    Shards are shuffled per epoch and split first across ranks, then across dataloader workers. Every rank yields
+    the same number of whole batches (workers wrap around their shards when they run short), so DDP never waits on
+    a rank with fewer samples. The order is a pure function of (seed, epoch, rank, worker), which lets
+    set_epoch(epoch, start_batch) resume exactly in the middle of an epoch.
+    """
+    def __init__(self, root: str, split: str = "train", transform=None, image_size=256,
+                 v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16), separator=False, val_cond='depth',
+                 batch_size=1, shuffle_buffer=1000, seed=0, cond_weights=None, **kwargs):
+        with open(shard_index_path(root, split), 'r') as f:
+            index = json.load(f)
+        self.shards = [os.path.join(root, entry[0]) for entry in index['shards']]
+
+        self.transforms = transform
+        self.split = split
+        self.v_patch_nums = v_patch_nums
+        self.image_size = image_size
+        self.separator = separator
+        self.val_cond = val_cond
+        self.colormap = create_color_map()
+        self.cond_weights = cond_weights or {cond_type: 0.25 for cond_type in COND_EXT}
+        # samples without any usable condition (the val condition, or one of non-zero weight) are skipped
+        self.usable_conds = [val_cond] if split == 'val' else [c for c in COND_EXT if self.cond_weights.get(c, 0) > 0]
+        assert self.usable_conds, 'every condition type has weight 0'
+        self.num_samples = self.count_usable(index)
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer if split == 'train' else 0
+        self.seed = seed
+
+        # dataloader workers do not join the process group, so the rank is taken here
+        self.rank = dist.get_rank() if dist.is_initialized() else 0
+        self.world_size = dist.get_world_size() if dist.is_initialized() else 1
+        self.batches_per_rank = self.num_samples // (self.world_size * self.batch_size)
+        self.epoch, self.start_batch = 0, 0
+        print(f'ImagenetC shard dataset init: {len(self.shards)} shards, total images {self.num_samples}')
+
+    def count_usable(self, index):
+        if not all(len(entry) > 2 for entry in index['shards']):
+            print('the shard index has no condition counts, assuming every sample has a usable condition')
+            return index['num_samples']
+        allowed = sum(1 << COND_IDX[cond_type] for cond_type in self.usable_conds)
+        num_samples = sum(count for entry in index['shards'] for bits, count in entry[2].items() if int(bits) & allowed)
+        assert num_samples > 0, f'no sample has a condition of {self.usable_conds}'
+        return num_samples
+
+    def is_usable(self, sample):
+        return any(COND_EXT[cond_type] in sample for cond_type in self.usable_conds)
+
+    def __len__(self):
+        return self.batches_per_rank * self.batch_size
+
+    def set_epoch(self, epoch, start_batch=0):
+        """start_batch is the number of batches this rank already consumed in the epoch."""
+        self.epoch, self.start_batch = epoch, start_batch
+
+    def raw_samples(self, shards):
+        while True:
+            found = False
+            for sample in build_datapipe(shards, decode_fn=read_member, cycle_count=1, shuffle=False):
+                if self.is_usable(sample):
+                    found = True
+                    yield sample
+            if not found:
+                raise RuntimeError(f'no sample in {len(shards)} shards has a condition of {self.usable_conds}')
+
+    def decode(self, sample, cond_type):
+        cls = int(sample['.cls'])
+        image = open_image(io.BytesIO(sample['.jpg']), getattr(self.transforms, 'draft_size', None))
+        cond = decode_cond(cond_type, io.BytesIO(sample[COND_EXT[cond_type]]), self.colormap)
+        return build_sample(image, cond, cond_type, cls, self.transforms, self.v_patch_nums, self.separator)
+
+    def choose_cond(self, sample, rng):
+        if self.split == 'val':
+            return self.val_cond
+        cond_types = [cond_type for cond_type in self.usable_conds if COND_EXT[cond_type] in sample]
+        return rng.choices(cond_types, [self.cond_weights[cond_type] for cond_type in cond_types], k=1)[0]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        shards = list(self.shards)
+        if self.split == 'train':
+            random.Random(f'{self.seed}-{self.epoch}').shuffle(shards)
+        shards = split_shards(split_shards(shards, self.rank, self.world_size), worker, num_workers)
+
+        # the dataloader takes batches from its workers round-robin, so worker w owns batches w, w + num_workers, ...
+        num_samples = len(range(worker, self.batches_per_rank, num_workers)) * self.batch_size
+        skip = len(range(worker, self.start_batch, num_workers)) * self.batch_size
+
+        rng = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker}')
+        cond_rng = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker}-cond')
+        samples = shuffle_buffer(self.raw_samples(shards), self.shuffle_buffer, rng)
+        for i, sample in enumerate(itertools.islice(samples, num_samples)):
+            # draw the condition for skipped samples too, so a resumed epoch sees the same conditions
+            cond_type = self.choose_cond(sample, cond_rng)
+            if i < skip:
+                continue
+            yield self.decode(sample, cond_type)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='../ImageNet2012/')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--num_workers', type=int, default=16)
+    args = parser.parse_args()
+    write_imagenetC_shards(args.root, args.out_dir, args.split, args.shard_size, args.num_workers)
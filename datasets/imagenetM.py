@@ -8,6 +8,7 @@ import json
 from pycocotools import mask as mask_utils
 import torch
 from torch.nn import functional as F
+from .transforms_image import open_image, build_ignore_masks
 
 def process_anns(anns, image_size, colormap):
     mask = np.zeros((image_size, image_size, 3))
@@ -58,7 +59,7 @@ class ImagenetMDataset(Dataset):
         mask_path = self.mask_paths[index]
         image_path = mask_path.replace('train_mask', 'train').replace('.json', '.JPEG')
         cls = self.cls[(image_path.split('/')[-2])]
-        image = Image.open(image_path).convert('RGB')
+        image = open_image(image_path, getattr(self.transforms, 'draft_size', None))
 
         with open(mask_path, 'r') as f:
             mask_info = json.load(f)
@@ -67,36 +68,12 @@ class ImagenetMDataset(Dataset):
 
         if self.transforms:
             image, mask = self.transforms(image, mask)
-        ignore_mask = torch.ones_like(mask.sum(dim=0))
+        sample = {'image': image, 'mask': mask, 'cls': cls, 'type': torch.tensor(0)}
+        if mask.dtype == torch.uint8:  # uint8 batches get their ignore masks on the device
+            return sample
 
-        ignore_mask[mask.sum(dim=0)==-3] = 0
-        ignore_masks = []
-        ignore_masks_ = []
-        for si, pm in enumerate(self.v_patch_nums):
-            num_sp_tokens = 1 if (si != 0 and self.separator) else 0
-            if si < 5:  # [1, 2, 3, 4, 5, 6,]
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # mask ignore
-
-            else:
-                ignore_mask_ = F.interpolate(ignore_mask[None, None, :, :], (pm, pm), mode='nearest')\
-                    .permute((0, 2, 3, 1)).reshape((-1,))
-                if self.separator:
-                    ignore_mask_ = torch.concat((torch.ones(1,), ignore_mask_), dim=0)
-
-                ignore_masks.append(ignore_mask_)  # mask ignore
-                ignore_masks.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-
-                ignore_masks_.append(torch.ones((pm ** 2 + num_sp_tokens,)))  # image ignore
-                ignore_masks_.append(ignore_mask_)  # mask ignore
-
-        ignore_masks = torch.concat(ignore_masks, dim=0)
-        ignore_masks_ = torch.concat(ignore_masks_, dim=0)
-
-        sample = {'image': image, 'mask': mask, 'cls': cls, 'ignore_mask': ignore_masks, 'ignore_mask_': ignore_masks_, 'type': torch.tensor(0)}
+        ignore_masks, ignore_masks_ = build_ignore_masks(mask[None], self.v_patch_nums, self.separator)
+        sample.update({'ignore_mask': ignore_masks[0], 'ignore_mask_': ignore_masks_[0]})
         return sample
 
 
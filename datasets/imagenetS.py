@@ -5,8 +5,10 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 from torchvision.datasets import ImageNet
 import os
+import json
 from PIL import Image
 from .utils import semantic_to_instance_map
+from .transforms_image import open_image
 import torch
 
 class ImagenetSDataset(Dataset):
@@ -21,12 +23,42 @@ class ImagenetSDataset(Dataset):
             ])
         else:
             self.transforms = transform
-        self.image_paths = sorted(glob.glob(os.path.join(root, split, "*", "*.JPEG")))
-        self.mask_paths = sorted(glob.glob(os.path.join(root, f"{split}-segmentation", "*", "*.png")))
-        folder_paths = glob.glob(os.path.join(root, split, "*"))
-        self.cls = [p.split('/')[-1] for p in folder_paths]
+        self.split = split
+        self.load_dataset(root)
+        # instance maps written offline by semantic_to_instance_dir are used directly when available
+        instance_dir = os.path.join(root, f"{split}-instance")
+        self.instance_dir = instance_dir if os.path.isdir(instance_dir) else None
+        self.segmentation_dir = os.path.join(root, f"{split}-segmentation")
+        # labels are precomputed once so __getitem__ does not scan the class list for every sample
+        self.labels = np.asarray([self.class_to_idx[p.split('/')[-2]] for p in self.image_paths], dtype=np.int64)
         print(f'Imagenet dataset init: total images {len(self.image_paths)}')
 
+    def load_dataset(self, root):
+        # sorted class folders keep the class indices identical on every node
+        self.classes = sorted(entry.name for entry in os.scandir(os.path.join(root, self.split)) if entry.is_dir())
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+
+        file_info_path = os.path.join(root, f'{self.split}_file_info.json')
+        if os.path.exists(file_info_path):
+            print('load ImageNetS from json')
+            with open(file_info_path, 'r') as file:
+                file_info = json.load(file)
+            self.image_paths = [os.path.join(root, p) for p in file_info['image']]
+            self.mask_paths = [os.path.join(root, p) for p in file_info['mask']]
+        else:
+            print('load ImageNetS from glob')
+            self.image_paths = sorted(glob.glob(os.path.join(root, self.split, "*", "*.JPEG")))
+            self.mask_paths = sorted(glob.glob(os.path.join(root, f"{self.split}-segmentation", "*", "*.png")))
+            # store relative paths so the cache stays valid when the dataset is mounted elsewhere
+            data = {
+                'image': [os.path.relpath(p, root) for p in self.image_paths],
+                'mask': [os.path.relpath(p, root) for p in self.mask_paths],
+            }
+            with open(file_info_path, 'w') as file:
+                json.dump(data, file)
+        assert len(self.image_paths) == len(self.mask_paths), \
+            f'{len(self.image_paths)} images but {len(self.mask_paths)} masks in {self.split}'
+
     def __len__(self):
         return len(self.image_paths)
 
@@ -34,9 +66,12 @@ class ImagenetSDataset(Dataset):
         # index = 1
         image_path = self.image_paths[index]
         mask_path = self.mask_paths[index]
-        cls = self.cls.index(image_path.split('/')[-2])
-        image = Image.open(image_path).convert('RGB')
-        mask = semantic_to_instance_map(mask_path)
+        cls = int(self.labels[index])
+        image = open_image(image_path, getattr(self.transforms, 'draft_size', None))
+        if self.instance_dir is not None:
+            mask = Image.open(os.path.join(self.instance_dir, os.path.relpath(mask_path, self.segmentation_dir))).convert('RGB')
+        else:
+            mask = semantic_to_instance_map(mask_path)
 
         if self.transforms:
             image, mask = self.transforms(image, mask)
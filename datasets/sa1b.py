@@ -1,4 +1,5 @@
 import json
+from concurrent.futures import ProcessPoolExecutor
 from torchvision import datasets, transforms
 from torch.utils.data import Dataset
 from .color_map import mask_colormap
@@ -8,6 +9,8 @@ from PIL import Image, ImageDraw
 import numpy as np
 from pycocotools import mask as mask_utils
 from .mask_color import mask_colormap
+from .transforms_image import open_image
+from tqdm import tqdm
 
 
 def apply_color_map(id_map, color_list):
@@ -27,42 +30,141 @@ def apply_color_map(id_map, color_list):
 
     return colored_image
 
+def rle_string_to_counts(s):
+    """
+    Decode the compressed COCO RLE string into its run lengths (port of rleFrString in pycocotools).
+    """
+    counts = []
+    p = 0
+    while p < len(s):
+        x, k, more = 0, 0, 1
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << 5 * k
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def rle_centroid(rle):
+    """
+    Calculate (row, col) centroid and area of a COCO RLE mask from its runs, without decoding the mask.
+    """
+    H = rle['size'][0]
+    counts = rle['counts']
+    if isinstance(counts, bytes):
+        counts = counts.decode('ascii')
+    if isinstance(counts, str):
+        counts = rle_string_to_counts(counts)
+    ends = np.cumsum(np.asarray(counts, dtype=np.int64))
+    starts = ends - np.asarray(counts, dtype=np.int64)
+    # runs alternate 0/1 starting with 0, over the column-major flattened mask
+    starts, ends = starts[1::2], ends[1::2]
+    area = int((ends - starts).sum())
+    if area == 0:
+        return None, None, 0
+
+    def col_sum(n):  # sum of floor(k / H) for k in [0, n)
+        q, r = n // H, n % H
+        return H * q * (q - 1) // 2 + r * q
+
+    idx_sum = ((ends * (ends - 1) - starts * (starts - 1)) // 2).sum()
+    cols = (col_sum(ends) - col_sum(starts)).sum()
+    rows = idx_sum - H * cols
+    return rows / area, cols / area, area
+
+
+def paint_annotations(annotations, height, width):
+    """
+    Paint SA-1B masks into a single id map, sorted by the distance of their centroid to the top-left corner.
+
+    Equivalent to np.argmax over the stacked sorted masks: the first mask covering a pixel wins, and uncovered
+    pixels get id 0. Masks are decoded one at a time and painted in reverse order, so no (N, H, W) array is built.
+    """
+    target = []
+    for ann in annotations:
+        row, col, area = rle_centroid(ann['segmentation'])
+        if area == 0:
+            continue
+        target.append((np.sqrt(row ** 2 + col ** 2), ann['segmentation']))
+    order = np.argsort([r for r, _ in target], kind='stable')
+
+    id_map = np.zeros((height, width), dtype=np.int32)
+    for rank in range(len(order) - 1, -1, -1):
+        m = mask_utils.decode(target[order[rank]][1]).astype(bool)
+        id_map[m] = rank
+    return id_map
+
+
 class SA1BMaskDataset(Dataset):
-    def __init__(self, root, transform):
+    def __init__(self, root, transform, label_root=None):
         self.transforms = transform
         self.image_paths = sorted(glob.glob(os.path.join(root, "*", "*.jpg")))
         self.anno_paths = sorted(glob.glob(os.path.join(root, "*", "*.json")))
         self.colormap = mask_colormap
+        self.root = root
+        # packed id maps written by convert_sa1b_labels, used instead of decoding the RLE annotations
+        self.label_root = label_root
 
     def __len__(self):
         return len(self.image_paths)
 
+    def load_target(self, idx):
+        if self.label_root is not None:
+            label_path = sa1b_label_path(self.anno_paths[idx], self.root, self.label_root)
+            if os.path.exists(label_path):
+                return np.array(Image.open(label_path))
+        with open(self.anno_paths[idx]) as f:
+            info = json.load(f)
+        return paint_annotations(info['annotations'], info['image']['height'], info['image']['width'])
+
     def __getitem__(self, idx):
         image_path = self.image_paths[idx]
-        anno_path = self.anno_paths[idx]
-        image = Image.open(image_path).convert('RGB')
-        with open(anno_path) as f:
-            annotations = json.load(f)['annotations']
-        target = []
-
-        for m in annotations:
-            # decode masks from COCO RLE format
-            m = mask_utils.decode(m['segmentation'])
-            index = np.where(m == 1)
-            r = np.sqrt(np.mean(index[0]) ** 2 + np.mean(index[1]) ** 2)
-            target.append((r, m))
-
-        target_ = [m for _, m in sorted(target)]
-        if len(target_) != 0:
-            target = np.argmax(np.stack(target_), axis=0)
-        else:
-            target = np.zeros((512, 512))
+        image = open_image(image_path, getattr(self.transforms, 'draft_size', None))
+        target = self.load_target(idx)
         mask = apply_color_map(target, self.colormap)
         mask = Image.fromarray(mask)
+        if mask.size != image.size:  # the image may be decoded at reduced scale
+            mask = mask.resize(image.size, Image.NEAREST)
 
         if self.transforms:
             image, mask = self.transforms(image, mask)
         
         sample = {'image': image, 'mask': mask, 'cls': 0}  # cls will not be used
 
-        return sample
\ No newline at end of file
+        return sample
+
+
+def sa1b_label_path(anno_path, root, label_root):
+    return os.path.join(label_root, os.path.relpath(anno_path, root).replace('.json', '.png'))
+
+
+def _convert_sa1b_label(paths):
+    anno_path, label_path = paths
+    with open(anno_path) as f:
+        info = json.load(f)
+    target = paint_annotations(info['annotations'], info['image']['height'], info['image']['width'])
+    os.makedirs(os.path.dirname(label_path), exist_ok=True)
+    # only id % len(colormap) is used when colouring, which always fits in uint8
+    Image.fromarray((target % len(mask_colormap)).astype(np.uint8)).save(label_path)
+    return label_path
+
+
+def convert_sa1b_labels(root, label_root, num_workers=16):
+    """
+    Offline conversion of the SA-1B json annotations into packed uint8 id maps under label_root.
+    """
+    anno_paths = sorted(glob.glob(os.path.join(root, "*", "*.json")))
+    jobs = [(p, sa1b_label_path(p, root, label_root)) for p in anno_paths]
+    jobs = [job for job in jobs if not os.path.exists(job[1])]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        with tqdm(total=len(jobs)) as pbar:
+            for _ in executor.map(_convert_sa1b_label, jobs, chunksize=16):
+                pbar.update(1)
+    return len(jobs)
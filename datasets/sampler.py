@@ -0,0 +1,68 @@
+import itertools
+
+from torch.utils.data import IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """DistributedSampler that can start an epoch at start_index, without the loader touching the earlier samples."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.start_index, None)
+
+
+def _position_source(dataloader):
+    # streams track their position themselves, map-style datasets through their sampler
+    return dataloader.dataset if isinstance(dataloader.dataset, IterableDataset) else dataloader.sampler
+
+
+def data_state_dict(dataloader, epoch, batches_seen):
+    """
+    Loader position to store in a checkpoint: epoch, permutation seed and how far the epoch got. The position is
+    kept as a global sample count, so it can be restored with another number of ranks or batch size.
+    """
+    source = _position_source(dataloader)
+    num_replicas = getattr(source, 'num_replicas', getattr(source, 'world_size', 1))
+    return {
+        'epoch': epoch,
+        'seed': getattr(source, 'seed', None),
+        'num_replicas': num_replicas,
+        'batch_size': dataloader.batch_size,
+        'batches_seen': batches_seen,
+        'num_batches': len(dataloader),
+        'samples_seen': batches_seen * dataloader.batch_size * num_replicas,
+    }
+
+
+def set_data_position(dataloader, epoch, state=None):
+    """
+    Positions the loader at the start of epoch, or with a state from data_state_dict at the first unseen batch of
+    that state's epoch. Returns the number of batches of this rank that are skipped.
+    """
+    source = _position_source(dataloader)
+    start_batch = 0
+    if state is not None:
+        assert state['epoch'] == epoch, f'loader state is for epoch {state["epoch"]}, not {epoch}'
+        if state['seed'] is not None:
+            source.seed = state['seed']
+        num_replicas = getattr(source, 'num_replicas', getattr(source, 'world_size', 1))
+        if num_replicas != state['num_replicas'] or dataloader.batch_size != state['batch_size']:
+            print(f'resuming the loader with {num_replicas} ranks x {dataloader.batch_size} samples per batch, '
+                  f'saved with {state["num_replicas"]} x {state["batch_size"]}')
+        start_batch = state['samples_seen'] // (num_replicas * dataloader.batch_size)
+
+    if isinstance(source, IterableDataset):
+        source.set_epoch(epoch, start_batch)
+    elif hasattr(source, 'set_epoch'):
+        # the samplers deal out the permutation rank by rank, so every rank skips the same number of samples
+        source.set_epoch(epoch, start_batch * dataloader.batch_size)
+    elif start_batch:
+        raise ValueError(f'{type(source).__name__} cannot resume in the middle of an epoch')
+    return start_batch
@@ -4,18 +4,35 @@ import random
 from PIL import Image
 
 import torch
+import torch.nn.functional as nnF
 from torchvision import transforms as T
 from torchvision.transforms import functional as F
+from torch.utils.data import default_collate, get_worker_info
+
+
+def open_image(path, draft_size=None):
+    """
+    Open an image as RGB. For JPEGs, draft_size lets the decoder downscale by 1/2, 1/4 or 1/8 while decoding,
+    keeping both sides at least draft_size pixels.
+    """
+    image = Image.open(path)
+    if draft_size is not None and image.format == 'JPEG':
+        image.draft('RGB', (draft_size, draft_size))
+    return image.convert('RGB')
 
 
 class Resize(object):
-    def __init__(self, size, interpolation=F.InterpolationMode.BICUBIC):
+    def __init__(self, size, interpolation=F.InterpolationMode.BICUBIC, target_interpolation=F.InterpolationMode.NEAREST):
         self.size = size
         self.interpolation = interpolation
-    def __call__(self, image, target=None):
-        image = F.resize(image, size=self.size, interpolation=F.InterpolationMode.LANCZOS)
+        # nearest keeps palette colours of the condition maps intact, box (area) suits continuous maps
+        self.target_interpolation = target_interpolation
+    def __call__(self, image, target=None, target_interpolation=None):
+        image = F.resize(image, size=self.size, interpolation=self.interpolation)
         if target is not None:
-            target = F.resize(target, size=self.size, interpolation=F.InterpolationMode.LANCZOS)
+            # straight to the resized image's (h, w), so a target of another size or aspect is resampled only once
+            target = F.resize(target, size=F.get_dimensions(image)[1:],
+                              interpolation=target_interpolation or self.target_interpolation)
         return image, target
 
 
@@ -90,32 +107,159 @@ class ToTensor(object):
         return image, target
 
 
+class PILToTensor(object):
+    def __call__(self, image, target=None):
+        image = F.pil_to_tensor(image)
+        if target is not None:
+            target = F.pil_to_tensor(target)
+        return image, target
+
+
+class ConvertImageDtype(object):
+    def __init__(self, dtype=torch.float32):
+        self.dtype = dtype
+
+    def __call__(self, image, target=None):
+        image = F.convert_image_dtype(image, self.dtype)
+        if target is not None:
+            target = F.convert_image_dtype(target, self.dtype)
+        return image, target
+
+
 class Compose(object):
-    def __init__(self, transforms):
+    def __init__(self, transforms, draft_size=None):
         self.transforms = transforms
+        # datasets open JPEGs with open_image(path, transform.draft_size) to decode at reduced scale
+        self.draft_size = draft_size
 
-    def __call__(self, image, mask=None):
+    def __call__(self, image, mask=None, mask_interpolation=None):
+        # mask_interpolation overrides the target interpolation of Resize for this call, e.g. per condition type
         for t in self.transforms:
-            image, mask = t(image, mask)
+            if mask_interpolation is not None and isinstance(t, Resize):
+                image, mask = t(image, mask, target_interpolation=mask_interpolation)
+            else:
+                image, mask = t(image, mask)
         return image, mask
 
 
-def create_image_mask_transforms(image_size, random_crop=False, mid_res=1.125):
+def normalize_uint8(x):
+    return x.float().div_(127.5).sub_(1)  # same as ToTensor + Normalize(0.5, 0.5)
+
+
+class BatchRandomCropFlip(object):
+    """
+    Crop (and randomly flip) a batch of fixed-size uint8 images and condition maps on the device, then
+    normalize them to [-1, 1]. Crop offsets and flips are drawn per sample and shared by image and condition.
+    """
+    def __init__(self, size, random_crop=True, flip_prob=0.5):
+        self.size = size
+        self.random_crop = random_crop
+        self.flip_prob = flip_prob if random_crop else 0.
+
+    def __call__(self, image, target=None):
+        B, C, H, W = image.shape
+        S = self.size
+        x = image if target is None else torch.cat((image, target), dim=1)
+        if self.random_crop:
+            top = torch.randint(0, H - S + 1, (B,), device=x.device)
+            left = torch.randint(0, W - S + 1, (B,), device=x.device)
+        else:
+            top = torch.full((B,), int(round((H - S) / 2.0)), device=x.device)
+            left = torch.full((B,), int(round((W - S) / 2.0)), device=x.device)
+        offsets = torch.arange(S, device=x.device)
+        rows = top[:, None] + offsets  # B, S
+        cols = left[:, None] + offsets  # B, S
+        if self.flip_prob > 0:
+            flip = torch.rand(B, device=x.device) < self.flip_prob
+            cols = torch.where(flip[:, None], cols.flip(1), cols)
+        x = x[torch.arange(B, device=x.device)[:, None, None], :, rows[:, :, None], cols[:, None, :]]  # B, S, S, C
+        x = normalize_uint8(x.permute(0, 3, 1, 2))
+        if target is None:
+            return x, None
+        return x[:, :C].contiguous(), x[:, C:].contiguous()
+
+
+def build_ignore_masks(cond, v_patch_nums, separator=False, is_mask=None):
+    """
+    Token-level ignore weights of a batch of condition maps (B, 3, H, W) normalized to [-1, 1]: black pixels of
+    mask conditions are ignored from the 6th scale on. Returns the weights for mask-first and image-first order.
+    """
+    B = cond.shape[0]
+    ignore_mask = (cond.sum(dim=1) != -3).float()
+    if is_mask is not None:
+        ignore_mask = torch.where(is_mask.view(B, 1, 1), ignore_mask, torch.ones_like(ignore_mask))
+    ignore_masks = []
+    ignore_masks_ = []
+    for si, pm in enumerate(v_patch_nums):
+        num_sp_tokens = 1 if (si != 0 and separator) else 0
+        ones = ignore_mask.new_ones((B, pm ** 2 + num_sp_tokens))
+        if si < 5:  # [1, 2, 3, 4, 5, 6,]
+            ignore_mask_ = ones
+        else:
+            ignore_mask_ = nnF.interpolate(ignore_mask[:, None], (pm, pm), mode='nearest').reshape(B, -1)
+            if separator:
+                ignore_mask_ = torch.concat((ignore_mask.new_ones((B, 1)), ignore_mask_), dim=1)
+        ignore_masks.extend([ignore_mask_, ones])  # mask ignore, image ignore
+        ignore_masks_.extend([ones, ignore_mask_])  # image ignore, mask ignore
+    return torch.concat(ignore_masks, dim=1), torch.concat(ignore_masks_, dim=1)
+
+
+def collate_uint8(samples):
+    """
+    Collate uint8 samples: image and condition map are packed into a single (B, 6, H, W) uint8 'pixels' tensor,
+    so pinning and the host-to-device copy move one buffer at a quarter of the float32 size.
+    """
+    image = samples[0]['image']
+    assert image.dtype == torch.uint8, 'collate_uint8 expects uint8 samples'
+    C, H, W = image.shape
+    pixels = torch.empty((len(samples), 2 * C, H, W), dtype=torch.uint8)
+    if get_worker_info() is not None:
+        pixels.share_memory_()  # avoid another copy when sending the batch back to the main process
+    for i, sample in enumerate(samples):
+        pixels[i, :C] = sample['image']
+        pixels[i, C:] = sample['mask']
+    batch = default_collate([{k: v for k, v in sample.items() if k not in ('image', 'mask')} for sample in samples])
+    batch['pixels'] = pixels
+    return batch
+
+
+def unpack_uint8_batch(batch, device=None, augment=None):
+    """
+    Move a batch produced by collate_uint8 to the device and return normalized images and condition maps.
+    """
+    pixels = batch['pixels']
+    if device is not None:
+        pixels = pixels.to(device, non_blocking=True)
+    C = pixels.shape[1] // 2
+    images, masks = pixels[:, :C], pixels[:, C:]
+    if augment is not None:
+        return augment(images, masks)
+    return normalize_uint8(images), normalize_uint8(masks)
+
+
+def create_image_mask_transforms(image_size, random_crop=False, mid_res=1.125,
+                                 interpolation=F.InterpolationMode.LANCZOS,
+                                 mask_interpolation=F.InterpolationMode.NEAREST, uint8_ops=False, gpu_aug=False,
+                                 uint8_output=False):
+    """
+    Paired image / condition transforms. With uint8_ops, crop and flip run on uint8 tensors after the
+    conversion, which avoids the intermediate PIL copies. With uint8_output, normalization is left to the
+    device (see collate_uint8). With gpu_aug, workers only return fixed-size (mid_res, mid_res) uint8 tensors
+    and BatchRandomCropFlip does the rest on the device.
+    """
     mid_res = round(mid_res * image_size)
-    if random_crop:
-        transform = Compose([
-            Resize(mid_res, interpolation=F.InterpolationMode.LANCZOS),  # TODO handle mask
-            RandomCrop((image_size, image_size)),
-            RandomHorizontalFlip(),
-            ToTensor(),
-            Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-        ])
+    crop = RandomCrop((image_size, image_size)) if random_crop else CenterCrop((image_size, image_size))
+    flip = [RandomHorizontalFlip()] if random_crop else []
+    resize = Resize(mid_res, interpolation=interpolation, target_interpolation=mask_interpolation)
+    normalize = Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    if gpu_aug:
+        transform = Compose([resize, CenterCrop((mid_res, mid_res)), PILToTensor()], draft_size=mid_res)
+    elif uint8_output:
+        transform = Compose([resize, PILToTensor(), crop, *flip], draft_size=mid_res)
+    elif uint8_ops:
+        transform = Compose([resize, PILToTensor(), crop, *flip, ConvertImageDtype(torch.float32), normalize],
+                            draft_size=mid_res)
     else:
-        transform = Compose([
-            Resize(mid_res, interpolation=F.InterpolationMode.LANCZOS),  # TODO handle mask
-            CenterCrop((image_size, image_size)),
-            ToTensor(),
-            Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-        ])
+        transform = Compose([resize, crop, *flip, ToTensor(), normalize], draft_size=mid_res)
 
     return transform
@@ -1,3 +1,6 @@
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import numpy as np
 from PIL import Image
@@ -6,6 +9,7 @@ import torchdata.datapipes as dps
 from braceexpand import braceexpand
 from .mask_color import mask_colormap
 from pycocotools import mask as mask_utils
+from tqdm import tqdm
 
 def calculate_centroid_poly(polygons):
     """
@@ -134,33 +138,43 @@ def calculate_centroid(label_image, label):
 
 def semantic_to_instance_map(semantic_map_path):
     # Load the semantic map image
-    semantic_map = np.array(Image.open(semantic_map_path))
+    semantic_map = np.array(Image.open(semantic_map_path).convert('RGB'))
 
     # Create the category mask: every non-black pixel is part of the category
-    category_mask = np.any(semantic_map != [0, 0, 0], axis=-1).astype(np.uint8) * 255
+    category_mask = np.any(semantic_map != 0, axis=-1).astype(np.uint8) * 255
 
-    # Find connected components (individual instances) within the category mask
-    num_labels, labels_im = cv2.connectedComponents(category_mask)
+    # Find connected components (individual instances) and their centroids in a single pass
+    num_labels, labels_im, _, centroids = cv2.connectedComponentsWithStats(category_mask)
 
-    # Collect centroids for sorting
-    centroids = []
-    for label in range(1, num_labels):  # Skip the background
-        centroid = calculate_centroid(labels_im, label)
-        if centroid:
-            centroids.append((label, centroid))
+    # Sort instances by the sum of x and y centroid coordinates, bottom-right first (label 0 is the background)
+    order = np.argsort(-(centroids[1:, 0] + centroids[1:, 1]), kind='stable') + 1
+
+    # Build a label -> colour lookup table and paint the whole map at once
+    lut = np.zeros((num_labels, 3), dtype=np.uint8)
+    ranks = np.arange(len(order)) % (len(mask_colormap) - 1) + 1  # skip the black background colour
+    lut[order] = mask_colormap[ranks]
+    instance_map_visual = lut[labels_im]
 
-    # Sort centroids based on their distance from the bottom-right corner
-    # The image's bottom-right corner is at (max_x, max_y)
-    max_x, max_y = labels_im.shape[1], labels_im.shape[0]
-    centroids.sort(key=lambda x: -(x[1][0] + x[1][1]))  # Sort by the sum of x and y coordinates
+    # print(f"Found {num_labels - 1} instances, sorted")
+    return Image.fromarray(instance_map_visual)
 
-    # Create a visual representation (optional)
-    instance_map_visual = np.zeros(semantic_map.shape, dtype=np.uint8)
-    for idx, (label, _) in enumerate(centroids, start=1):
-        color = mask_colormap[idx]
-        instance_map_visual[labels_im == label] = color
 
-    # Convert the visual instance map to a PIL image and save
+def _semantic_to_instance_file(paths):
+    src_path, dst_path = paths
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    semantic_to_instance_map(src_path).save(dst_path)
+    return dst_path
 
-    # print(f"Found {num_labels - 1} instances, sorted")
-    return Image.fromarray(instance_map_visual)
\ No newline at end of file
+
+def semantic_to_instance_dir(src_dir, dst_dir, num_workers=16, ext='png'):
+    """
+    Convert every semantic map under src_dir into an instance map under dst_dir, keeping the folder layout.
+    """
+    src_paths = sorted(glob.glob(os.path.join(src_dir, '**', f'*.{ext}'), recursive=True))
+    jobs = [(p, os.path.join(dst_dir, os.path.relpath(p, src_dir))) for p in src_paths]
+    jobs = [job for job in jobs if not os.path.exists(job[1])]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        with tqdm(total=len(jobs)) as pbar:
+            for _ in executor.map(_semantic_to_instance_file, jobs, chunksize=64):
+                pbar.update(1)
+    return len(jobs)
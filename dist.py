@@ -10,6 +10,7 @@ import torch.distributed as tdist
 
 __rank, __local_rank, __world_size, __device = 0, 0, 1, 'cuda' if torch.cuda.is_available() else 'cpu'
 __initialized = False
+__comm_device = None  # where collectives run; cuda unless set by attach()
 
 
 def initialized():
@@ -48,6 +49,28 @@ def initialize(fork=False, backend='nccl', gpu_id_if_not_distibuted=0, timeout=3
     print(f'[lrk={get_local_rank()}, rk={get_rank()}]')
 
 
+def attach(comm_device=None):
+    """
+    Adopt a process group created with torch.distributed directly (e.g. hccl in train_control_var_hpu.py), so the
+    collectives below work there too. Tensors on other devices are copied to comm_device to be reduced;
+    get_device() is left unchanged.
+    """
+    global __rank, __local_rank, __world_size, __initialized, __comm_device
+    assert tdist.is_initialized(), 'torch.distributed is not initialized!'
+    __rank, __world_size = tdist.get_rank(), tdist.get_world_size()
+    __local_rank = int(os.environ.get('LOCAL_RANK', __rank))
+    __comm_device = comm_device
+    __initialized = True
+
+
+def _on_comm_device(t: torch.Tensor) -> bool:
+    return t.is_cuda if __comm_device is None else t.device.type == torch.device(__comm_device).type
+
+
+def _to_comm_device(t: torch.Tensor) -> torch.Tensor:
+    return t.detach().cuda() if __comm_device is None else t.detach().to(__comm_device)
+
+
 def get_rank():
     return __rank
 
@@ -99,8 +122,8 @@ def barrier():
 
 def allreduce(t: torch.Tensor, async_op=False):
     if __initialized:
-        if not t.is_cuda:
-            cu = t.detach().cuda()
+        if not _on_comm_device(t):
+            cu = _to_comm_device(t)
             ret = tdist.all_reduce(cu, async_op=async_op)
             t.copy_(cu.cpu())
         else:
@@ -111,8 +134,8 @@ def allreduce(t: torch.Tensor, async_op=False):
 
 def allgather(t: torch.Tensor, cat=True) -> Union[List[torch.Tensor], torch.Tensor]:
     if __initialized:
-        if not t.is_cuda:
-            t = t.cuda()
+        if not _on_comm_device(t):
+            t = _to_comm_device(t)
         ls = [torch.empty_like(t) for _ in range(__world_size)]
         tdist.all_gather(ls, t)
     else:
@@ -124,8 +147,8 @@ def allgather(t: torch.Tensor, cat=True) -> Union[List[torch.Tensor], torch.Tens
 
 def allgather_diff_shape(t: torch.Tensor, cat=True) -> Union[List[torch.Tensor], torch.Tensor]:
     if __initialized:
-        if not t.is_cuda:
-            t = t.cuda()
+        if not _on_comm_device(t):
+            t = _to_comm_device(t)
         
         t_size = torch.tensor(t.size(), device=t.device)
         ls_size = [torch.empty_like(t_size) for _ in range(__world_size)]
@@ -151,8 +174,8 @@ def allgather_diff_shape(t: torch.Tensor, cat=True) -> Union[List[torch.Tensor],
 
 def broadcast(t: torch.Tensor, src_rank) -> None:
     if __initialized:
-        if not t.is_cuda:
-            cu = t.detach().cuda()
+        if not _on_comm_device(t):
+            cu = _to_comm_device(t)
             tdist.broadcast(cu, src=src_rank)
             t.copy_(cu.cpu())
         else:
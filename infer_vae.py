@@ -1,3 +1,6 @@
+from time import perf_counter
+STARTUP_T0 = perf_counter()  # taken before the imports, see --profile_startup
+
 import os
 import argparse
 import logging
@@ -13,13 +16,14 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision.utils import make_grid
 
-from transformers import get_scheduler
-
 from datasets import create_dataset
-from models import VQVAE, VisualProgressAutoreg
-from utils.wandb import CustomWandbTracker
+from models import VQVAE
+from utils.startup import StartupProfiler
 from ruamel.yaml import YAML
 
+startup = StartupProfiler(start=STARTUP_T0)
+startup.mark('imports')
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
@@ -77,6 +81,7 @@ def parse_args():
     parser.add_argument("--cond_drop_rate", type=float, default=0.1, help="drop rate of condition model")
 
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--profile_startup", "--profile-startup", action='store_true', help="report the time of every startup phase")
 
     # fFirst parse of command-line args to check for config file
     args = parser.parse_args()
@@ -96,6 +101,7 @@ def parse_args():
 
 def infer_vae(args):
     wandb.init(project="VPA")
+    startup.mark('wandb')
     device = torch.device(args.device)
     if args.device == 'hpu':
         import habana_frameworks.torch.core as htcore
@@ -107,6 +113,8 @@ def infer_vae(args):
         p.requires_grad_(False)
     if args.vqvae_pretrained_path is not None:
         vqvae.load_state_dict(torch.load(args.vqvae_pretrained_path))
+    startup.mark('vqvae')
+    startup.report()
 
     for batch_idx, batch in enumerate(dataloader):
         images, conditions = batch
@@ -123,6 +131,7 @@ def infer_vae(args):
 
 if __name__ == '__main__':
     args = parse_args()
+    startup.enabled = args.profile_startup
     # Setup accelerator:
     if args.run_name is None:
         model_name = f'vqvae_ch{args.ch}v{args.vocab_size}z{args.z_channels}_vpa_d{args.depth}e{args.embed_dim}h{args.num_heads}_{args.dataset_name}_ep{args.num_epochs}_bs{args.batch_size}'
@@ -138,6 +147,7 @@ if __name__ == '__main__':
     # create dataloader
     dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
                             pin_memory=True, drop_last=True)
+    startup.mark('dataset')
     # Calculate total batch size
 
     infer_vae(args)
\ No newline at end of file
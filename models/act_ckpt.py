@@ -0,0 +1,82 @@
+import math
+
+# per-block modes: recompute the whole block, or only its self-attention, in the backward
+ACT_CKPT_MODES = ('block', 'attn')
+
+
+def block_activation_bytes(batch_size, seq_len, embed_dim, num_heads, mlp_ratio=4., dtype_bytes=2, attn_matrix=True):
+    """
+    Rough bytes one transformer block keeps for the backward, as (plain, attention checkpointed, block checkpointed).
+    The attention keeps qkv, its output and, unless a memory-efficient kernel runs, the (L, L) probabilities per head;
+    the rest of the block keeps about 8 + 2 * mlp_ratio tensors of (B, L, C). A checkpointed block keeps its input.
+    """
+    BLC = batch_size * seq_len * embed_dim * dtype_bytes
+    attn = 4 * BLC + (batch_size * num_heads * seq_len ** 2 * dtype_bytes if attn_matrix else 0)
+    rest = (8 + 2 * mlp_ratio) * BLC
+    return rest + attn, rest + BLC, BLC
+
+
+def _spread(k, depth):
+    """k block indices spread evenly over the stack."""
+    return sorted({int(i * depth / k) for i in range(k)}) if k > 0 else []
+
+
+def plan_activation_checkpointing(policy, depth, bytes_per_block=None):
+    """
+    Per-block modes (None, 'attn' or 'block') of a policy:
+      none | all | attn | every:N (whole blocks 0, N, 2N, ...) | budget:GiB
+    budget:GiB keeps the activations of the stack under the budget (bytes_per_block from block_activation_bytes is
+    needed) with the least recomputation: attention checkpoints first, on as few blocks as possible, then whole blocks.
+    """
+    policy = (policy or 'none').lower()
+    if policy == 'none':
+        return [None] * depth
+    if policy == 'all':
+        return ['block'] * depth
+    if policy == 'attn':
+        return ['attn'] * depth
+    name, _, value = policy.partition(':')
+    if name == 'every':
+        n = int(value)
+        assert n >= 1, f'every:N needs N >= 1, got {policy}'
+        return ['block' if i % n == 0 else None for i in range(depth)]
+    if name != 'budget':
+        raise ValueError(f'unknown activation checkpointing policy: {policy}')
+
+    assert bytes_per_block is not None, 'budget:GiB needs the activation size of a block'
+    budget = float(value) * 2 ** 30
+    plain, attn_only, ckpt = bytes_per_block
+    modes = [None] * depth
+    if depth * plain <= budget:
+        return modes
+    if depth * attn_only <= budget:
+        for i in _spread(math.ceil((depth * plain - budget) / (plain - attn_only)), depth):
+            modes[i] = 'attn'
+        return modes
+    k = math.ceil((depth * attn_only - budget) / (attn_only - ckpt))
+    if k > depth:
+        print(f'[act_ckpt] {float(value):g}GiB is below the {depth * ckpt / 2 ** 30:.2f}GiB of a fully checkpointed stack')
+    modes = ['attn'] * depth
+    for i in _spread(min(k, depth), depth):
+        modes[i] = 'block'
+    return modes
+
+
+def apply_activation_checkpointing(blocks, policy, batch_size=None, seq_len=None, dtype_bytes=2):
+    """
+    Sets the act_ckpt mode of every SABlock / AdaLNSABlock in blocks and returns the modes. batch_size and seq_len
+    (per device) are only needed for budget policies. Checkpointing is non-reentrant, so it works under DDP and
+    accelerate as is, and only applies in training mode with grad enabled.
+    """
+    bytes_per_block = None
+    if policy and policy.lower().startswith('budget'):
+        b0 = blocks[0]
+        attn = b0.attn
+        bytes_per_block = block_activation_bytes(
+            batch_size, seq_len, b0.C, attn.num_heads, mlp_ratio=b0.ffn.fc1.out_features / b0.C,
+            dtype_bytes=dtype_bytes, attn_matrix=not attn.using_xform,
+        )
+    modes = plan_activation_checkpointing(policy, len(blocks), bytes_per_block)
+    for b, mode in zip(blocks, modes):
+        b.act_ckpt = mode
+    return modes
@@ -3,7 +3,9 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
+from models.block_sparse import BlockSparseLayout, block_sparse_attn
 from models.helpers import DropPath, drop_path
 
 
@@ -93,12 +95,14 @@ class SelfAttention(nn.Module):
         # qkv: BL3Hc
         
         using_flash = self.using_flash and attn_bias is None and qkv.dtype != torch.float32
-        if using_flash or self.using_xform: q, k, v = qkv.unbind(dim=2); dim_cat = 1   # q or k or v: BLHc
+        block_sparse = isinstance(attn_bias, BlockSparseLayout)    # masked blocks are skipped, see models/block_sparse.py
+        using_BLHc = (using_flash or self.using_xform) and not block_sparse
+        if using_BLHc: q, k, v = qkv.unbind(dim=2); dim_cat = 1   # q or k or v: BLHc
         else: q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(dim=0); dim_cat = 2               # q or k or v: BHLc
         
         if self.cos_attn:
             scale_mul = self.scale_mul_1H11.clamp_max(self.max_scale_mul).exp()
-            if using_flash or self.using_xform: scale_mul = scale_mul.transpose(1, 2)  # 1H11 to 11H1
+            if using_BLHc: scale_mul = scale_mul.transpose(1, 2)  # 1H11 to 11H1
             q = F.normalize(q, dim=-1).mul(scale_mul)
             k = F.normalize(k, dim=-1)
             k = k.to(q.dtype)
@@ -108,7 +112,9 @@ class SelfAttention(nn.Module):
             else: k = self.cached_k = torch.cat((self.cached_k, k), dim=dim_cat); v = self.cached_v = torch.cat((self.cached_v, v), dim=dim_cat)
         
         dropout_p = self.attn_drop if self.training else 0.0
-        if using_flash:
+        if block_sparse:
+            oup = block_sparse_attn(q, k, v, attn_bias, scale=self.scale, dropout_p=dropout_p, attn_fn=slow_attn).transpose(1, 2).reshape(B, L, C)
+        elif using_flash:
             assert attn_bias is None and qkv.dtype != torch.float32
             oup = flash_attn_func(q, k, v, dropout_p=dropout_p, softmax_scale=self.scale).view(B, L, C)
         elif self.using_xform:
@@ -146,13 +152,24 @@ class SABlock(nn.Module):
             self.gamma2 = nn.Parameter(layer_scale * torch.ones(embed_dim), requires_grad=True)
         else:
             self.gamma1 = self.gamma2 = 1
+        self.act_ckpt = None    # None, 'attn' or 'block', see models/act_ckpt.py
     
     # NOTE: attn_bias is None during inference because kv cache is enabled
     def forward(self, x, cond_BD, attn_bias):
+        if self.act_ckpt == 'block' and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, cond_BD, attn_bias, use_reentrant=False)
+        return self._forward(x, cond_BD, attn_bias)
+    
+    def _attn(self, x, attn_bias):
+        if self.act_ckpt == 'attn' and self.training and torch.is_grad_enabled():
+            return checkpoint(self.attn, x, attn_bias, use_reentrant=False)
+        return self.attn(x, attn_bias=attn_bias)
+    
+    def _forward(self, x, cond_BD, attn_bias):
         if self.fused_add_norm_fn is not None:
             return self.fused_forward_wo_cond(x, attn_bias=attn_bias)
         main_type = x.dtype
-        x = x.float() + self.drop_path(self.gamma1 * self.attn(self.norm1(x), attn_bias=attn_bias))     # following flash-attn: using fp32 in residual
+        x = x.float() + self.drop_path(self.gamma1 * self._attn(self.norm1(x), attn_bias=attn_bias))     # following flash-attn: using fp32 in residual
         x = x + self.drop_path(self.gamma2 * self.ffn(self.norm2(x.to(dtype=main_type))))               # following flash-attn: using fp32 in residual
         return x.to(dtype=main_type)
     
@@ -164,7 +181,7 @@ class SABlock(nn.Module):
             x0=x, residual=residual, weight=self.norm1.weight, bias=self.norm1.bias, dropout_p=0.0,              # todo: no drop
             epsilon=self.norm1.eps, rowscale=rowscale1, layerscale=self.gamma1 if isinstance(self.gamma1, torch.nn.Parameter) else None, prenorm=True, residual_in_fp32=True,
         )
-        x = self.attn(x, attn_bias=attn_bias)
+        x = self._attn(x, attn_bias=attn_bias)
         rowscale2 = drop_path(x=x.new_ones(x.shape[:-1]), drop_prob=self.drop_prob, training=True) if self.drop_prob > 0 and self.training else None
         x, residual = self.fused_add_norm_fn(
             x0=x, residual=residual, weight=self.norm2.weight, bias=self.norm2.bias, dropout_p=0.0,              # todo: no drop
@@ -198,16 +215,27 @@ class AdaLNSABlock(nn.Module):
             self.ada_lin = nn.Sequential(nn.SiLU(inplace=False), lin)
         
         self.fused_add_norm_fn = None
+        self.act_ckpt = None    # None, 'attn' or 'block', see models/act_ckpt.py
     
     # NOTE: attn_bias is None during inference because kv cache is enabled
     def forward(self, x, cond_BD, attn_bias):   # C: embed_dim, D: cond_dim
+        if self.act_ckpt == 'block' and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, cond_BD, attn_bias, use_reentrant=False)
+        return self._forward(x, cond_BD, attn_bias)
+    
+    def _attn(self, x, attn_bias):
+        if self.act_ckpt == 'attn' and self.training and torch.is_grad_enabled():
+            return checkpoint(self.attn, x, attn_bias, use_reentrant=False)
+        return self.attn(x, attn_bias=attn_bias)
+    
+    def _forward(self, x, cond_BD, attn_bias):
         if self.shared_aln:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = (self.ada_gss + cond_BD).unbind(2) # 116C + B16C =unbind(2)=> 6 B1C
         else:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
-        x = x + self.drop_path(self.attn( self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias=attn_bias ).mul_(gamma1))
+        x = x + self.drop_path(self._attn( self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias=attn_bias ).mul_(gamma1))
         x = x + self.drop_path(self.ffn( self.ln_wo_grad(x).mul(scale2.add(1)).add_(shift2) ).mul(gamma2)) # this mul(gamma2) cannot be in-placed when FusedMLP is used
         return x
     
     def extra_repr(self) -> str:
-        return f'shared_aln={self.shared_aln}'
+        return f'shared_aln={self.shared_aln}, act_ckpt={self.act_ckpt}'
@@ -0,0 +1,91 @@
+from typing import List, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def attention_reference(query, key, value, scale: float, attn_mask=None, dropout_p=0.0):    # q, k, v: BHLc
+    """Plain matmul-softmax attention, the pure PyTorch reference (and CPU) path."""
+    attn = query.mul(scale) @ key.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn + attn_mask
+    attn = attn.float().softmax(dim=-1).to(value.dtype)
+    if dropout_p > 0:
+        attn = F.dropout(attn, p=dropout_p)
+    return attn @ value
+
+
+class BlockSparseLayout(object):
+    """
+    Which (query segment, key segment) blocks of an additive attention mask are open, for masks that are constant
+    (0 or -inf) on every block. The segments of ControlVAR are the halves of each scale in begin_ends.
+
+    Query segments that see the same keys are grouped; block_sparse_attn runs one unmasked attention per group over
+    its open key runs only, so the fully masked blocks cost nothing and no dense bias is needed.
+    """
+    def __init__(self, L: int, groups: List[Tuple[int, int, List[Tuple[int, int]]]]):
+        self.L = L
+        self.groups = groups    # (q_start, q_end, [(k_start, k_end), ...])
+        self._index = {}
+
+    @classmethod
+    def from_bias(cls, bias_LL: torch.Tensor, boundaries: Sequence[int]) -> 'BlockSparseLayout':
+        """boundaries are the segment edges 0 = b_0 < b_1 < ... = L."""
+        L = bias_LL.shape[-1]
+        assert boundaries[0] == 0 and boundaries[-1] == L, f'boundaries {boundaries} do not cover 0..{L}'
+        segments = list(zip(boundaries[:-1], boundaries[1:]))
+        groups = []
+        for qs, qe in segments:
+            runs = []
+            for ks, ke in segments:
+                block = bias_LL[qs:qe, ks:ke]
+                if (block == 0).all():
+                    if runs and runs[-1][1] == ks:
+                        runs[-1] = (runs[-1][0], ke)
+                    else:
+                        runs.append((ks, ke))
+                elif not torch.isneginf(block).all():
+                    raise ValueError(f'attention mask is not constant 0 or -inf on block [{qs}:{qe}, {ks}:{ke}]')
+            assert runs, f'queries [{qs}:{qe}] see no keys'
+            if groups and groups[-1][1] == qs and groups[-1][2] == runs:
+                groups[-1] = (groups[-1][0], qe, runs)
+            else:
+                groups.append((qs, qe, runs))
+        return cls(L, groups)
+
+    def dense_bias(self, dtype=torch.float32, device=None) -> torch.Tensor:
+        """The (L, L) additive mask of this layout."""
+        bias = torch.full((self.L, self.L), -torch.inf, dtype=dtype, device=device)
+        for qs, qe, runs in self.groups:
+            for ks, ke in runs:
+                bias[qs:qe, ks:ke] = 0
+        return bias
+
+    def density(self) -> float:
+        """Fraction of the (L, L) attention scores that are computed."""
+        return sum((qe - qs) * sum(ke - ks for ks, ke in runs) for qs, qe, runs in self.groups) / self.L ** 2
+
+    def keys(self, x: torch.Tensor, gi: int) -> torch.Tensor:
+        """The open keys (or values) of group gi from x: B, H, L, c; a view when they are one run."""
+        runs = self.groups[gi][2]
+        if len(runs) == 1:
+            return x[:, :, runs[0][0]:runs[0][1]]
+        index = self._index.get((gi, x.device))
+        if index is None:
+            index = torch.cat([torch.arange(ks, ke) for ks, ke in runs]).to(x.device)
+            self._index[gi, x.device] = index
+        return x.index_select(2, index)
+
+
+def block_sparse_attn(query, key, value, layout: BlockSparseLayout, scale: float, dropout_p=0.0,
+                      attn_fn=attention_reference) -> torch.Tensor:     # q, k, v: BHLc, returns BHLc
+    """
+    Attention under the mask of layout, computed group by group on the open blocks only. attn_fn(query, key, value,
+    scale=, dropout_p=) runs the unmasked attention of a group, e.g. scaled_dot_product_attention, which can pick its
+    flash / memory-efficient kernels since there is no bias; the default is the pure PyTorch reference.
+    """
+    assert query.shape[2] == layout.L, f'sequence of {query.shape[2]} tokens, layout of {layout.L}'
+    oup = []
+    for gi, (qs, qe, _) in enumerate(layout.groups):
+        oup.append(attn_fn(query[:, :, qs:qe], layout.keys(key, gi), layout.keys(value, gi), scale=scale, dropout_p=dropout_p))
+    return torch.cat(oup, dim=2)
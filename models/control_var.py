@@ -10,7 +10,8 @@ from torch.nn import functional as F
 
 import dist
 from models.basic_var import AdaLNSABlock, SABlock
-from models.helpers import sample_with_top_k_top_p_, gumbel_softmax_with_rng
+from models.block_sparse import BlockSparseLayout
+from models.helpers import sample_with_top_k_top_p_, gumbel_softmax_with_rng, PhiloxRNG, linear_cross_entropy
 from models.vqvae import VQVAE, VectorQuantizer2
 
 
@@ -28,7 +29,7 @@ class ControlVAR(nn.Module):
         layer_scale=-1., tau=4, cos_attn=False,
         patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16),   # 10 steps by default
         flash_if_available=True, fused_if_available=True, mask_factor=2, bidirectional=False, separate_decoding=False,
-        separator=False, type_pos=False, indep=True, multi_cond=False,
+        separator=False, type_pos=False, indep=True, multi_cond=False, block_sparse=False,
     ):
         super().__init__()
         # 0. hyperparameters
@@ -66,6 +67,21 @@ class ControlVAR(nn.Module):
             cur += (pn ** 2 + num_sp_tokens) * mask_factor
         self.num_stages_minus_1 = len(self.patch_nums) - 1
         self.rng = torch.Generator(device=dist.get_device())
+        if self.separator:
+            # static teacher-forcing layout, per scale [x1, sep, x2, sep]: where the word tokens and the separators go
+            # and which separator embedding each one uses (mapping swaps the pairs when the image comes first)
+            word_pos, sep_pos = [], []
+            for si, pn in enumerate(self.patch_nums[1:]):
+                bg = self.begin_ends[si + 1][0]
+                for half in range(mask_factor):
+                    start = bg + half * (pn * pn + 1)
+                    word_pos.extend(range(start, start + pn * pn))
+                    sep_pos.append(start + pn * pn)
+            assert self.first_l + len(word_pos) + len(sep_pos) == self.L
+            sep_ids = torch.arange(len(sep_pos))
+            self.register_buffer('sep_word_pos', torch.tensor(word_pos), persistent=False)
+            self.register_buffer('sep_pos', torch.tensor(sep_pos), persistent=False)
+            self.register_buffer('sep_ids', torch.stack([sep_ids, sep_ids ^ 1]), persistent=False)
 
         # 1. input (word) embedding
         quant: VectorQuantizer2 = vae_local.quantize
@@ -196,6 +212,15 @@ class ControlVAR(nn.Module):
                 # Image.fromarray(attn_bias_for_masking_.cpu().numpy().astype(np.uint8)[0, 0]).convert('L').save('mask_.png')
 
         self.register_buffer('attn_bias_for_masking', attn_bias_for_masking.contiguous())
+        # the mask is constant on the blocks between the halves of the scales, so the block-sparse path can skip
+        # the fully masked blocks instead of adding a dense -inf bias
+        self.attn_layout = None
+        if block_sparse:
+            boundaries = [0]
+            for bg, ed in self.begin_ends:
+                boundaries.extend(bg + (ed - bg) * (h + 1) // mask_factor for h in range(mask_factor))
+            self.attn_layout = BlockSparseLayout.from_bias(attn_bias_for_masking[0, 0], boundaries)
+            print(f'[block sparse attention] {len(self.attn_layout.groups)} query groups, {100 * self.attn_layout.density():.1f}% of the scores computed')
 
         # 6. classifier head
         num_total_sp_tokens = self.num_stages_minus_1 * mask_factor if self.separator else 0
@@ -212,6 +237,26 @@ class ControlVAR(nn.Module):
             self.cond_embed = nn.Embedding(5, self.C)
             nn.init.trunc_normal_(self.cond_embed.weight.data, mean=0, std=init_std)
 
+    def make_rng(self, g_seed, B):
+        """
+        None, a single generator for the whole batch (int seed), or a counter-based stream per sample (B seeds).
+        Per-sample streams make every random draw of a sample independent of the other samples in the batch.
+        """
+        if g_seed is None:
+            return None
+        if isinstance(g_seed, int):
+            self.rng.manual_seed(g_seed)
+            return self.rng
+        rng = PhiloxRNG(g_seed, device=self.lvl_1L.device)
+        assert len(rng) == B, f'expected {B} seeds, got {len(rng)}'
+        return rng
+
+    @staticmethod
+    def multinomial_B(probs_1C: torch.Tensor, B: int, rng) -> torch.Tensor:
+        if isinstance(rng, PhiloxRNG):
+            return rng.multinomial(probs_1C.expand(B, -1))[:, 0]
+        return torch.multinomial(probs_1C, num_samples=B, replacement=True, generator=rng).reshape(B)
+
     def get_logits(self, h_or_h_and_residual: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]], cond_BD: Optional[torch.Tensor]):
         if not isinstance(h_or_h_and_residual, torch.Tensor):
             h, resi = h_or_h_and_residual   # is h_and_residual, so fused_add_norm must be used, so self.gamma2_last is not None
@@ -229,26 +274,32 @@ class ControlVAR(nn.Module):
         """
         only used for inference, on autoregressive mode
         :param B: batch size
-        :param label_B: imagenet label; if None, randomly sampled
-        :param g_seed: random seed
-        :param cfg: classifier-free guidance ratio
+        :param label_B: imagenet label, or one label per sample; if None, randomly sampled
+        :param g_seed: random seed, or one seed per sample
+        :param cfg: classifier-free guidance ratios (class, condition type, pixel condition), or a (B, 3) tensor
         :param top_k: top-k sampling
         :param top_p: top-p sampling
         :param more_smooth: smoothing the pred using gumbel softmax; only used in visualization, not used in FID/IS benchmarking
+        :param cond_type: condition type, or one per sample
         :return: if returns_vemb: list of embedding h_BChw := vae_embed(idx_Bl), else: list of idx_Bl
         """
-        if g_seed is None:
-            rng = None
-        else:
-            self.rng.manual_seed(g_seed); rng = self.rng
+        rng = self.make_rng(g_seed, B)
 
         lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC
 
         if label_B is None:
-            label_B = torch.multinomial(self.selecting_idx, num_samples=B, replacement=True, generator=rng).reshape(B)
+            label_B = self.multinomial_B(self.selecting_idx, B, rng)
         elif isinstance(label_B, int):
             label_B = torch.full((B,), fill_value=self.num_classes if label_B < 0 else label_B,
                                  device=self.lvl_1L.device)
+        elif isinstance(label_B, (list, tuple)):
+            label_B = torch.tensor(label_B, device=self.lvl_1L.device)
+        if isinstance(cond_type, int):
+            cond_type = torch.full((B,), fill_value=cond_type, device=self.lvl_1L.device)
+        elif isinstance(cond_type, (list, tuple)):
+            cond_type = torch.tensor(cond_type, device=self.lvl_1L.device)
+        if torch.is_tensor(cfg):  # per-sample guidance, one (B, 1, 1) scale per term
+            cfg = cfg.to(self.lvl_1L.device).float().view(B, 3, 1, 1).unbind(1)
         empty_cls = torch.full_like(label_B, fill_value=self.num_classes)
         # p(c2|c1,C,I)p(c1|C,I)p(C|I)p(I)
         # label_B = torch.cat((label_B, empty_cls, empty_cls), dim=0)
@@ -303,8 +354,9 @@ class ControlVAR(nn.Module):
                 logits_BlV = (1 + t1) * logits_BlV[:B] \
                              + (t2 - t1) * logits_BlV[B:2 * B] \
                              - t2 * logits_BlV[-B:]
-            logits_BlV = logits_BlV.repeat(repeat_num, 1, 1)
+            # sample once per sample and share the tokens with its guidance copies
             idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+            idx_Bl = idx_Bl.repeat(repeat_num, 1)
 
             if c_mask is not None :  # Teaching force
                 if repeat_num == 4:
@@ -329,6 +381,7 @@ class ControlVAR(nn.Module):
                 gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)  # refer to mask-git
                 h_BChw = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1,
                                                  rng=rng) @ self.vae_quant_proxy[0].embedding.weight.unsqueeze(0)
+                h_BChw = h_BChw.repeat(repeat_num, 1, 1)
 
             assert self.mask_factor == 2, 'current visualization only support mask_factor == 2'
             h_BChw = h_BChw.transpose_(1, 2)
@@ -362,21 +415,27 @@ class ControlVAR(nn.Module):
         """
         only used for inference, on autoregressive mode
         :param B: batch size
-        :param label_B: imagenet label; if None, randomly sampled
-        :param g_seed: random seed
-        :param cfg: classifier-free guidance ratio
+        :param label_B: imagenet label, or one label per sample; if None, randomly sampled
+        :param g_seed: random seed, or one seed per sample
+        :param cfg: classifier-free guidance ratio, or one ratio per sample
         :param top_k: top-k sampling
         :param top_p: top-p sampling
         :param more_smooth: smoothing the pred using gumbel softmax; only used in visualization, not used in FID/IS benchmarking
+        :param cond_type: condition type, or one per sample
         :return: if returns_vemb: list of embedding h_BChw := vae_embed(idx_Bl), else: list of idx_Bl
         """
-        if g_seed is None: rng = None
-        else: self.rng.manual_seed(g_seed); rng = self.rng
+        rng = self.make_rng(g_seed, B)
 
         if label_B is None:
-            label_B = torch.multinomial(self.selecting_idx, num_samples=B, replacement=True, generator=rng).reshape(B)
+            label_B = self.multinomial_B(self.selecting_idx, B, rng)
         elif isinstance(label_B, int):
             label_B = torch.full((B,), fill_value=self.num_classes if label_B < 0 else label_B, device=self.lvl_1L.device)
+        elif isinstance(label_B, (list, tuple)):
+            label_B = torch.tensor(label_B, device=self.lvl_1L.device)
+        if isinstance(cond_type, (list, tuple)):
+            cond_type = torch.tensor(cond_type, device=self.lvl_1L.device)
+        if not isinstance(cfg, (int, float)):  # per-sample guidance
+            cfg = torch.as_tensor(cfg, dtype=torch.float32, device=self.lvl_1L.device).view(B, 1, 1)
 
         sos = cond_BD = self.class_emb(torch.cat((label_B, torch.full_like(label_B, fill_value=self.num_classes)), dim=0))
         mask_first = True
@@ -389,10 +448,10 @@ class ControlVAR(nn.Module):
                     uncond_type = torch.tensor([4, 4, 4, 4], device=dist.get_device())
                 else:
                     cond_idx = torch.full((1, 4), fill_value=1 / 4, dtype=torch.float32, device=dist.get_device())
-                    cond_type = torch.multinomial(cond_idx, num_samples=B, replacement=True, generator=rng).reshape(B)
+                    cond_type = self.multinomial_B(cond_idx, B, rng)
                     uncond_type = torch.full((B,), fill_value=4, device=self.lvl_1L.device)
             elif isinstance(cond_type, int):
-                assert cond_type <= 3 and cond_type > 0
+                assert 0 <= cond_type <= 3
                 cond_type = torch.full((B,), fill_value=cond_type, device=self.lvl_1L.device)
                 uncond_type = torch.full((B,), fill_value=4, device=self.lvl_1L.device)
             else:
@@ -541,11 +600,10 @@ class ControlVAR(nn.Module):
                         next_token_map_2 = next_token_map_2.view(B, self.Cvae, -1).transpose(1, 2)
 
                         if self.separator:
-                            mapping = [i for i in range(18)] if mask_first else [i + 1 if i % 2 == 0 else i - 1 for i in range(18)]
-                            label1, label2 = mapping[2 * si] + self.V, mapping[2 * si + 1] + self.V
-                            label1, label2 = sos.new_ones(B, ) * label1, sos.new_ones(B, ) * label2
-                            label1, label2 = label1.unsqueeze(1), label2.unsqueeze(1)
-                            special_token1, special_token2 = self.special_embed(label1.long()), self.special_embed(label2.long())
+                            # the separators of the next scale, in the same layout as forward (see sep_ids)
+                            special_tokens = self.special_embed(self.sep_ids[0 if mask_first else 1, 2 * si: 2 * si + 2])
+                            special_token1 = special_tokens[None, :1].expand(B, -1, -1)
+                            special_token2 = special_tokens[None, 1:].expand(B, -1, -1)
                             next_token_map_1 = self.word_embed(next_token_map_1)
                             next_token_map_2 = self.word_embed(next_token_map_2)
                             next_token_map = torch.concat((next_token_map_1, special_token1, next_token_map_2, special_token2), dim=1)
@@ -565,10 +623,27 @@ class ControlVAR(nn.Module):
         return torch.concat([img1, img2], dim=2)   # de-normalize, from [-1, 1] to [0, 1]
 
 
-    def forward(self, label_B: torch.LongTensor, x_BLCv_wo_first_l: torch.Tensor, cond_type, mask_first=True) -> torch.Tensor:  # returns logits_BLV
+    def head_loss(self, h_BLC: torch.Tensor, cond_BD: Optional[torch.Tensor], target_BL: torch.Tensor,
+                  weight_BL: Optional[torch.Tensor] = None, chunk_size: int = 8192) -> torch.Tensor:
+        """
+        Weighted sum of the token cross-entropies of get_logits(h_BLC, cond_BD), computed by the fused chunked
+        head + cross-entropy, so the (B, L, V) logits are never materialized.
+        """
+        h = self.head_nm(h_BLC.float(), cond_BD).float()
+        head = self.head
+        if isinstance(head, nn.Sequential):
+            h, head = head[:-1](h), head[-1]
+        weight_N = weight_BL.reshape(-1) if weight_BL is not None else None
+        return linear_cross_entropy(h.reshape(-1, h.shape[-1]), head.weight, head.bias, target_BL.reshape(-1), weight_N, chunk_size)
+
+    def forward(self, label_B: torch.LongTensor, x_BLCv_wo_first_l: torch.Tensor, cond_type, mask_first=True,
+                target_BL=None, weight_BL=None, loss_chunk=8192) -> torch.Tensor:  # returns logits_BLV
         """
         :param label_B: label_B
         :param x_BLCv_wo_first_l: teacher forcing input (B, self.L-self.first_l, self.Cvae)
+        :param target_BL: if given, returns the weighted sum of the token losses (see head_loss) instead of the logits
+        :param weight_BL: per-token loss weights (e.g. the ignore mask), all ones if None
+        :param loss_chunk: tokens per chunk of the fused head + cross-entropy
         :return: logits BLV, V is vocab_size
         """
         bg, ed = self.begin_ends[self.prog_si] if self.prog_si >= 0 else (0, self.L)
@@ -601,21 +676,13 @@ class ControlVAR(nn.Module):
                 x_BLC = sos
             else:
                 if self.separator:
-                    mapping = [i for i in range(18)] if mask_first else [i + 1 if i % 2 == 0 else i - 1 for i in range(18)]
-                    x_BLC = self.word_embed(x_BLCv_wo_first_l.float())
-                    new_x = [sos,]
-                    cur = 0
-                    for si, pn in enumerate(self.patch_nums[1:]):  # skip first
-                        label1, label2 = mapping[2 * si] + self.V, mapping[2 * si+1] + self.V
-                        label1, label2 = x_BLC.new_ones(B,) * label1, x_BLC.new_ones(B,) * label2
-                        label1, label2 = label1.unsqueeze(1), label2.unsqueeze(1)
-                        special_token1, special_token2 = self.special_embed(label1.long()), self.special_embed(label2.long())
-                        x1 = x_BLC[:, cur: cur + pn * pn]
-                        x2 = x_BLC[:, cur + pn*pn: cur + pn*pn * self.mask_factor]
-                        new_x.extend([x1, special_token1, x2, special_token2])
-                        cur += pn*pn * self.mask_factor
-                    assert cur == x_BLCv_wo_first_l.shape[1]
-                    x_BLC = torch.cat(new_x, dim=1)
+                    assert x_BLCv_wo_first_l.shape[1] == self.sep_word_pos.shape[0]
+                    words = self.word_embed(x_BLCv_wo_first_l.float())
+                    special_tokens = self.special_embed(self.sep_ids[0 if mask_first else 1])   # one lookup, shared by the batch
+                    x_BLC = words.new_empty(B, self.L, self.C)
+                    x_BLC[:, :self.first_l] = sos
+                    x_BLC.index_copy_(1, self.sep_word_pos, words)
+                    x_BLC.index_copy_(1, self.sep_pos, special_tokens.unsqueeze(0).expand(B, -1, -1))
                 else:
                     x_BLC = torch.cat((sos, self.word_embed(x_BLCv_wo_first_l.float())), dim=1)
 
@@ -633,10 +700,17 @@ class ControlVAR(nn.Module):
         x_BLC = x_BLC.to(dtype=main_type)
         cond_BD_or_gss = cond_BD_or_gss.to(dtype=main_type)
         attn_bias = attn_bias.to(dtype=main_type)
+        if self.attn_layout is not None and ed == self.L:
+            attn_bias = self.attn_layout
 
         SABlock.forward, AdaLNSABlock.forward
         for i, b in enumerate(self.blocks):
             x_BLC = b(x=x_BLC, cond_BD=cond_BD_or_gss, attn_bias=attn_bias)
+        if target_BL is not None:
+            loss = self.head_loss(x_BLC.float(), cond_BD, target_BL, weight_BL, loss_chunk)
+            if self.prog_si == 0:
+                loss = loss + sum(p.view(-1)[0] * 0 for p in self.word_embed.parameters() if p.requires_grad)
+            return loss
         x_BLC = self.get_logits(x_BLC.float(), cond_BD)
 
         if self.prog_si == 0:
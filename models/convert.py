@@ -0,0 +1,121 @@
+import os
+import json
+import math
+import hashlib
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+from utils.checkpoint import load_weights, save_weights
+
+# buffers and parameters ControlVAR rebuilds in its own init
+SKIPPED_KEYS = ('lvl_1L', 'pos_start', 'attn_bias_for_masking')
+
+
+def _trunc_normal(shape, std, generator_seed):
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(generator_seed)
+        return nn.init.trunc_normal_(torch.empty(shape), mean=0, std=std)
+
+
+def pos_source_index(patch_nums, separator=False, interpos=False):
+    """
+    For every position of the ControlVAR pos_1LC: the VAR position it is copied from (-1 for separator tokens, which
+    start from scratch) and whether it lies in the second (image) half of its scale.
+
+    The layouts are, per scale, [cond, image] with interpos, [cond (pn^2), sep, image (pn^2), sep] with separators
+    (none on the first scale), and the whole VAR sequence twice otherwise.
+    """
+    pn2 = torch.tensor(patch_nums) ** 2
+    starts = torch.cumsum(pn2, 0) - pn2
+    if not separator and not interpos:
+        L = int(pn2.sum())
+        index = torch.arange(2 * L)
+        return index % L, index >= L
+    sp = (torch.arange(len(patch_nums)) > 0).long()
+    if interpos:
+        sp = torch.zeros_like(sp)
+    half = pn2 + sp
+    scale = torch.repeat_interleave(torch.arange(len(patch_nums)), 2 * half)
+    local = torch.arange(int(scale.numel())) - torch.repeat_interleave(torch.cumsum(2 * half, 0) - 2 * half, 2 * half)
+    second = local >= half[scale]
+    within = local - second.long() * half[scale]
+    src = torch.where(within < pn2[scale], starts[scale] + within, torch.full_like(within, -1))
+    return src, second
+
+
+def var_to_control_var(state_dict, patch_nums, embed_dim, vocab_size, separator=False, interpos=False, mpos=False,
+                       seed=0):
+    """
+    Turns a VAR state dict into a ControlVAR one: pos_1LC is laid out for the interleaved condition/image sequence
+    with one gather, and with separators the head gets rows for the separator tokens. New entries are drawn from
+    the same truncated normals as before, seeded so every converted copy is identical.
+    """
+    state_dict = OrderedDict((k.replace('module.', ''), v) for k, v in state_dict.items())
+    for key in SKIPPED_KEYS:
+        state_dict.pop(key, None)
+    init_std = math.sqrt(1 / embed_dim / 3)
+
+    pos_1LC_ = state_dict['pos_1LC']
+    src, second = pos_source_index(patch_nums, separator, interpos)
+    pos_1LC = _trunc_normal((1, len(src), embed_dim), init_std, seed)
+    copied = src >= 0
+    pe = pos_1LC_[0, src[copied]].float()
+    if mpos and separator:  # the image half starts from the negated positions
+        pe = torch.where(second[copied, None], -pe, pe)
+    pos_1LC[0, copied] = pe.to(pos_1LC.dtype)
+    state_dict['pos_1LC'] = pos_1LC.to(pos_1LC_.dtype)
+
+    if separator:
+        num_sp_tokens = (len(patch_nums) - 1) * 2
+        weight = _trunc_normal((num_sp_tokens, embed_dim), init_std, seed + 1).mul_(0.02)
+        head_w, head_b = state_dict['head.weight'][:vocab_size], state_dict['head.bias'][:vocab_size]
+        state_dict['head.weight'] = torch.cat([head_w, weight.to(head_w.dtype)])
+        state_dict['head.bias'] = torch.cat([head_b, head_b.new_zeros(num_sp_tokens)])
+    return state_dict
+
+
+def converted_cache_path(path, cache_dir, **conversion):
+    stat = os.stat(path)
+    key = json.dumps({'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, **conversion},
+                     sort_keys=True)
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        import safetensors  # noqa: F401
+        ext = '.safetensors'
+    except ImportError:
+        ext = '.pth'
+    return os.path.join(cache_dir, f'{name}.controlvar-{hashlib.md5(key.encode()).hexdigest()[:12]}{ext}')
+
+
+def load_control_var_weights(path, patch_nums, embed_dim, vocab_size, separator=False, interpos=False, mpos=False,
+                             cache_dir=None):
+    """
+    VAR weights converted for ControlVAR. The first launch converts the checkpoint once (on rank 0 when a process
+    group is up) and caches the result; every other rank and later launch memory-maps the cached file.
+    """
+    conversion = dict(patch_nums=list(patch_nums), embed_dim=embed_dim, vocab_size=vocab_size, separator=separator,
+                      interpos=interpos, mpos=mpos)
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), 'converted')
+    cache_path = converted_cache_path(path, cache_dir, **conversion)
+    distributed = dist.is_available() and dist.is_initialized()
+    state_dict = None
+    if not os.path.exists(cache_path) and (not distributed or dist.get_rank() == 0):
+        state_dict = load_weights(path)
+        state_dict = var_to_control_var(state_dict.get('model_state_dict', state_dict), **conversion)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_weights(state_dict, cache_path)
+        except OSError as e:
+            print(f'cannot cache the converted weights at {cache_path}: {e}')
+    if distributed:  # every rank waits here, whether or not the cache existed
+        dist.barrier()
+    if state_dict is not None:
+        return state_dict
+    if os.path.exists(cache_path):
+        return load_weights(cache_path)
+    # rank 0 could not write the cache, convert locally
+    state_dict = load_weights(path)
+    return var_to_control_var(state_dict.get('model_state_dict', state_dict), **conversion)
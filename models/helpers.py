@@ -1,8 +1,74 @@
+import math
+from typing import Optional
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
 
 
+PHILOX_M0, PHILOX_M1 = 0xD2511F53, 0xCD9E8D57
+PHILOX_W0, PHILOX_W1 = 0x9E3779B9, 0xBB67AE85
+MASK32 = 0xFFFFFFFF
+
+
+def _mulhilo32(a, b: int):
+    """High and low 32 bits of a * b for uint32 values held in int64, split in 16-bit halves so nothing overflows."""
+    p = (a >> 16) * b
+    s = ((p & 0xFFFF) << 16) + (a & 0xFFFF) * b
+    return (p >> 16) + (s >> 32), s & MASK32
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1, rounds: int = 10):
+    """Philox4x32-10 (Salmon et al., 2011) on int64 tensors holding uint32 words; matches the Random123 test vectors."""
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo32(c0, PHILOX_M0)
+        hi1, lo1 = _mulhilo32(c2, PHILOX_M1)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0, k1 = (k0 + PHILOX_W0) & MASK32, (k1 + PHILOX_W1) & MASK32
+    return c0, c1, c2, c3
+
+
+class PhiloxRNG(object):
+    """
+    Counter-based random numbers with one stream per sample. Each value is Philox4x32-10 of the counter
+    (element, offset) under the key of its sample's 64-bit seed, so a sample's draws depend on its seed alone and
+    not on its position in the batch or the batch size. The offset advances once per draw call, i.e. once per scale
+    in the samplers; the element index runs over the token positions (and vocabulary) of that call.
+    """
+    def __init__(self, seeds, device=None):
+        seeds = torch.as_tensor(seeds, dtype=torch.int64, device=device).view(-1)
+        self.k0, self.k1 = seeds & MASK32, (seeds >> 32) & MASK32
+        self.offset = 0
+
+    def __len__(self):
+        return self.k0.shape[0]
+
+    def random_bits(self, shape) -> torch.Tensor:
+        """uint32 values (in int64) of the given shape, whose first dim is the batch."""
+        B, n = shape[0], math.prod(shape[1:])
+        assert B == len(self), f'{len(self)} seeds for a batch of {B}'
+        c0 = torch.arange((n + 3) // 4, dtype=torch.int64, device=self.k0.device).expand(B, -1)
+        c1 = torch.full_like(c0, self.offset & MASK32)
+        c2 = torch.full_like(c0, (self.offset >> 32) & MASK32)
+        c3 = torch.zeros_like(c0)
+        self.offset += 1
+        out = philox4x32(c0, c1, c2, c3, self.k0.view(B, 1), self.k1.view(B, 1))
+        return torch.stack(out, dim=-1).view(B, -1)[:, :n].reshape(shape)
+
+    def uniform(self, shape, dtype=torch.float32) -> torch.Tensor:
+        """Uniforms in the open interval (0, 1), 23 bits each so 1 stays out of reach in float32."""
+        return ((self.random_bits(shape) >> 9).to(dtype) + 0.5) * 2 ** -23
+
+    def multinomial(self, probs: torch.Tensor, num_samples: int = 1, replacement: bool = True) -> torch.Tensor:
+        """Like torch.multinomial over the last dim of probs (B, ..., V), with one stream per row of dim 0."""
+        if replacement:  # inverse cdf
+            cdf = probs.float().cumsum(dim=-1)
+            u = self.uniform((*probs.shape[:-1], num_samples)) * cdf[..., -1:]
+            return torch.searchsorted(cdf, u.contiguous(), right=True).clamp_(max=probs.shape[-1] - 1)
+        gumbels = -(-self.uniform(probs.shape).log()).log()  # gumbel top-k
+        return (probs.float().log() - gumbels).topk(num_samples, dim=-1)[1]
+
+
 def sample_with_top_k_top_p_(logits_BlV: torch.Tensor, top_k: int = 0, top_p: float = 0.0, rng=None, num_samples=1) -> torch.Tensor:  # return idx, shaped (B, l)
     B, l, V = logits_BlV.shape
     if top_k > 0:
@@ -16,14 +82,19 @@ def sample_with_top_k_top_p_(logits_BlV: torch.Tensor, top_k: int = 0, top_p: fl
     # sample (have to squeeze cuz torch.multinomial can only be used for 2D tensor)
     replacement = num_samples >= 0
     num_samples = abs(num_samples)
+    if isinstance(rng, PhiloxRNG):  # one stream per sample, so a sample does not depend on the rest of the batch
+        return rng.multinomial(logits_BlV.softmax(dim=-1), num_samples=num_samples, replacement=replacement)
     return torch.multinomial(logits_BlV.softmax(dim=-1).view(-1, V), num_samples=num_samples, replacement=replacement, generator=rng).view(B, l, num_samples)
 
 
-def gumbel_softmax_with_rng(logits: torch.Tensor, tau: float = 1, hard: bool = False, eps: float = 1e-10, dim: int = -1, rng: torch.Generator = None) -> torch.Tensor:
+def gumbel_softmax_with_rng(logits: torch.Tensor, tau: float = 1, hard: bool = False, eps: float = 1e-10, dim: int = -1, rng=None) -> torch.Tensor:
     if rng is None:
         return F.gumbel_softmax(logits=logits, tau=tau, hard=hard, eps=eps, dim=dim)
     
-    gumbels = (-torch.empty_like(logits, memory_format=torch.legacy_contiguous_format).exponential_(generator=rng).log())
+    if isinstance(rng, PhiloxRNG):  # one stream per sample along dim 0
+        gumbels = (-(-rng.uniform(logits.shape).log()).log()).to(logits.dtype)   # drawn in fp32, the 23-bit ints overflow fp16
+    else:
+        gumbels = (-torch.empty_like(logits, memory_format=torch.legacy_contiguous_format).exponential_(generator=rng).log())
     gumbels = (logits + gumbels) / tau
     y_soft = gumbels.softmax(dim)
     
@@ -36,6 +107,61 @@ def gumbel_softmax_with_rng(logits: torch.Tensor, tau: float = 1, hard: bool = F
     return ret
 
 
+class _LinearCrossEntropy(torch.autograd.Function):
+    """
+    sum_i w_i * CE(h_i @ W^T + b, t_i) evaluated chunk by chunk. The gradients are computed in the same pass, so
+    only one (chunk, V) block of logits is alive at a time and nothing of that size is kept for the backward.
+    """
+    @staticmethod
+    def forward(ctx, h_NC, weight, bias, target_N, weight_N, chunk_size):
+        needs_grad = any(ctx.needs_input_grad[:3])
+        grad_h = torch.empty_like(h_NC) if ctx.needs_input_grad[0] else None
+        grad_w = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if ctx.needs_input_grad[1] else None
+        grad_b = torch.zeros(bias.shape, dtype=torch.float32, device=bias.device) if bias is not None and ctx.needs_input_grad[2] else None
+        loss = torch.zeros((), dtype=torch.float32, device=h_NC.device)
+        for s in range(0, h_NC.shape[0], chunk_size):
+            h, t, w = h_NC[s:s + chunk_size], target_N[s:s + chunk_size], weight_N[s:s + chunk_size].float()
+            logits = F.linear(h, weight, bias).float()  # same precision as the head in get_logits
+            lse = logits.logsumexp(dim=-1)
+            loss += ((lse - logits.gather(1, t[:, None])[:, 0]) * w).sum()
+            if not needs_grad:
+                continue
+            # dCE/dlogits = softmax - onehot, scaled by the token weight; the logits buffer is reused for it
+            g = logits.sub_(lse[:, None]).exp_()
+            g[torch.arange(t.shape[0], device=t.device), t] -= 1
+            g.mul_(w[:, None])
+            if grad_h is not None:
+                grad_h[s:s + chunk_size] = torch.matmul(g, weight).to(grad_h.dtype)
+            if grad_w is not None:
+                grad_w += torch.matmul(g.t(), h).float()
+            if grad_b is not None:
+                grad_b += g.sum(0)
+        ctx.save_for_backward(grad_h, grad_w, grad_b)
+        ctx.dtypes = weight.dtype, bias.dtype if bias is not None else None
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_h, grad_w, grad_b = ctx.saved_tensors
+        w_dtype, b_dtype = ctx.dtypes
+        grad_h = grad_h * grad_loss.to(grad_h.dtype) if grad_h is not None else None
+        grad_w = (grad_w * grad_loss).to(w_dtype) if grad_w is not None else None
+        grad_b = (grad_b * grad_loss).to(b_dtype) if grad_b is not None else None
+        return grad_h, grad_w, grad_b, None, None, None
+
+
+def linear_cross_entropy(h_NC: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor], target_N: torch.Tensor,
+                         weight_N: Optional[torch.Tensor] = None, chunk_size: int = 8192) -> torch.Tensor:
+    """
+    Weighted sum of the token cross-entropies of a linear head, i.e.
+    (F.cross_entropy(F.linear(h, weight, bias).float(), target, reduction='none') * weight_N).sum(),
+    without materializing the (N, V) logits or keeping them for the backward.
+    """
+    if weight_N is None:
+        weight_N = h_NC.new_ones(h_NC.shape[0], dtype=torch.float32)
+    return _LinearCrossEntropy.apply(h_NC, weight, bias, target_N, weight_N, chunk_size)
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False, scale_by_keep: bool = True):    # taken from timm
     if drop_prob == 0. or not training: return x
     keep_prob = 1 - drop_prob
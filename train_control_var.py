@@ -1,9 +1,13 @@
+from time import perf_counter
+STARTUP_T0 = perf_counter()  # taken before the imports, see --profile_startup
+
 import os
 import argparse
 import logging
 import math
 import random
 from collections import OrderedDict
+from functools import partial
 import numpy as np
 from itertools import chain
 from time import time
@@ -14,7 +18,7 @@ from PIL import Image
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset
 from torchvision.utils import make_grid
 
 from transformers import get_scheduler
@@ -22,14 +26,21 @@ from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import set_seed
 
-from datasets import create_dataset
-from models import VQVAE, VisualProgressAutoreg, VAR, build_var, ControlVAR, build_control_var
+from datasets import create_dataset, create_sampler
+from datasets.transforms_image import BatchRandomCropFlip, build_ignore_masks, collate_uint8, unpack_uint8_batch
+from models import VQVAE, build_control_var
+from models.act_ckpt import apply_activation_checkpointing
+from models.convert import load_control_var_weights
 from utils.wandb import CustomWandbTracker
+from utils.misc import DeviceMeter
+from utils.preview import PreviewWorker
+from utils.checkpoint import AsyncCheckpointer, load_weights
+from utils.startup import StartupProfiler
 from ruamel.yaml import YAML
 
-from peft import LoraConfig, get_peft_model, TaskType, prepare_model_for_kbit_training
-
 logger = get_logger(__name__)
+startup = StartupProfiler(start=STARTUP_T0)
+startup.mark('imports')
 
 
 def parse_args():
@@ -45,6 +56,9 @@ def parse_args():
     parser.add_argument("--image_size", type=int, default=256, help="image size")
     parser.add_argument("--batch_size", type=int, default=8, help="per gpu batch size")
     parser.add_argument("--num_workers", type=int, default=16, help="batch size")
+    parser.add_argument("--gpu_aug", type=bool, default=False, help="crop/flip/normalize batches on the device instead of in the workers")
+    parser.add_argument("--cond_weights", nargs=4, type=float, default=[0.25, 0.25, 0.25, 0.25], help='sampling weights of mask, canny, depth, normal conditions')
+    parser.add_argument("--uint8_batch", type=bool, default=False, help="load uint8 batches and normalize them on the device")
 
     # training
     parser.add_argument("--debug", type=bool, default=False)
@@ -57,7 +71,10 @@ def parse_args():
     parser.add_argument("--lr_scheduler", type=str, default='lin0', help='lr scheduler')
     parser.add_argument("--log_interval", type=int, default=500, help='log interval for steps')
     parser.add_argument("--val_interval", type=int, default=1, help='validation interval for epochs')
+    parser.add_argument("--preview_interval", type=int, default=None, help='preview interval for steps, defaults to log_interval')
+    parser.add_argument("--preview_device", type=str, default=None, help='device of the preview model copy, defaults to the training device')
     parser.add_argument("--save_interval", type=str, default='10000', help='save interval')
+    parser.add_argument("--keep_checkpoints", type=int, default=3, help='number of most recent checkpoints kept')
     parser.add_argument("--mixed_precision", type=str, default='bf16', help='mixed precision', choices=['no', 'fp16', 'bf16', 'fp8'])
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help='gradient accumulation steps')
     parser.add_argument("--lora", type=bool, default=False, help='use lora to train linear layers only')
@@ -73,6 +90,10 @@ def parse_args():
     parser.add_argument("--ch", type=int, default=160, help="channel size of vqvae")
     parser.add_argument("--vqvae_pretrained_path", type=str, default='pretrained/vae_ch160v4096z32.pth', help="vqvae pretrained path")
     parser.add_argument("--var_pretrained_path", type=str, default='pretrained/var_d16.pth', help="var pretrained path")
+    parser.add_argument("--block_sparse_attn", action='store_true', help="skip the fully masked blocks of the scale-causal attention mask instead of passing a dense bias")
+    parser.add_argument("--act_ckpt", type=str, default='none', help="activation checkpointing of the var blocks: none, all, attn (attention only), every:N or budget:GiB (per device)")
+    parser.add_argument("--fused_ce_chunk", type=int, default=0, help='tokens per chunk of the fused head + cross-entropy, 0 materializes the full logits')
+    parser.add_argument("--weight_cache_dir", type=str, default=None, help="cache of the converted var weights, defaults to <var_pretrained_path dir>/converted")
     # vpq model
     parser.add_argument("--v_patch_nums", type=int, default=[1, 2, 3, 4, 5, 6, 8, 10, 13, 16], help="number of patch numbers of each scale")
     parser.add_argument("--v_patch_layers", type=int, default=[1, 2, 3, 4, 5, 6, 8, 10, 13, 16], help="index of layers for predicting each scale")
@@ -99,6 +120,7 @@ def parse_args():
     parser.add_argument("--cond_drop_rate", type=float, default=0.1, help="drop rate of condition model")
 
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--profile_startup", "--profile-startup", action='store_true', help="report the time of every startup phase")
 
     # fFirst parse of command-line args to check for config file
     args = parser.parse_args()
@@ -113,22 +135,36 @@ def parse_args():
 
     # re-parse command-line args to overwrite with any command-line inputs
     args = parser.parse_args()
+    args.uint8_batch = args.uint8_batch or args.gpu_aug  # gpu_aug works on uint8 batches
+    args.preview_interval = args.preview_interval or args.log_interval
 
     return args
 
 
 
-def train_epoch(accelerator, var, vqvae, cond_model, dataloader, optimizer, lr_scheduler, progress_bar, args):
+def train_epoch(accelerator, var, vqvae, cond_model, dataloader, optimizer, lr_scheduler, progress_bar, args,
+                previewer=None, checkpointer=None):
 
     var.train()
     if cond_model is not None:
         cond_model.train()
     loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
+    gpu_aug = BatchRandomCropFlip(args.image_size) if args.gpu_aug else None
+    meter = DeviceMeter()
 
+    if isinstance(dataloader.dataset, IterableDataset):
+        dataloader.dataset.set_epoch(args.epoch)
     for batch_idx, batch in enumerate(dataloader):
+        batch = {k: v.to(accelerator.device, non_blocking=True) if torch.is_tensor(v) else v for k, v in batch.items()}
 
         with accelerator.accumulate(var):
-            images, masks, conditions, cond_type = batch['image'], batch['mask'], batch['cls'], batch['type']
+            conditions, cond_type = batch['cls'], batch['type']
+            if args.uint8_batch:
+                images, masks = unpack_uint8_batch(batch, augment=gpu_aug)
+                batch['ignore_mask'], batch['ignore_mask_'] = build_ignore_masks(masks, args.v_patch_nums, args.separator,
+                                                                                 is_mask=cond_type == 0)
+            else:
+                images, masks = batch['image'], batch['mask']
 
             # forward to get input ids
             with torch.no_grad():
@@ -168,69 +204,80 @@ def train_epoch(accelerator, var, vqvae, cond_model, dataloader, optimizer, lr_s
                     raise NotImplementedError
             x_BLCv_wo_first_l = torch.concat(input_h_list, dim=1)
 
-            # forwad through model
-            logits = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type)  # BLC, C=vocab size
-            logits = logits.view(-1, logits.size(-1))
             labels = torch.cat(labels_list, dim=1)
             labels = labels.view(-1)
-
-            loss = loss_fn(logits, labels)
-
-            print("loss", loss.item())
-
             ignore_mask = batch['ignore_mask'] if mask_first else batch['ignore_mask_']
             ignore_mask = ignore_mask.view(-1)
-            loss = (loss * ignore_mask.float()).mean() / (ignore_mask.mean() + 1e-6)
+
+            # forwad through model
+            if args.fused_ce_chunk > 0:  # sum of the token losses, the logits are never materialized
+                loss = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type, target_BL=labels,
+                           weight_BL=ignore_mask, loss_chunk=args.fused_ce_chunk) / labels.numel()
+            else:
+                logits = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type)  # BLC, C=vocab size
+                logits = logits.view(-1, logits.size(-1))
+                loss = (loss_fn(logits, labels) * ignore_mask.float()).mean()
+            loss = loss / (ignore_mask.mean() + 1e-6)
             accelerator.backward(loss)
             optimizer.step()
             lr_scheduler.step()
             optimizer.zero_grad()
-
+            meter.update(loss=loss)
 
         # Checks if the accelerator has performed an optimization step behind the scenes
         if accelerator.sync_gradients:
             progress_bar.update(1)
             args.completed_steps += 1
 
-        # Log metrics
-        if args.completed_steps % args.log_interval == 0:
+        # Log metrics, the running loss is read back (and all-reduced) only here
+        if accelerator.sync_gradients and args.completed_steps % args.log_interval == 0:
+            train_metrics = meter.compute()
+            progress_bar.set_description(f"train/loss: {train_metrics['loss']:.4f}")
             accelerator.log(
                 {
-                    "train/loss": loss.item(),
+                    "train/loss": train_metrics['loss'],
                     "step": args.completed_steps,
                     "epoch": args.epoch,
                     "lr": optimizer.param_groups[0]["lr"]
                 },
                 step=args.completed_steps)
 
-        # Save model
+        # Save model, every process writes its shard of the checkpoint
         if isinstance(args.save_interval, int):
-            if args.completed_steps % args.save_interval == 0:
-                save_dir = os.path.join(args.project_dir, f"step_{args.completed_steps}")
-                os.makedirs(save_dir, exist_ok=True)
-                accelerator.save_state(save_dir)
+            if accelerator.sync_gradients and args.completed_steps % args.save_interval == 0:
+                save_checkpoint(accelerator, var, cond_model, optimizer, lr_scheduler, checkpointer, args)
 
-        # TODO remove
-        if args.completed_steps % 100 == 0:
-            inference(accelerator, var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(),
-                      num_samples=1, guidance_scale=4.0, top_k=900, top_p=0.95, seed=42)
+        # previews render on a copy of the weights in the background, skipped while the last one is running
+        if previewer is not None and accelerator.sync_gradients and args.completed_steps % args.preview_interval == 0:
+            previewer.snapshot(args.completed_steps)
 
 
 @torch.no_grad()
-def inference(accelerator, var, vqvae, cond_model, conditions,
-              num_samples=1, guidance_scale=4.0, top_k=900, top_p=0.95, seed=42):
-
-    var.eval()
-    cond_model.eval()
-    images = var.autoregressive_infer_cfg(B=len(conditions), label_B=torch.tensor(conditions, device=torch.device('cuda')),
-                                          cfg=4, top_k=top_k, top_p=top_p, g_seed=seed)
+def preview(var, step, accelerator, num_classes, guidance_scale=4.0, top_k=900, top_p=0.95, seed=42):
+    """Runs on the PreviewWorker thread with its eval copy of the model."""
+    conditions = np.random.choice(num_classes, 4).tolist()
+    images = var.autoregressive_infer_cfg(B=len(conditions),
+                                          label_B=torch.tensor(conditions, device=next(var.parameters()).device),
+                                          cfg=guidance_scale, top_k=top_k, top_p=top_p, g_seed=seed)
     image = make_grid(images, nrow=len(conditions), padding=0, pad_value=1.0)
     image = image.permute(1, 2, 0).mul_(255).cpu().numpy()
     image = Image.fromarray(image.astype(np.uint8))
 
-    accelerator.log({"images": [wandb.Image(image, caption=f"{conditions}")]})
-    var.train()
-    cond_model.train()
+    # logged against its own step key, the training loop has moved on by the time the preview is ready
+    accelerator.log({"images": [wandb.Image(image, caption=f"{conditions}")], "preview_step": step})
+
+
+def save_checkpoint(accelerator, var, cond_model, optimizer, lr_scheduler, checkpointer, args):
+    checkpoint = {
+        'model_state_dict': accelerator.unwrap_model(var).state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'lr_scheduler_state_dict': lr_scheduler.state_dict(),
+        'epoch': args.epoch,
+        'step': args.completed_steps,
+    }
+    if cond_model is not None:
+        checkpoint['cond_model_state_dict'] = accelerator.unwrap_model(cond_model).state_dict()
+    checkpointer.save(args.completed_steps, checkpoint)
 
 
 def validate():
@@ -240,6 +287,8 @@ def validate():
 def main():
 
     args = parse_args()
+    startup.enabled = args.profile_startup
+    startup.mark('parse args')
 
     # seed
     set_seed(args.seed)
@@ -271,16 +320,22 @@ def main():
         level=logging.INFO,
     )
     logger.info(accelerator.state, main_process_only=False)
+    startup.mark('accelerator')
 
 
     # create dataset
     logger.info("Creating dataset")
     dataset = create_dataset(args.dataset_name, args)
     # create dataloader
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+    streaming = isinstance(dataset, IterableDataset)
+    sampler = create_sampler(dataset, args)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler,
+                            shuffle=None if streaming or sampler is not None else True, num_workers=args.num_workers, pin_memory=True, drop_last=True,
+                            collate_fn=collate_uint8 if args.uint8_batch else None)
     # Calculate total batch size
     total_batch_size = args.batch_size * accelerator.num_processes * args.gradient_accumulation_steps
     args.total_batch_size = total_batch_size
+    startup.mark('dataset')
 
     # Create VQVAE Model
     logger.info("Creating VQVAE model")
@@ -290,51 +345,33 @@ def main():
         p.requires_grad_(False)
     if args.vqvae_pretrained_path is not None:
         vqvae.load_state_dict(torch.load(args.vqvae_pretrained_path, map_location=torch.device('cpu')))
+    startup.mark('vqvae')
 
     # Create VPA Model
     logger.info("Creating VAR model")
 
     var = build_control_var(vae=vqvae, depth=args.depth, patch_nums=args.v_patch_nums, mask_type=args.mask_type,
                          cond_drop_rate=1.1 if args.uncond else 0.1, bidirectional=args.bidirectional,
-                         separate_decoding=args.separate_decoding, separator=args.separator,)
+                         separate_decoding=args.separate_decoding, separator=args.separator,
+                         block_sparse=args.block_sparse_attn)
 
     if args.var_pretrained_path is not None:
-        var_state_dict = torch.load(args.var_pretrained_path, map_location=torch.device('cpu'))
-        init_std = math.sqrt(1 / args.embed_dim / 3)
         if args.mask_type == 'interleave_append':
-            for key in ['lvl_1L', 'pos_start', 'attn_bias_for_masking']:
-                del var_state_dict[key]  # will be handled in the init
-            for key in ['pos_1LC', ]:
-                pos_1LC_ = var_state_dict[key]
-                if args.separator:
-                    pos_1LC = []
-                    L = 0
-                    for i, pn in enumerate(args.v_patch_nums):
-                        num_sp_tokens = 1 if i != 0 else 0
-                        pe = torch.empty((pn * pn + num_sp_tokens) * 2, args.embed_dim)
-                        nn.init.trunc_normal_(pe, mean=0, std=init_std)
-                        pe[:pn*pn] = pos_1LC_[:, L:L+pn*pn]
-                        pe[pn*pn+num_sp_tokens:pn*pn*2+num_sp_tokens] = pos_1LC_[:, L:L+pn*pn]
-                        pos_1LC.append(pe)
-                        L += pn*pn
-                    pos_1LC = torch.cat(pos_1LC, dim=0).unsqueeze(0)  # 1, L, C
-                    var_state_dict[key] = pos_1LC
-                else:
-                    var_state_dict[key] = torch.concat([var_state_dict[key], var_state_dict[key]], dim=1)
-            # key = 'lvl_embed.weight'
-            # var_state_dict[key] = torch.concat([var_state_dict[key], var_state_dict[key]], dim=0)
-            if args.separator:
-                weight = torch.empty(args.vocab_size + (len(args.v_patch_nums) - 1) * 2, args.embed_dim)
-                bias = torch.empty(args.vocab_size + (len(args.v_patch_nums) - 1) * 2)
-                nn.init.trunc_normal_(weight, mean=0, std=init_std)
-                nn.init.trunc_normal_(bias, mean=0, std=init_std)
-                weight[:args.vocab_size] = var_state_dict['head.weight']
-                bias[:args.vocab_size] = var_state_dict['head.bias']
-                var_state_dict['head.weight'] = weight
-                var_state_dict['head.bias'] = bias
+            # converted once for pos_1LC and the separator head, then memory-mapped from the cache by every process
+            var_state_dict = load_control_var_weights(args.var_pretrained_path, args.v_patch_nums, args.embed_dim,
+                                                      args.vocab_size, separator=args.separator,
+                                                      cache_dir=args.weight_cache_dir)
+        else:
+            var_state_dict = load_weights(args.var_pretrained_path)
         # var.load_state_dict(var_state_dict, strict=False)
 
+    act_ckpt = apply_activation_checkpointing(var.blocks, args.act_ckpt, batch_size=args.batch_size, seq_len=var.L,
+                                              dtype_bytes=4 if args.mixed_precision == 'no' else 2)
+    print(f'activation checkpointing {args.act_ckpt}: {sum(m == "block" for m in act_ckpt)} blocks, '
+          f'{sum(m == "attn" for m in act_ckpt)} attentions of {len(act_ckpt)}')
+
     if args.lora:
+        from peft import LoraConfig, get_peft_model
         lora_params = []
         for name, _ in var.named_modules():
             if ('attn.' in name and 'attn.proj_drop' not in name) or 'ffn.fc' in name or 'ada_lin.1' in name:
@@ -353,6 +390,7 @@ def main():
         var.print_trainable_parameters()
 
     var.train()
+    startup.mark('var')
 
     # Create Condition Model
     logger.info("Creating conditional model")
@@ -386,11 +424,16 @@ def main():
     )
 
     # Send to accelerator
-    var, cond_model, vqvae, optimizer, lr_scheduler, dataloader = accelerator.prepare(var, cond_model, vqvae, optimizer, lr_scheduler, dataloader)
+    if streaming:
+        # the stream is already split per rank; accelerate would dispatch or re-shard it
+        var, cond_model, vqvae, optimizer, lr_scheduler = accelerator.prepare(var, cond_model, vqvae, optimizer, lr_scheduler)
+    else:
+        var, cond_model, vqvae, optimizer, lr_scheduler, dataloader = accelerator.prepare(var, cond_model, vqvae, optimizer, lr_scheduler, dataloader)
 
     # Start tracker
     experiment_config = vars(args)
     accelerator.init_trackers(model_name, config=experiment_config)
+    startup.mark('optimizer, prepare, trackers')
 
     # Start training
     if accelerator.is_main_process:
@@ -409,29 +452,42 @@ def main():
     args.starting_epoch = 0
 
     # TODO: add resume function
-    inference(accelerator, var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(), num_samples=1,
-              guidance_scale=4.0, top_k=900, top_p=0.95, seed=42)
+    checkpointer = AsyncCheckpointer(os.path.join(args.project_dir, 'checkpoints'), accelerator.process_index,
+                                     accelerator.num_processes, keep_last=args.keep_checkpoints)
+    previewer = None
+    if accelerator.is_main_process:
+        previewer = PreviewWorker(accelerator.unwrap_model(var),
+                                  partial(preview, accelerator=accelerator, num_classes=args.num_classes,
+                                          guidance_scale=4.0, top_k=900, top_p=0.95, seed=42),
+                                  device=args.preview_device, shared=(accelerator.unwrap_model(vqvae),))
+        previewer.snapshot(args.completed_steps)
+    startup.mark('checkpointer, preview')
+    if accelerator.is_main_process:
+        startup.report(logger.info)
     # Training
     for epoch in range(args.starting_epoch, args.num_epochs):
 
         args.epoch = epoch
+        if hasattr(dataloader, 'set_epoch'):  # accelerate forwards the epoch to the sampler
+            dataloader.set_epoch(epoch)
         if accelerator.is_main_process:
             logger.info(f"Epoch {epoch+1}/{args.num_epochs}")
 
         # train epoch
-        train_epoch(accelerator, var, vqvae, cond_model, dataloader, optimizer, lr_scheduler, progress_bar, args)
+        train_epoch(accelerator, var, vqvae, cond_model, dataloader, optimizer, lr_scheduler, progress_bar, args,
+                    previewer, checkpointer)
 
-        if epoch % args.val_interval == 0:
-            inference(accelerator, var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(), num_samples=1,
-                      guidance_scale=4.0, top_k=900, top_p=0.95, seed=42)
+        if epoch % args.val_interval == 0 and previewer is not None:
+            previewer.snapshot(args.completed_steps)
 
         
         if args.save_interval  == 'epoch':
-            save_dir = os.path.join(args.project_dir, f"epoch_{args.epoch}")
-            os.makedirs(save_dir, exist_ok=True)
-            accelerator.save_state(save_dir)
+            save_checkpoint(accelerator, var, cond_model, optimizer, lr_scheduler, checkpointer, args)
     
     # end training
+    if previewer is not None:
+        previewer.close()
+    checkpointer.close()
     accelerator.end_training()
 
     
@@ -1,3 +1,6 @@
+from time import perf_counter
+STARTUP_T0 = perf_counter()  # taken before the imports, see --profile_startup
+
 import os
 import argparse
 import math
@@ -11,6 +14,7 @@ from tqdm.auto import tqdm
 import wandb
 from PIL import Image
 from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.nn as nn
@@ -19,21 +23,30 @@ from torchvision.utils import make_grid
 
 import torch.distributed as dist
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
 import wandb
-from transformers import get_scheduler
 
-from datasets import create_dataset
-from models import VQVAE, VisualProgressAutoreg, VAR, build_var, ControlVAR, build_control_var
+from datasets import create_dataset, create_sampler, data_state_dict, set_data_position
+from datasets.transforms_image import BatchRandomCropFlip, build_ignore_masks, collate_uint8, unpack_uint8_batch
+from models import VQVAE, build_control_var
+from models.act_ckpt import apply_activation_checkpointing
+from models.convert import load_control_var_weights
 from ruamel.yaml import YAML
 from utils import seed_everything, filter_params, lr_wd_annealing
+from utils.misc import DeviceMeter, class_sample_batches
+from utils.export import ImageExporter, to_uint8_images
+from utils.fid import InceptionMetrics, build_feature_extractor
+from utils.preview import PreviewWorker
+from utils.checkpoint import AsyncCheckpointer, load_checkpoint, load_weights
+from utils.startup import StartupProfiler
+import dist as dist_utils
 
 import habana_frameworks.torch.core as htcore
 import habana_frameworks.torch.distributed.hccl
-from peft import LoraConfig, get_peft_model, TaskType, prepare_model_for_kbit_training, tuners
 
 device = torch.device('hpu')
+startup = StartupProfiler(start=STARTUP_T0)
+startup.mark('imports')
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -48,6 +61,8 @@ def parse_args():
     parser.add_argument("--image_size", type=int, default=256, help="image size")
     parser.add_argument("--batch_size", type=int, default=8, help="per gpu batch size")
     parser.add_argument("--num_workers", type=int, default=16, help="batch size")
+    parser.add_argument("--gpu_aug", type=bool, default=False, help="crop/flip/normalize batches on the device instead of in the workers")
+    parser.add_argument("--uint8_batch", type=bool, default=False, help="load uint8 batches and normalize them on the device")
 
     # training
     parser.add_argument("--debug", type=bool, default=False)
@@ -60,7 +75,10 @@ def parse_args():
     parser.add_argument("--lr_scheduler", type=str, default='lin0', help='lr scheduler')
     parser.add_argument("--log_interval", type=int, default=500, help='log interval for steps')
     parser.add_argument("--val_interval", type=int, default=1, help='validation interval for epochs')
+    parser.add_argument("--preview_interval", type=int, default=None, help='preview interval for steps, defaults to log_interval')
+    parser.add_argument("--preview_device", type=str, default='cpu', help='device of the preview model copy; cpu keeps the preview thread off the lazy-mode hpu graph')
     parser.add_argument("--save_interval", type=str, default='3000', help='save interval')
+    parser.add_argument("--keep_checkpoints", type=int, default=3, help='number of most recent checkpoints kept')
     parser.add_argument("--mixed_precision", type=str, default='bf16', help='mixed precision', choices=['no', 'fp16', 'bf16', 'fp8'])
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help='gradient accumulation steps')
     parser.add_argument("--lora", type=bool, default=False, help='use lora to train linear layers only')
@@ -71,19 +89,30 @@ def parse_args():
     parser.add_argument("--weight_decay_end", type=float, default=0, help='final lr ratio at the end of training')
     parser.add_argument("--resume", type=str, default=False, help='resume')
     parser.add_argument("--ignore_mask", type=bool, default=False, help='ignore_mask')
+    parser.add_argument("--block_sparse_attn", action='store_true', help="skip the fully masked blocks of the scale-causal attention mask instead of passing a dense bias")
+    parser.add_argument("--act_ckpt", type=str, default='none', help="activation checkpointing of the var blocks: none, all, attn (attention only), every:N or budget:GiB (per device)")
+    parser.add_argument("--fused_ce_chunk", type=int, default=0, help='tokens per chunk of the fused head + cross-entropy, 0 materializes the full logits')
     parser.add_argument("--val_only", type=bool, default=False, help='validation only')
     parser.add_argument("--c_mask", type=bool, default=False, help='teaching force mask in validation')
     parser.add_argument("--c_img", type=bool, default=False, help='teaching force img in validation')
     parser.add_argument("--cfg", nargs='+', type=float, default=[4, 4, 4], help='cfg guidance scale')
     parser.add_argument("--gibbs", type=int, default=0, help='use gibbs sampling during inference')
     parser.add_argument("--save_val", type=bool, default=False, help='save val images')
+    parser.add_argument("--val_samples_per_class", type=int, default=50, help='class-conditional val samples per class')
+    parser.add_argument("--val_format", type=str, default='png', choices=['png', 'jpg', 'webp'], help='file format of saved val images')
+    parser.add_argument("--fid", type=bool, default=False, help='compute FID/IS of the val samples in-process')
+    parser.add_argument("--fid_stats", type=str, default=None, help='reference statistics (.npz with mu, sigma) for FID')
+    parser.add_argument("--fid_extractor", type=str, default='inception', choices=['inception', 'tiny'], help='feature network for FID/IS, tiny is a CPU stand-in')
+    parser.add_argument("--export_workers", type=int, default=4, help='threads encoding saved val images')
     parser.add_argument("--val_cond", type=str, default='depth', help='val condition')
+    parser.add_argument("--cond_weights", nargs=4, type=float, default=[0.25, 0.25, 0.25, 0.25], help='sampling weights of mask, canny, depth, normal conditions')
     # vqvae
     parser.add_argument("--vocab_size", type=int, default=4096, nargs='+', help="codebook size")
     parser.add_argument("--z_channels", type=int, default=32, help="latent size of vqvae")
     parser.add_argument("--ch", type=int, default=160, help="channel size of vqvae")
     parser.add_argument("--vqvae_pretrained_path", type=str, default='pretrained/vae_ch160v4096z32.pth', help="vqvae pretrained path")
     parser.add_argument("--var_pretrained_path", type=str, default='pretrained/var_d16.pth', help="var pretrained path")
+    parser.add_argument("--weight_cache_dir", type=str, default=None, help="cache of the converted var weights, defaults to <var_pretrained_path dir>/converted")
     # vpq model
     parser.add_argument("--v_patch_nums", type=int, default=[1, 2, 3, 4, 5, 6, 8, 10, 13, 16], help="number of patch numbers of each scale")
     parser.add_argument("--v_patch_layers", type=int, default=[1, 2, 3, 4, 5, 6, 8, 10, 13, 16], help="index of layers for predicting each scale")
@@ -110,6 +139,7 @@ def parse_args():
     parser.add_argument("--cond_drop_rate", type=float, default=0.1, help="drop rate of condition model")
 
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--profile_startup", "--profile-startup", action='store_true', help="report the time of every startup phase")
 
     # fFirst parse of command-line args to check for config file
     args = parser.parse_args()
@@ -123,30 +153,34 @@ def parse_args():
 
     # re-parse command-line args to overwrite with any command-line inputs
     args = parser.parse_args()
+    args.uint8_batch = args.uint8_batch or args.gpu_aug  # gpu_aug works on uint8 batches
+    args.preview_interval = args.preview_interval or args.log_interval
 
     return args
 
 
-def train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, rank, args):
+def train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, rank, args, previewer=None,
+                checkpointer=None):
 
     var.train()
     if cond_model is not None:
         cond_model.train()
     loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
+    gpu_aug = BatchRandomCropFlip(args.image_size) if args.gpu_aug else None
 
-    train_loss = []
-    if args.completed_steps != args.epoch * args.num_update_steps_per_epoch:
-        print(f'skipping {args.completed_steps - args.epoch * args.num_update_steps_per_epoch} batches')
-        print(f'step:{args.completed_steps}, epoch: {args.epoch}, step_per_epoch: {args.num_update_steps_per_epoch}')
+    meter = DeviceMeter()
     for batch_idx, batch in enumerate(dataloader):
-        for _ in range(args.completed_steps - args.epoch * args.num_update_steps_per_epoch):
-            continue
-
-        images, masks, conditions, cond_type = batch['image'], batch['mask'], batch['cls'], batch['type']
-        images = images.to(device)
-        masks = masks.to(device)
+        conditions, cond_type = batch['cls'], batch['type']
         conditions = conditions.to(device)
         cond_type = cond_type.to(device)
+        if args.uint8_batch:
+            images, masks = unpack_uint8_batch(batch, device, augment=gpu_aug)
+            batch['ignore_mask'], batch['ignore_mask_'] = build_ignore_masks(masks, args.v_patch_nums, args.separator,
+                                                                             is_mask=cond_type == 0)
+        else:
+            images, masks = batch['image'], batch['mask']
+            images = images.to(device)
+            masks = masks.to(device)
 
         _ = lr_wd_annealing(args.lr_scheduler, optimizer, args.scaled_lr,
                                                              args.weight_decay, args.weight_decay_end,
@@ -203,14 +237,6 @@ def train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, ran
 
         x_BLCv_wo_first_l = torch.concat(input_h_list, dim=1)
 
-        # forwad through model
-        if args.mixed_precision == 'bf16':
-            with torch.autocast(device_type='hpu', dtype=torch.bfloat16):
-                logits = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type)  # BLC, C=vocab size
-        else:
-            logits = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type)  # BLC, C=vocab size
-        logits = logits.view(-1, logits.size(-1))
-
         if args.separator:
             mapping = [i for i in range(18)] if mask_first else [i + 1 if i % 2 == 0 else i - 1 for i in range(18)]
             B = labels_list[0].shape[0]
@@ -227,16 +253,25 @@ def train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, ran
 
         labels = torch.cat(labels_list, dim=1)
         labels = labels.view(-1)
-        print(logits)
-        loss = loss_fn(logits, labels)
-
+        ignore_mask = None
         if args.ignore_mask:
             ignore_mask = batch['ignore_mask'] if mask_first else batch['ignore_mask_']
-            ignore_mask.to(device)
+            ignore_mask = ignore_mask.to(device)
             ignore_mask = ignore_mask.view(-1)
-            loss = (loss * ignore_mask.float()).mean() / (ignore_mask.mean() + 1e-6)
-        else:
-            loss = loss.mean()
+
+        # forwad through model
+        with torch.autocast(device_type='hpu', dtype=torch.bfloat16, enabled=args.mixed_precision == 'bf16'):
+            if args.fused_ce_chunk > 0:  # sum of the token losses, the logits are never materialized
+                loss = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type,
+                           target_BL=labels, weight_BL=ignore_mask, loss_chunk=args.fused_ce_chunk) / labels.numel()
+            else:
+                logits = var(conditions, x_BLCv_wo_first_l, mask_first=mask_first, cond_type=cond_type)  # BLC, C=vocab size
+                logits = logits.view(-1, logits.size(-1))
+                loss = loss_fn(logits, labels)
+                loss = (loss * ignore_mask.float()).mean() if ignore_mask is not None else loss.mean()
+
+        if ignore_mask is not None:
+            loss = loss / (ignore_mask.mean() + 1e-6)
 
         loss.backward()
         htcore.mark_step()
@@ -248,54 +283,54 @@ def train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, ran
         htcore.mark_step()
         if batch_idx % args.gradient_accumulation_steps == 0:
             optimizer.zero_grad()
-            progress_bar.set_description(f"train/loss: {loss.item()}")
         args.completed_steps += 1
+        args.epoch_batches += 1
         progress_bar.update(1)
 
-        train_loss.append(loss.item())
+        meter.update(loss=loss)
+        # read back (and all-reduce) the running loss only when it is logged
+        if args.completed_steps % args.log_interval == 0:
+            train_metrics = meter.compute()
 
         if rank == 0:
             # Log metrics
             if args.completed_steps % args.log_interval == 0:
-                train_loss_mean = torch.tensor(sum(train_loss) / len(train_loss))  #.to(device)
-                # dist.all_reduce(train_loss_mean, op=dist.ReduceOp.SUM)
+                progress_bar.set_description(f"train/loss: {train_metrics['loss']:.4f}")
                 wandb.log(
                     {
-                        "train/loss": train_loss_mean.item(),
+                        "train/loss": train_metrics['loss'],
                         "step": args.completed_steps,
                         "epoch": args.epoch,
                         "lr": optimizer.param_groups[0]["lr"],
                         "weight_decay": optimizer.param_groups[0]["weight_decay"],
                     },
                     step=args.completed_steps)
-                inference(var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(), rank=rank,
-                          guidance_scale=4.0, top_k=900, top_p=0.95, seed=42)
+            # previews render on a copy of the weights in the background, skipped while the last one is running
+            if previewer is not None and args.completed_steps % args.preview_interval == 0:
+                previewer.snapshot(args.completed_steps)
 
-            # Save model
-            if isinstance(args.save_interval, int):
-                if args.completed_steps % args.save_interval == 0:
-                    save_dir = os.path.join(args.project_dir, f"step_{args.completed_steps}")
-                    os.makedirs(save_dir, exist_ok=True)
-                    save_checkpoint(var, optimizer, args, latest=True)
+        # Save model, every rank writes its shard of the checkpoint
+        if isinstance(args.save_interval, int):
+            if args.completed_steps % args.save_interval == 0:
+                save_checkpoint(var, optimizer, args, checkpointer,
+                                data_state=data_state_dict(dataloader, args.epoch, args.epoch_batches))
 
 
 @torch.no_grad()
-def inference(var, vqvae, cond_model, conditions, rank=0, guidance_scale=4.0, top_k=900, top_p=0.95, seed=42):
-    var.eval()
-    if cond_model:
-        cond_model.eval()
-    # conditions = [474, 474, 474, 474]
-    images = var.module.autoregressive_infer_cfg(B=len(conditions), label_B=torch.tensor(conditions, device=device),
+def preview(var, step, num_classes, guidance_scale=4.0, top_k=900, top_p=0.95, seed=42):
+    """Runs on the PreviewWorker thread with its eval copy of the model."""
+    conditions = np.random.choice(num_classes, 4).tolist()
+    model_device = next(var.parameters()).device
+    images = var.autoregressive_infer_cfg(B=len(conditions), label_B=torch.tensor(conditions, device=model_device),
                                           cfg=guidance_scale, top_k=top_k, top_p=top_p, g_seed=seed)
+    if model_device.type == 'hpu':
+        htcore.mark_step()
     image = make_grid(images, nrow=len(conditions), padding=0, pad_value=1.0)
     image = image.permute(1, 2, 0).mul_(255).cpu().numpy()
     image = Image.fromarray(image.astype(np.uint8))
 
-    wandb.log({f"images": [wandb.Image(image, caption=f"{conditions}")]})
-
-    var.train()
-    # if cond_model:
-    #     cond_model.train()
+    # logged against its own step key, the training loop has moved on by the time the preview is ready
+    wandb.log({"images": [wandb.Image(image, caption=f"{conditions}")], "preview_step": step})
 
 def pix_cond_inference(images, masks, conditions, cond_type, device, B, var, vqvae, c_mask, c_img,
                        guidance_scale, top_k, top_p, seed, args):
@@ -326,7 +361,10 @@ def pix_cond_inference(images, masks, conditions, cond_type, device, B, var, vqv
 
 def cls_cond_inference(cls, device, B, var, index, cond_type, guidance_scale, top_k, top_p, seed):
     types = {'mask': 0, 'canny': 1, 'depth': 2, 'normal': 3, 'none': 4}
-    conditions = torch.tensor([cls for _ in range(B)], device=device).long()
+    if isinstance(cls, int):
+        conditions = torch.tensor([cls for _ in range(B)], device=device).long()
+    else:
+        conditions = cls.to(device).long()  # one class per sample
     cond_type = torch.tensor([types[cond_type] for _ in range(B)], device=var.device).long()
     with torch.no_grad():
         images = var.module.autoregressive_infer_cfg(B=B, label_B=conditions,
@@ -340,6 +378,12 @@ def validate(var, vqvae, cond_model, dataloader, args, guidance_scale=(6, 6, 6),
     var.eval()
     if cond_model:
         cond_model.eval()
+    # generated images are encoded and written in the background while the next batch is sampled
+    exporter = ImageExporter(num_workers=args.export_workers) if save_val else None
+    # FID/IS from running feature moments, reduced across ranks at the end
+    metrics = InceptionMetrics(build_feature_extractor(args.fid_extractor, device), args.fid_stats, device) \
+        if args.fid else None
+    ext = args.val_format
     if c_mask or c_img:
         pbar = tqdm(range(math.ceil(len(dataloader))), disable=not rank == 0)
         save_path = os.path.join(args.project_dir, f'cfg_{guidance_scale[0]}_{guidance_scale[1]}_{guidance_scale[2]}_{args.val_cond}',
@@ -350,11 +394,11 @@ def validate(var, vqvae, cond_model, dataloader, args, guidance_scale=(6, 6, 6),
             B = masks.shape[0]
             images = pix_cond_inference(images, masks, conditions, cond_type, device, B, var, vqvae, c_mask, c_img,
                        guidance_scale, top_k, top_p, seed, args)
+            if metrics is not None:
+                metrics.update(images[:, :, 256:])
             if save_val:
-                images = images.permute(0, 2, 3, 1).mul_(255).cpu().numpy().astype(np.uint8)
-                for b in range(B):
-                    image = Image.fromarray(images[b, 256:])
-                    image.save(os.path.join(save_path, f'{batch_idx * B + b}.png'))
+                exporter.submit(to_uint8_images(images[:, :, 256:]),
+                                [os.path.join(save_path, f'{batch_idx * B + b}.{ext}') for b in range(B)])
             else:
                 image_ = make_grid(images, nrow=B, padding=0, pad_value=1.0)
                 image_ = image_.permute(1, 2, 0).mul_(255).cpu().numpy()
@@ -363,48 +407,57 @@ def validate(var, vqvae, cond_model, dataloader, args, guidance_scale=(6, 6, 6),
 
             pbar.update(1)
     else:
-        slices = 1000 // args.gpus
-        classes = [i for i in range(slices * rank, slices * (rank + 1))] if rank != args.gpus - 1 \
-            else [i for i in range(slices * rank, 1000)]
-        pbar = tqdm(range(len(classes)), disable=not rank == 0)
-        for cls in classes:
-            os.makedirs(os.path.join(args.project_dir, f'cfg_{guidance_scale[0]}', f'{cls}'), exist_ok=True)
-            assert 50 > args.batch_size
-            for i in range(50 // args.batch_size + 1):
-                B = args.batch_size if i != 50 // args.batch_size else 50 - i * args.batch_size
-                if B == 0: continue
-                cond_type = 'depth'
-                seed = seed + i * (cls + 1)
-                images = cls_cond_inference(cls, device, B, var, i, cond_type, guidance_scale, top_k, top_p, seed)
-                # image = make_grid(images, nrow=B, padding=0, pad_value=1.0)
-                if gibbs != 0:
-                    for g_step in range(gibbs):
-                        # start from mask teaching force
-                        masks, images = images[:, :, :256, :], images[:, :, 256:, :]
-                        masks, images = (masks - 0.5) / 0.5, (images - 0.5) / 0.5
-                        c_mask = True
-                        images = pix_cond_inference(images, masks, cls, cond_type, device, B, var, vqvae, c_mask,
-                                                    c_img, guidance_scale, top_k, top_p, seed, args)
-
-                        masks, images = images[:, :, :256, :], images[:, :, 256:, :]
-                        masks, images = (masks - 0.5) / 0.5, (images - 0.5) / 0.5
-                        c_img = True
-                        images = pix_cond_inference(images, masks, cls, cond_type, device, B, var, vqvae, c_mask,
-                                                    c_img, guidance_scale, top_k, top_p, seed, args)
-
-                if save_val:
-                    images = images.permute(0, 2, 3, 1).mul_(255).cpu().numpy().astype(np.uint8)
-                    for b in range(B):
-                        image = Image.fromarray(images[b, 256])
-                        image.save(os.path.join(args.project_dir, f'cfg_{guidance_scale[0]}', f'{cls}',
-                                                f'{i * args.batch_size + b}.png'))
-                else:
-                    image_ = make_grid(images, nrow=B, padding=0, pad_value=1.0)
-                    image_ = image_.permute(1, 2, 0).mul_(255).cpu().numpy()
-                    image_ = Image.fromarray(image_.astype(np.uint8))
-                    wandb.log({f"images": [wandb.Image(image_, caption=f"{cls}_{guidance_scale}")]})
+        # fixed-size batches of (class, sample) pairs, spread evenly over the ranks
+        batches = class_sample_batches(args.num_classes, args.val_samples_per_class, args.batch_size, args.gpus, rank, seed)
+        save_root = os.path.join(args.project_dir, f'cfg_{guidance_scale[0]}')
+        if save_val:
+            for cls in torch.cat([classes for classes, _, _, _ in batches]).unique().tolist():
+                os.makedirs(os.path.join(save_root, f'{cls}'), exist_ok=True)
+        pbar = tqdm(range(len(batches)), disable=not rank == 0)
+        for i, (classes, indices, seeds, valid) in enumerate(batches):
+            B = len(classes)
+            cond_type = 'depth'
+            # every sample draws from its own seed, so the result does not depend on how the pairs are batched
+            images = cls_cond_inference(classes, device, B, var, i, cond_type, guidance_scale, top_k, top_p, seeds)
+            # image = make_grid(images, nrow=B, padding=0, pad_value=1.0)
+            if gibbs != 0:
+                for g_step in range(gibbs):
+                    # start from mask teaching force
+                    masks, images = images[:, :, :256, :], images[:, :, 256:, :]
+                    masks, images = (masks - 0.5) / 0.5, (images - 0.5) / 0.5
+                    c_mask = True
+                    images = pix_cond_inference(images, masks, classes, cond_type, device, B, var, vqvae, c_mask,
+                                                c_img, guidance_scale, top_k, top_p, seeds, args)
+
+                    masks, images = images[:, :, :256, :], images[:, :, 256:, :]
+                    masks, images = (masks - 0.5) / 0.5, (images - 0.5) / 0.5
+                    c_img = True
+                    images = pix_cond_inference(images, masks, classes, cond_type, device, B, var, vqvae, c_mask,
+                                                c_img, guidance_scale, top_k, top_p, seeds, args)
+
+            # padding pairs of the last batch are generated but not kept
+            images = images[valid.to(images.device)]
+            classes, indices = classes[valid], indices[valid]
+            if metrics is not None:
+                metrics.update(images[:, :, 256:])
+            if save_val:
+                exporter.submit(to_uint8_images(images[:, :, 256:]),
+                                [os.path.join(save_root, f'{cls}', f'{index}.{ext}')
+                                 for cls, index in zip(classes.tolist(), indices.tolist())])
+            else:
+                image_ = make_grid(images, nrow=len(images), padding=0, pad_value=1.0)
+                image_ = image_.permute(1, 2, 0).mul_(255).cpu().numpy()
+                image_ = Image.fromarray(image_.astype(np.uint8))
+                wandb.log({f"images": [wandb.Image(image_, caption=f"{classes.tolist()}_{guidance_scale}")]})
             pbar.update(1)
 
+    if exporter is not None:
+        exporter.close()
+    if metrics is not None:
+        results = metrics.compute()
+        if rank == 0:
+            print(f'val metrics: {results}')
+            wandb.log({f'val/{k}': v for k, v in results.items()})
     var.train()
 
 
@@ -413,22 +466,25 @@ def setup(rank, world_size):
     os.environ['MASTER_PORT'] = '12346'
     # initialize the process group
     dist.init_process_group(backend='hccl', rank=rank, world_size=world_size)
+    dist_utils.attach(device)  # collectives in dist.py (e.g. the FID reduction) run on this group
 
 def cleanup():
     dist.destroy_process_group()
 
-def save_checkpoint(model, optimizer, args, save_dir='', latest=False):
+def save_checkpoint(model, optimizer, args, checkpointer, data_state=None):
+    """Called on every rank; returns once the state is copied to host memory, the files are written meanwhile."""
     checkpoint = {
         'model_state_dict': model.state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'epoch': args.epoch,
-        'step': args.completed_steps
+        'step': args.completed_steps,
+        'data_state': data_state,  # loader position, see datasets.data_state_dict
     }
-    step = 'latest' if latest else args.completed_steps
-    torch.save(checkpoint, os.path.join(save_dir, f'checkpoint_step_{step}.pth'))
+    checkpointer.save(args.completed_steps, checkpoint)
 
 def resume(var, optimizer, args):
-    state_dict = torch.load(args.resume, map_location=torch.device('cpu'))
+    # a checkpoint directory (its 'latest' step) or a single .pth file
+    state_dict = load_checkpoint(args.resume, map_location=torch.device('cpu'))
     if 'model_state_dict' in state_dict.keys():
         var_state_dict = state_dict['model_state_dict']
 
@@ -441,12 +497,25 @@ def resume(var, optimizer, args):
     args.completed_steps = state_dict['step']
     args.starting_epoch = state_dict['epoch']
 
-    if 'latest' not in args.resume:
+    data_state = state_dict.get('data_state')
+    if data_state is not None:
+        # continue at the first unseen batch, or with the next epoch when the saved one was complete
+        if data_state['batches_seen'] >= data_state['num_batches']:
+            args.starting_epoch += 1
+        else:
+            args.data_state = data_state
+    elif 'latest' not in args.resume:
         args.starting_epoch += 1
+    else:
+        # checkpoints without a loader state: the position follows from the step count
+        batches_seen = args.completed_steps - args.starting_epoch * args.num_update_steps_per_epoch
+        args.data_state = {'epoch': args.starting_epoch, 'seed': None, 'num_replicas': args.gpus,
+                           'batch_size': args.batch_size, 'samples_seen': batches_seen * args.batch_size * args.gpus}
 
     print(f'Resume from step: {args.completed_steps}, epoch: {args.starting_epoch}')
 
 def prepare_lora(var):
+    from peft import LoraConfig, get_peft_model
     print('Warning: The weights in attn.mat_kqv are currently not supported.')
     # TODO: attn.mat_kqv
     lora_params = []
@@ -470,71 +539,22 @@ def prepare_lora(var):
     var.print_trainable_parameters()
 
 def load_var_weight(var, args):
-    var_state_dict = torch.load(args.var_pretrained_path, map_location=torch.device('cpu'))
-    if 'model_state_dict' in var_state_dict.keys():
-        var_state_dict = var_state_dict['model_state_dict']
-    new_dict = OrderedDict()
-    for k, v in var_state_dict.items():
-        new_dict[k.replace('module.', '')] = v
-    var_state_dict = new_dict
-    init_std = math.sqrt(1 / args.embed_dim / 3)
     print('load model')
     if args.mask_type == 'interleave_append':
-        print('handle pos and attn bias')
-        for key in ['lvl_1L', 'pos_start', 'attn_bias_for_masking']:
-            del var_state_dict[key]  # will be handled in the init
-        print('handle pos_1LC')
-        for key in ['pos_1LC', ]:
-            pos_1LC_ = var_state_dict[key]
-            if args.interpos:
-                # pos_1LC = var_state_dict[key].permute(0, 2, 1)  # 1, C, L
-                # var_state_dict[key] = torch.nn.functional.interpolate(pos_1LC, size=1378).permute(0, 2, 1)
-                # var_state_dict[key] = torch.concat([var_state_dict[key], var_state_dict[key], var_state_dict[key][:,:18]], dim=1)
-                pos_1LC = []
-                L = 0
-                for i, pn in enumerate(args.v_patch_nums):
-                    pe = torch.empty((pn * pn) * 2, args.embed_dim)
-                    nn.init.trunc_normal_(pe, mean=0, std=init_std)
-                    pe[:pn * pn] = pos_1LC_[:, L:L + pn * pn]
-                    pe[pn * pn:pn * pn * 2] = pos_1LC_[:, L:L + pn * pn]
-                    pos_1LC.append(pe)
-                    L += pn * pn
-                pos_1LC = torch.cat(pos_1LC, dim=0).unsqueeze(0)  # 1, L, C
-                var_state_dict[key] = pos_1LC
-            else:
-                if args.separator:
-                    pos_1LC = []
-                    L = 0
-                    for i, pn in enumerate(args.v_patch_nums):
-                        num_sp_tokens = 1 if i != 0 else 0
-                        pe = torch.empty((pn * pn + num_sp_tokens) * 2, args.embed_dim)
-                        nn.init.trunc_normal_(pe, mean=0, std=init_std)
-                        pe[:pn * pn] = pos_1LC_[:, L:L + pn * pn]
-                        pe[pn * pn + num_sp_tokens:pn * pn * 2 + num_sp_tokens] = pos_1LC_[:,
-                                                                                  L:L + pn * pn] * -1 if args.mpos else 1
-                        pos_1LC.append(pe)
-                        L += pn * pn
-                    pos_1LC = torch.cat(pos_1LC, dim=0).unsqueeze(0)  # 1, L, C
-                    var_state_dict[key] = pos_1LC
-                else:
-
-                    var_state_dict[key] = torch.concat([var_state_dict[key], var_state_dict[key]], dim=1)
-
-        if args.separator:
-            weight = torch.empty(args.vocab_size + (len(args.v_patch_nums) - 1) * 2, args.embed_dim)
-            bias = torch.empty(args.vocab_size + (len(args.v_patch_nums) - 1) * 2)
-            nn.init.trunc_normal_(weight, mean=0, std=init_std)
-            nn.init.trunc_normal_(bias, mean=0, std=init_std)
-            weight = weight.mul_(0.02)
-            bias = bias.mul_(0.0)
-            weight[:args.vocab_size] = var_state_dict['head.weight']
-            bias[:args.vocab_size] = var_state_dict['head.bias']
-            var_state_dict['head.weight'] = weight
-            var_state_dict['head.bias'] = bias
+        # converted once for pos_1LC and the separator head, then memory-mapped from the cache by every rank
+        var_state_dict = load_control_var_weights(args.var_pretrained_path, args.v_patch_nums, args.embed_dim,
+                                                  args.vocab_size, separator=args.separator, interpos=args.interpos,
+                                                  mpos=args.mpos, cache_dir=args.weight_cache_dir)
+    else:
+        var_state_dict = load_weights(args.var_pretrained_path)
+        var_state_dict = var_state_dict.get('model_state_dict', var_state_dict)
+        var_state_dict = OrderedDict((k.replace('module.', ''), v) for k, v in var_state_dict.items())
     var.load_state_dict(var_state_dict, strict=False)
 
 def process(rank, world_size, args):
     print(f"Running DDP on rank {rank}.")
+    startup.enabled = args.profile_startup
+    startup.mark('spawn')
     setup(rank, world_size)
     seed_everything(rank)
 
@@ -543,6 +563,7 @@ def process(rank, world_size, args):
             wandb.init(project="Debug")
         else:
             wandb.init(project="ControlVAR")
+    startup.mark('process group, wandb')
 
     # Setup accelerator:
     if args.run_name is None:
@@ -566,15 +587,17 @@ def process(rank, world_size, args):
     dataset = create_dataset(args.dataset_name, args)
     val_dataset = create_dataset(args.dataset_name, args, split='val')
     # create dataloader
-    sampler = DistributedSampler(dataset, shuffle=True)
+    sampler = create_sampler(dataset, args, num_replicas=world_size, rank=rank)
     dataloader = DataLoader(dataset, sampler=sampler, batch_size=args.batch_size,
-                            num_workers=args.num_workers, pin_memory=True, drop_last=True)
-    val_sampler = DistributedSampler(val_dataset, shuffle=False)
+                            num_workers=args.num_workers, pin_memory=True, drop_last=True,
+                            collate_fn=collate_uint8 if args.uint8_batch else None)
+    val_sampler = create_sampler(val_dataset, args, split='val', num_replicas=world_size, rank=rank)
     val_dataloader = DataLoader(val_dataset, sampler=val_sampler, batch_size=args.batch_size,
                             num_workers=args.num_workers, pin_memory=True, drop_last=False)
     # Calculate total batch size
     total_batch_size = args.batch_size * args.gpus * args.gradient_accumulation_steps
     args.total_batch_size = total_batch_size
+    startup.mark('dataset')
 
     # Create VQVAE Model
     print("Creating VQVAE model")
@@ -585,6 +608,7 @@ def process(rank, world_size, args):
         p.requires_grad_(False)
     if args.vqvae_pretrained_path is not None:
         vqvae.load_state_dict(torch.load(args.vqvae_pretrained_path, map_location=torch.device('cpu')))
+    startup.mark('vqvae')
 
     # Create VPA Model
     print("Creating VAR model")
@@ -592,17 +616,23 @@ def process(rank, world_size, args):
     var = build_control_var(vae=vqvae, depth=args.depth, patch_nums=args.v_patch_nums, mask_type=args.mask_type,
                          cond_drop_rate=1.1 if args.uncond else 0.1, bidirectional=args.bidirectional,
                          separate_decoding=args.separate_decoding, separator=args.separator, type_pos=args.type_pos,
-                         indep=args.indep, multi_cond=args.multi_cond)
+                         indep=args.indep, multi_cond=args.multi_cond, block_sparse=args.block_sparse_attn)
 
     if args.var_pretrained_path is not None and not args.resume:
         print('Loading varmodel')
         load_var_weight(var, args)
 
+    act_ckpt = apply_activation_checkpointing(var.blocks, args.act_ckpt, batch_size=args.batch_size, seq_len=var.L,
+                                              dtype_bytes=4 if args.mixed_precision == 'no' else 2)
+    print(f'activation checkpointing {args.act_ckpt}: {sum(m == "block" for m in act_ckpt)} blocks, '
+          f'{sum(m == "attn" for m in act_ckpt)} attentions of {len(act_ckpt)}')
+
     if args.lora:
         prepare_lora()
 
     var = DDP(var.to(device), find_unused_parameters=False)
     var.train()
+    startup.mark('var')
 
 
     print('Filtering parameters')
@@ -654,37 +684,55 @@ def process(rank, world_size, args):
     progress_bar = tqdm(range(args.max_train_steps), disable=not rank == 0)
     args.completed_steps = 0
     args.starting_epoch = 0
+    args.data_state = None
 
     if args.resume:
         resume(var, optimizer, args)
         progress_bar.update(args.completed_steps)
         print(f'resume from step {args.completed_steps}')
+    startup.mark('optimizer, resume')
 
+    checkpointer = AsyncCheckpointer(os.path.join(args.project_dir, 'checkpoints'), rank, world_size,
+                                     keep_last=args.keep_checkpoints)
+    previewer = None
     if rank == 0 and not args.val_only:
-        print('start eval')
-        inference(var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(),
-                  guidance_scale=4.0, top_k=900, top_p=0.96, seed=42)
-        print('end eval')
+        # the hpu bridge is not safe to drive from two threads, so by default the previews render on a cpu copy
+        # (with its own copy of the vqvae)
+        previewer = PreviewWorker(var.module, partial(preview, num_classes=args.num_classes, guidance_scale=4.0,
+                                                      top_k=900, top_p=0.96, seed=42),
+                                  device=args.preview_device,
+                                  shared=(vqvae,) if torch.device(args.preview_device).type == 'hpu' else ())
+        previewer.snapshot(args.completed_steps)
+    startup.mark('checkpointer, preview')
+    if rank == 0:
+        startup.report()
 
     if not args.val_only:
         # Training
         for epoch in range(args.starting_epoch, args.num_epochs):
 
             args.epoch = epoch
+            # a resumed epoch starts at the first unseen batch, the skipped samples are never loaded
+            args.epoch_batches = set_data_position(dataloader, epoch, args.data_state)
+            args.data_state = None
             if rank == 0:
                 print(f"Epoch {epoch+1}/{args.num_epochs}")
-            train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, rank, args)
+            train_epoch(var, vqvae, cond_model, dataloader, optimizer, progress_bar, rank, args, previewer,
+                        checkpointer)
 
-            if epoch % args.val_interval == 0 and rank == 0:
-                inference(var, vqvae, cond_model, np.random.choice(args.num_classes, 4).tolist(),
-                          guidance_scale=4.0, top_k=900, top_p=0.96, seed=42)
+            if epoch % args.val_interval == 0 and previewer is not None:
+                previewer.snapshot(args.completed_steps)
 
-            if args.save_interval == 'epoch' and rank == 0:
-                save_checkpoint(var, optimizer, args, args.project_dir)
+            if args.save_interval == 'epoch':
+                save_checkpoint(var, optimizer, args, checkpointer,
+                                data_state=data_state_dict(dataloader, args.epoch, args.epoch_batches))
     else:
         assert not (args.c_img and args.c_mask)  # only give one condition
         validate(var, vqvae, cond_model, val_dataloader, args, c_mask=args.c_mask,
                  c_img=args.c_img, rank=rank, guidance_scale=args.cfg, gibbs=args.gibbs, save_val=args.save_val)
+    if previewer is not None:
+        previewer.close()
+    checkpointer.close()
     # end training
     cleanup()
 
@@ -705,4 +753,4 @@ if __name__ == '__main__':
     #     try:
     #         run(process, args.gpus, args)
     #     except:
-    #         args.resume = f'experiments/{args.output_dir}/checkpoint_step_latest.pth'
+    #         args.resume = f'experiments/{args.output_dir}/checkpoints'
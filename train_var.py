@@ -1,3 +1,6 @@
+from time import perf_counter
+STARTUP_T0 = perf_counter()  # taken before the imports, see --profile_startup
+
 import os
 import argparse
 import logging
@@ -19,11 +22,14 @@ from accelerate.logging import get_logger
 from accelerate.utils import set_seed
 
 from datasets import create_dataset
-from models import VQVAE, VisualProgressAutoreg, VAR, build_var
+from models import VQVAE, build_var
 from utils.wandb import CustomWandbTracker
+from utils.startup import StartupProfiler
 from ruamel.yaml import YAML
 
 logger = get_logger(__name__)
+startup = StartupProfiler(start=STARTUP_T0)
+startup.mark('imports')
 
 
 def parse_args():
@@ -83,6 +89,7 @@ def parse_args():
     parser.add_argument("--cond_drop_rate", type=float, default=0.1, help="drop rate of condition model")
 
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--profile_startup", "--profile-startup", action='store_true', help="report the time of every startup phase")
 
     # fFirst parse of command-line args to check for config file
     args = parser.parse_args()
@@ -186,6 +193,7 @@ def validate():
 
 def main():
     args = parse_args()
+    startup.enabled = args.profile_startup
 
     # seed
     set_seed(args.seed)
@@ -216,6 +224,7 @@ def main():
         level=logging.INFO,
     )
     logger.info(accelerator.state, main_process_only=False)
+    startup.mark('accelerator')
 
     # create dataset
     logger.info("Creating dataset")
@@ -226,6 +235,7 @@ def main():
     # Calculate total batch size
     total_batch_size = args.batch_size * accelerator.num_processes * args.gradient_accumulation_steps
     args.total_batch_size = total_batch_size
+    startup.mark('dataset')
 
     # Create VQVAE Model
     logger.info("Creating VQVAE model")
@@ -246,6 +256,7 @@ def main():
     if args.var_pretrained_path is not None:
         var.load_state_dict(torch.load(args.var_pretrained_path))
     var.train()
+    startup.mark('vqvae, var')
 
     # Create Condition Model
     logger.info("Creating conditional model")
@@ -287,6 +298,9 @@ def main():
     # Start tracker
     experiment_config = vars(args)
     accelerator.init_trackers(model_name, config=experiment_config)
+    startup.mark('optimizer, prepare, trackers')
+    if accelerator.is_main_process:
+        startup.report(logger.info)
 
     # Start training
     if accelerator.is_main_process:
@@ -1,3 +1,6 @@
+from time import perf_counter
+STARTUP_T0 = perf_counter()  # taken before the imports, see --profile_startup
+
 import os
 import argparse
 import math
@@ -24,8 +27,12 @@ from datasets import create_dataset
 from models.vqvae_mask import VQVAE
 from losses.vqperceptual import VQLPIPSWithDiscriminator
 from ruamel.yaml import YAML
+from utils.checkpoint import AsyncCheckpointer, load_checkpoint
+from utils.startup import StartupProfiler
 
 device = torch.device('cuda')
+startup = StartupProfiler(start=STARTUP_T0)
+startup.mark('imports')
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -54,6 +61,7 @@ def parse_args():
     parser.add_argument("--log_interval", type=int, default=5, help='log interval for steps')
     parser.add_argument("--val_interval", type=int, default=1, help='validation interval for epochs')
     parser.add_argument("--save_interval", type=str, default='5000', help='save interval')
+    parser.add_argument("--keep_checkpoints", type=int, default=3, help='number of most recent checkpoints kept')
     parser.add_argument("--mixed_precision", type=str, default='no', help='mixed precision', choices=['no', 'fp16', 'bf16', 'fp8'])
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help='gradient accumulation steps')
     
@@ -84,6 +92,7 @@ def parse_args():
     parser.add_argument("--cond_drop_rate", type=float, default=0.1, help="drop rate of condition model")
     
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--profile_startup", "--profile-startup", action='store_true', help="report the time of every startup phase")
 
     # fFirst parse of command-line args to check for config file
     args = parser.parse_args()
@@ -102,7 +111,8 @@ def parse_args():
     return args
 
 
-def train_epoch(vqvae, loss_fn, dataloader, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, progress_bar, rank, args):
+def train_epoch(vqvae, loss_fn, dataloader, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, progress_bar, rank, args,
+                checkpointer=None):
 
     vqvae.train()
     loss_fn.train()
@@ -144,13 +154,10 @@ def train_epoch(vqvae, loss_fn, dataloader, optimizer_G, optimizer_D, lr_schedul
                 image = Image.fromarray(image.astype(np.uint8))
                 wandb.log({f"images": [wandb.Image(image)]}, step=args.completed_steps)
 
-
-            # Save model
-            if isinstance(args.save_interval, int):
-                if args.completed_steps % args.save_interval == 0:
-                    save_dir = os.path.join(args.project_dir, f"step_{args.completed_steps}")
-                    os.makedirs(save_dir, exist_ok=True)
-                    save_checkpoint(vqvae, loss_fn, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, args, -1, args.completed_steps,)
+        # Save model, every rank writes its shard of the checkpoint
+        if isinstance(args.save_interval, int):
+            if args.completed_steps % args.save_interval == 0:
+                save_checkpoint(vqvae, loss_fn, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, checkpointer, -1, args.completed_steps,)
             #
             # TODO remove
             # if args.completed_steps % 100 == 0:
@@ -185,7 +192,7 @@ def setup(rank, world_size):
 def cleanup():
     dist.destroy_process_group()
 
-def save_checkpoint(generator, discriminator, optimizer_G, optimizer_D, scheduler_G, scheduler_D, args, epoch=None, step=None, ):
+def save_checkpoint(generator, discriminator, optimizer_G, optimizer_D, scheduler_G, scheduler_D, checkpointer, epoch=None, step=None, ):
     checkpoint = {
         'generator_state_dict': generator.state_dict(),
         'discriminator_state_dict': discriminator.state_dict(),
@@ -196,14 +203,17 @@ def save_checkpoint(generator, discriminator, optimizer_G, optimizer_D, schedule
         'epoch': epoch,
         'step': step
     }
-    torch.save(checkpoint, f'{args.output_dir}/checkpoint_step_{step:08d}.pth')
+    checkpointer.save(step, checkpoint)
 
 def process(rank, world_size, args):
     print(f"Running DDP on rank {rank}.")
+    startup.enabled = args.profile_startup
+    startup.mark('spawn')
     setup(rank, world_size)
 
     if rank == 0:
         wandb.init(project="MaskVAE")
+    startup.mark('process group, wandb')
 
     # Setup accelerator:
     if args.run_name is None:
@@ -233,6 +243,7 @@ def process(rank, world_size, args):
     args.total_batch_size = total_batch_size
 
     # Create VQVAE Model
+    startup.mark('dataset')
     print("Creating VQVAE model")
     vqvae = VQVAE(vocab_size=args.vocab_size, z_channels=args.z_channels, ch=args.ch, test_mode=True,
                   share_quant_resi=4, v_patch_nums=args.v_patch_nums).to(device)
@@ -250,6 +261,7 @@ def process(rank, world_size, args):
     loss_fn = DDP(loss_fn)
 
     # Create Optimizer
+    startup.mark('vqvae, discriminator')
     print("Creating optimizer")
     # TODO: support faster optimizer
     trainable_params_G = list(vqvae.parameters())
@@ -295,7 +307,7 @@ def process(rank, world_size, args):
     # TODO: add resume function
 
     if args.resume is not None:
-        checkpoint = torch.load(args.resume)
+        checkpoint = load_checkpoint(args.resume)
         vqvae.load_state_dict(checkpoint['generator_state_dict'])
         loss_fn.load_state_dict(checkpoint['discriminator_state_dict'])
         optimizer_G.load_state_dict(checkpoint['optimizer_G_state_dict'])
@@ -306,6 +318,11 @@ def process(rank, world_size, args):
         args.starting_epoch = checkpoint['epoch']
         progress_bar.update(args.completed_steps)
 
+    checkpointer = AsyncCheckpointer(os.path.join(args.output_dir, 'checkpoints'), rank, world_size,
+                                     keep_last=args.keep_checkpoints)
+    startup.mark('optimizer, resume')
+    if rank == 0:
+        startup.report()
         
     # if rank == 0:
     #     print('start eval')
@@ -320,17 +337,17 @@ def process(rank, world_size, args):
             print(f"Epoch {epoch+1}/{args.num_epochs}")
 
         # train epoch
-        train_epoch(vqvae, loss_fn, dataloader, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, progress_bar, rank, args)
+        train_epoch(vqvae, loss_fn, dataloader, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, progress_bar, rank, args,
+                    checkpointer)
 
         # if epoch % args.val_interval == 0 and rank == 0:
         #     inference(vqvae, images, seed=42)
 
-        if args.save_interval  == 'epoch' and rank == 0:
-            save_dir = os.path.join(args.project_dir, f"epoch_{args.epoch}")
-            os.makedirs(save_dir, exist_ok=True)
-            save_checkpoint(vqvae, loss_fn, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, args, epoch, args.completed_steps)
+        if args.save_interval  == 'epoch':
+            save_checkpoint(vqvae, loss_fn, optimizer_G, optimizer_D, lr_scheduler_G, lr_scheduler_D, checkpointer, epoch, args.completed_steps)
     
     # end training
+    checkpointer.close()
     cleanup()
 
     
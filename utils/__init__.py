@@ -1,3 +1,10 @@
-from .wandb import CustomWandbTracker
 from .misc import seed_everything
-from .lr_control import filter_params, lr_wd_annealing
\ No newline at end of file
+from .lr_control import filter_params, lr_wd_annealing
+
+
+def __getattr__(name):
+    # the tracker pulls in accelerate and wandb, only the accelerate trainers need it
+    if name == 'CustomWandbTracker':
+        from .wandb import CustomWandbTracker
+        return CustomWandbTracker
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
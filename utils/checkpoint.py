@@ -0,0 +1,213 @@
+import os
+import json
+import pickle
+import time
+import shutil
+import threading
+
+import torch
+
+LATEST = 'latest'
+MANIFEST = 'manifest.json'
+
+
+class _TensorRef(object):
+    """Placeholder for a tensor in the saved structure of a checkpoint."""
+    def __init__(self, index):
+        self.index = index
+
+
+def _flatten(obj, tensors):
+    if torch.is_tensor(obj):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        out = type(obj)((k, _flatten(v, tensors)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):  # module state dicts carry their version info here
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, tensors) for v in obj)
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        out = type(obj)((k, _unflatten(v, tensors)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_unflatten(v, tensors) for v in obj)
+    return obj
+
+
+def _partition(tensors, num_parts):
+    """Owner rank of every tensor, balancing the bytes per rank. Deterministic, so every rank agrees."""
+    sizes = [t.numel() * t.element_size() for t in tensors]
+    load, owner = [0] * num_parts, [0] * len(tensors)
+    for i in sorted(range(len(tensors)), key=lambda i: (-sizes[i], i)):
+        part = min(range(num_parts), key=lambda p: load[p])
+        owner[i] = part
+        load[part] += sizes[i]
+    return owner
+
+
+def shard_name(rank):
+    return f'rank{rank:05d}.pt'
+
+
+def _atomic_write(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer(object):
+    """
+    Writes checkpoints in the background as one shard per rank.
+
+    save(step, state) must be called on every rank with the same (replicated) state, a nested structure of dicts,
+    lists and tensors. The tensors are split by size across the ranks; each rank copies its part into reused
+    (pinned, on cuda) CPU buffers and returns, a thread then writes {root}/step_{step:08d}/rank{rank:05d}.pt. Once
+    every shard exists, rank 0 writes the manifest, atomically points {root}/latest at the new step and removes all
+    but the last keep_last checkpoints. A checkpoint without a manifest is incomplete and never loaded.
+    """
+    def __init__(self, root, rank=0, world_size=1, keep_last=3, timeout=3600):
+        self.root = root
+        self.rank = rank
+        self.world_size = world_size
+        self.keep_last = keep_last
+        self.timeout = timeout
+        self.pin = torch.cuda.is_available()
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+        os.makedirs(root, exist_ok=True)
+
+    def _stage(self, index, tensor):
+        buf = self.buffers.get(index)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.pin)
+            self.buffers[index] = buf
+        buf.copy_(tensor.detach(), non_blocking=tensor.is_cuda)
+        return buf
+
+    def save(self, step, state):
+        # the buffers are reused, so the previous checkpoint has to be on disk first
+        self.wait()
+        tensors = []
+        skeleton = _flatten(state, tensors)
+        owner = _partition(tensors, self.world_size)
+        shard = {'tensors': {i: self._stage(i, t) for i, t in enumerate(tensors) if owner[i] == self.rank}}
+        if self.rank == 0:
+            shard['skeleton'] = skeleton
+        copied = None
+        if self.pin:
+            copied = torch.cuda.Event()
+            copied.record()
+        self.thread = threading.Thread(target=self._write, args=(step, shard, len(tensors), copied), daemon=True)
+        self.thread.start()
+
+    def _write(self, step, shard, num_tensors, copied):
+        try:
+            if copied is not None:
+                copied.synchronize()
+            step_dir = os.path.join(self.root, f'step_{step:08d}')
+            os.makedirs(step_dir, exist_ok=True)
+            path = os.path.join(step_dir, shard_name(self.rank))
+            torch.save(shard, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            if self.rank == 0:
+                self._commit(step, step_dir, num_tensors)
+        except Exception as e:
+            self.error = e
+
+    def _commit(self, step, step_dir, num_tensors):
+        shards = [shard_name(r) for r in range(self.world_size)]
+        deadline = time.time() + self.timeout
+        while not all(os.path.exists(os.path.join(step_dir, s)) for s in shards):
+            if time.time() > deadline:
+                raise TimeoutError(f'checkpoint {step_dir}: shards of other ranks missing after {self.timeout}s')
+            time.sleep(1)
+        manifest = {'step': step, 'world_size': self.world_size, 'num_tensors': num_tensors, 'shards': shards}
+        _atomic_write(os.path.join(step_dir, MANIFEST), json.dumps(manifest))
+        _atomic_write(os.path.join(self.root, LATEST), os.path.basename(step_dir))
+        self._prune(step)
+
+    def _prune(self, step):
+        steps = sorted(d for d in os.listdir(self.root) if d.startswith('step_') and
+                       os.path.exists(os.path.join(self.root, d, MANIFEST)))
+        for d in steps[:-self.keep_last]:
+            shutil.rmtree(os.path.join(self.root, d), ignore_errors=True)
+        # leftovers of interrupted saves older than the new checkpoint
+        for d in os.listdir(self.root):
+            if d.startswith('step_') and d < f'step_{step:08d}' and d not in steps:
+                shutil.rmtree(os.path.join(self.root, d), ignore_errors=True)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing the checkpoint failed') from error
+
+    def close(self):
+        self.wait()
+
+
+def load_weights(path):
+    """
+    Reads a state dict without copying the whole file into memory first: .safetensors files are memory-mapped, torch
+    files are opened with mmap=True where the torch version and file format allow it.
+    """
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path, device='cpu')
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):  # old torch, legacy (non-zip) file or pickled objects
+        return torch.load(path, map_location='cpu')
+
+
+def save_weights(state_dict, path):
+    """Atomic write of a flat state dict, as safetensors when the name says so."""
+    tmp_path = path + '.tmp'
+    if path.endswith('.safetensors'):
+        from safetensors.torch import save_file
+        save_file({k: v.contiguous() for k, v in state_dict.items()}, tmp_path)
+    else:
+        torch.save(state_dict, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def resolve_checkpoint(path):
+    """A checkpoint root resolves to the step its 'latest' file points at."""
+    if os.path.exists(os.path.join(path, LATEST)):
+        with open(os.path.join(path, LATEST), 'r') as f:
+            path = os.path.join(path, f.read().strip())
+    return path
+
+
+def is_sharded_checkpoint(path):
+    return os.path.exists(os.path.join(resolve_checkpoint(path), MANIFEST))
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Loads a checkpoint of AsyncCheckpointer (a step directory or the root) or a plain torch.save file."""
+    if not is_sharded_checkpoint(path):
+        return torch.load(path, map_location=map_location)
+    step_dir = resolve_checkpoint(path)
+    with open(os.path.join(step_dir, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    tensors, skeleton = {}, None
+    for name in manifest['shards']:
+        shard = torch.load(os.path.join(step_dir, name), map_location=map_location, weights_only=False)
+        tensors.update(shard['tensors'])
+        skeleton = shard.get('skeleton', skeleton)
+    assert len(tensors) == manifest['num_tensors'], f'{step_dir} is missing tensors'
+    return _unflatten(skeleton, tensors)
@@ -0,0 +1,66 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+# encoder settings per extension; png stays lossless, the low compress level is several times faster to encode
+SAVE_KWARGS = {
+    '.png': {'compress_level': 1},
+    '.jpg': {'quality': 95},
+    '.jpeg': {'quality': 95},
+    '.webp': {'quality': 95},
+}
+
+
+def to_uint8_images(images):
+    """(B, 3, H, W) float images in [0, 1] to a (B, H, W, 3) uint8 tensor, converted before leaving the device."""
+    return images.permute(0, 2, 3, 1).mul(255).to(torch.uint8)
+
+
+class ImageExporter(object):
+    """
+    Encodes and writes images on a thread pool so generation does not wait on the encoder.
+
+    submit() takes a batch of (B, H, W, 3) uint8 images (tensor or array) and one path per image. At most
+    max_pending batches are held in memory: submit() blocks once the writers fall that far behind. flush() waits for
+    every pending write and re-raises the first error.
+    """
+    def __init__(self, num_workers=4, max_pending=8):
+        self.executor = ThreadPoolExecutor(num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, images, paths):
+        if torch.is_tensor(images):
+            images = images.cpu().numpy()
+        self.slots.acquire()
+        future = self.executor.submit(self._write, images, paths)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+        self.futures.append(future)
+
+    @staticmethod
+    def _write(images, paths):
+        for image, path in zip(images, paths):
+            ext = os.path.splitext(path)[1].lower()
+            Image.fromarray(np.ascontiguousarray(image)).save(path, **SAVE_KWARGS.get(ext, {}))
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,165 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import dist
+
+
+class TorchFidelityInception(nn.Module):
+    """The FID/IS reference Inception (pt_inception-2015-12-05) from torch-fidelity: 2048-d pool features and logits."""
+    def __init__(self):
+        super().__init__()
+        from torch_fidelity.feature_extractor_inceptionv3 import FeatureExtractorInceptionV3
+        self.net = FeatureExtractorInceptionV3('inception-v3-compat', ['2048', 'logits_unbiased'])
+
+    def forward(self, images):
+        features, logits = self.net(images.mul(255).round().clamp(0, 255).to(torch.uint8))
+        return features, logits
+
+
+class TorchvisionInception(nn.Module):
+    """
+    Fallback when torch-fidelity is missing. The torchvision weights differ from the reference network, so scores
+    are only comparable with statistics computed by this same extractor.
+    """
+    def __init__(self):
+        super().__init__()
+        from torchvision.models import inception_v3, Inception_V3_Weights
+        net = inception_v3(weights=Inception_V3_Weights.IMAGENET1K_V1)
+        self.fc, net.fc = net.fc, nn.Identity()
+        self.net = net
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        x = F.interpolate(images, size=(299, 299), mode='bilinear', align_corners=False)
+        features = self.net((x - self.mean) / self.std)
+        return features, self.fc(features)
+
+
+class TinyFeatureExtractor(nn.Module):
+    """Small randomly initialized stand-in with the same interface, for checking the pipeline on CPU."""
+    def __init__(self, dim=64, num_classes=10, seed=0):
+        super().__init__()
+        g = torch.Generator().manual_seed(seed)
+        self.convs = nn.Sequential(nn.Conv2d(3, 16, 3, 2, 1), nn.ReLU(), nn.Conv2d(16, dim, 3, 2, 1), nn.ReLU())
+        self.fc = nn.Linear(dim, num_classes)
+        with torch.no_grad():
+            for p in self.parameters():
+                p.copy_(torch.randn(p.shape, generator=g) * 0.1)
+
+    def forward(self, images):
+        features = self.convs(images).mean(dim=(2, 3))
+        return features, self.fc(features)
+
+
+def build_feature_extractor(name='inception', device='cpu'):
+    if name == 'tiny':
+        net = TinyFeatureExtractor()
+    else:
+        try:
+            net = TorchFidelityInception()
+        except ImportError:
+            print('torch-fidelity is not installed, use the torchvision Inception weights for FID/IS')
+            net = TorchvisionInception()
+    return net.eval().requires_grad_(False).to(device)
+
+
+def load_reference_stats(path):
+    """Reference mean and covariance from an .npz with 'mu' and 'sigma' (pytorch-fid / ADM layout)."""
+    stats = np.load(path)
+    return stats['mu'].astype(np.float64), stats['sigma'].astype(np.float64)
+
+
+def frechet_distance(mu1, sigma1, mu2, sigma2):
+    """
+    ||mu1 - mu2||^2 + tr(sigma1 + sigma2 - 2 (sigma1 sigma2)^(1/2)). The trace of the matrix square root equals the
+    sum of the square roots of the eigenvalues of sigma1^(1/2) sigma2 sigma1^(1/2), which is symmetric, so two
+    symmetric eigendecompositions replace scipy's sqrtm.
+    """
+    w, v = np.linalg.eigh(sigma1)
+    sqrt1 = (v * np.sqrt(np.clip(w, 0, None))) @ v.T
+    eig = np.linalg.eigvalsh(sqrt1 @ sigma2 @ sqrt1)
+    tr_covmean = np.sqrt(np.clip(eig, 0, None)).sum()
+    diff = mu1 - mu2
+    return float(diff @ diff + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
+
+
+class InceptionMetrics(object):
+    """
+    Streams generated batches through a feature extractor and keeps only running moments: the feature sum and
+    outer-product sum for FID, and sum p log p plus the sum of p(y|x) for IS. compute() combines the ranks through
+    dist.allreduce, so no image or feature ever leaves the rank. Every rank must call compute().
+
+    The moments are accumulated in float64 on the CPU and centered per rank before the all-reduce, so the reduction
+    itself is accurate in float32 (HPU collectives have no float64). IS is computed over all samples in a single
+    split.
+    """
+    def __init__(self, extractor, ref_stats=None, device='cpu'):
+        self.extractor = extractor
+        self.device = device
+        self.ref_stats = load_reference_stats(ref_stats) if isinstance(ref_stats, str) else ref_stats
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.feat_sum = self.feat_outer = None
+        self.plogp_sum = 0.
+        self.prob_sum = None
+
+    @torch.no_grad()
+    def update(self, images):
+        """images: (B, 3, H, W) in [0, 1]."""
+        features, logits = self.extractor(images.to(self.device).float())
+        features = features.double().cpu()
+        if self.feat_sum is None:
+            self.feat_sum = torch.zeros(features.shape[1], dtype=torch.float64)
+            self.feat_outer = torch.zeros(features.shape[1], features.shape[1], dtype=torch.float64)
+        self.n += features.shape[0]
+        self.feat_sum += features.sum(0)
+        self.feat_outer += features.T @ features
+
+        if logits is not None:
+            log_p = F.log_softmax(logits.double().cpu(), dim=1)
+            p = log_p.exp()
+            self.plogp_sum += (p * log_p).sum().item()
+            self.prob_sum = p.sum(0) if self.prob_sum is None else self.prob_sum + p.sum(0)
+
+    def _allreduce(self, t):
+        dist.allreduce(t)
+
+    def _reduce(self, t):
+        t = t.float()
+        self._allreduce(t)
+        return t.double()
+
+    def stats(self):
+        """Global feature mean and covariance (unbiased), reduced over all ranks."""
+        assert self.feat_sum is not None, 'every rank needs at least one batch before the reduction'
+        n_local = self.n
+        n = int(self._reduce(torch.tensor([n_local])).item())
+        mu_local = self.feat_sum / max(n_local, 1)
+        mu = self._reduce(self.feat_sum) / n
+        # centered scatter of this rank, shifted to the global mean
+        delta = mu_local - mu
+        scatter = self.feat_outer - n_local * torch.outer(mu_local, mu_local) + n_local * torch.outer(delta, delta)
+        sigma = self._reduce(scatter) / (n - 1)
+        return n, mu.numpy(), sigma.numpy()
+
+    def save_stats(self, path):
+        """Write the reduced statistics as a reference .npz, e.g. for a set of real images."""
+        n, mu, sigma = self.stats()
+        if dist.is_master():
+            np.savez(path, mu=mu, sigma=sigma, n=n)
+
+    def compute(self):
+        n, mu, sigma = self.stats()
+        results = {'num_samples': n}
+        if self.ref_stats is not None:
+            results['fid'] = frechet_distance(mu, sigma, *self.ref_stats)
+        if self.prob_sum is not None:
+            plogp = self._reduce(torch.tensor([self.plogp_sum])).item() / n
+            p_y = self._reduce(self.prob_sum) / n
+            results['is'] = float(np.exp(plogp - (p_y * torch.log(p_y.clamp_min(1e-12))).sum().item()))
+        return results
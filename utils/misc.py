@@ -4,6 +4,7 @@ import numpy as np
 import random
 
 import datetime
+import math
 import functools
 import glob
 import os
@@ -90,6 +91,39 @@ class SmoothedValue(object):
             max=self.max,
             value=self.value)
 
+class DeviceMeter(object):
+    """
+    Running sums of scalar tensors that stay on the device. update() only queues device-side adds, so logging no
+    longer syncs the host every step (on HPU each .item() also flushes the lazy graph). compute() reads all sums
+    back in one transfer, averaged over steps and ranks, and resets them; every rank must call it at the same step.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.count = 0
+
+    def update(self, **kwargs):
+        for k, v in kwargs.items():
+            v = v.detach().float()
+            if k in self.sums:
+                self.sums[k].add_(v)
+            else:
+                self.sums[k] = v.clone()
+        self.count += 1
+
+    def compute(self):
+        if not self.sums:
+            return {}
+        keys = list(self.sums)
+        t = torch.stack([self.sums[k] for k in keys])
+        t = torch.cat([t, t.new_tensor([self.count])])
+        if tdist.is_available() and tdist.is_initialized():
+            tdist.all_reduce(t)
+        t = t.tolist()
+        self.sums, self.count = {}, 0
+        return {k: v / t[-1] for k, v in zip(keys, t[:-1])}
+
+
 class MetricLogger(object):
     def __init__(self, delimiter='  '):
         self.meters = defaultdict(SmoothedValue)
@@ -182,4 +216,23 @@ class MetricLogger(object):
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('{}   Total time:      {}   ({:.3f} s / it)'.format(
-            header, total_time_str, total_time / max_iters), flush=True)
\ No newline at end of file
+            header, total_time_str, total_time / max_iters), flush=True)
+
+def class_sample_batches(num_classes, samples_per_class, batch_size, world_size, rank, seed=0):
+    """
+    Work list for class-conditional sampling. All (class, sample index) pairs are flattened class-major and cut into
+    batches of exactly batch_size, which may span two classes; the final batch is padded with repeated pairs marked
+    invalid. Batches are dealt round-robin, so ranks differ by at most one batch. Every pair gets the seed
+    seed + cls * samples_per_class + index, which does not depend on world_size.
+
+    Returns this rank's batches as (classes, indices, seeds, valid) tensors of length batch_size.
+    """
+    total = num_classes * samples_per_class
+    pairs = torch.arange(math.ceil(total / batch_size) * batch_size)
+    valid = pairs < total
+    pairs = torch.where(valid, pairs, pairs % total)
+    classes, indices = pairs // samples_per_class, pairs % samples_per_class
+    seeds = seed + pairs
+    batches = list(zip(classes.split(batch_size), indices.split(batch_size), seeds.split(batch_size),
+                       valid.split(batch_size)))
+    return batches[rank::world_size]
@@ -0,0 +1,83 @@
+import copy
+import threading
+
+import torch
+
+
+def _move_unregistered(model, device, skip):
+    """.to() for what Module.to() misses: plain tensor attributes and modules held in tuples (e.g. vae_proxy)."""
+    for m in list(model.modules()):
+        for k, v in list(vars(m).items()):
+            if torch.is_tensor(v) and not isinstance(v, torch.nn.Parameter):
+                setattr(m, k, v.to(device))
+            elif isinstance(v, tuple):
+                for p in v:
+                    if isinstance(p, torch.nn.Module) and id(p) not in skip:
+                        p.to(device)
+
+
+class PreviewWorker(object):
+    """
+    Renders preview samples off the training loop.
+
+    snapshot() copies the current weights into a side model with device-side copies only (no host sync) and hands
+    it to a background thread, which runs render_fn(side_model, step) to generate, decode and log the previews.
+    While a preview is still rendering, further snapshots are skipped, so the training loop never waits on it.
+    Modules in `shared` (e.g. the frozen VQVAE) are referenced by the side model instead of copied, so they must
+    live on the side model's device.
+    """
+    def __init__(self, model, render_fn, device=None, shared=()):
+        memo = {id(m): m for s in shared for m in s.modules()}
+        for m in model.modules():  # generators cannot be deep-copied, the side model gets fresh ones
+            for v in vars(m).values():
+                if isinstance(v, torch.Generator):
+                    memo[id(v)] = torch.Generator(device=device if device is not None else v.device)
+        self.model = model
+        self.side = copy.deepcopy(model, memo)
+        if device is not None:
+            self.side.to(device)
+            _move_unregistered(self.side, device, skip=memo)
+        self.side.eval().requires_grad_(False)
+        self.render_fn = render_fn
+        self.thread = None
+        self.device = device = next(self.side.parameters()).device
+        # on cuda the previews run on their own stream, after the weight copies of the training stream
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.copied = None
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @torch.no_grad()
+    def snapshot(self, step):
+        if self.busy():
+            return False
+        src = self.model.state_dict()
+        for k, dst in self.side.state_dict().items():
+            dst.copy_(src[k], non_blocking=dst.device.type != 'cpu')
+        if self.device.type == 'hpu':
+            # lazy mode only queues the copies; run them before the thread reads the side weights
+            import habana_frameworks.torch.core as htcore
+            htcore.mark_step()
+        if self.stream is not None:
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+        self.thread = threading.Thread(target=self._run, args=(step,), daemon=True)
+        self.thread.start()
+        return True
+
+    @torch.no_grad()
+    def _run(self, step):
+        try:
+            if self.stream is not None:
+                self.stream.wait_event(self.copied)
+                with torch.cuda.stream(self.stream):
+                    self.render_fn(self.side, step)
+            else:
+                self.render_fn(self.side, step)
+        except Exception as e:  # a failed preview must not take the training run down
+            print(f'[preview] step {step} failed: {e!r}')
+
+    def close(self):
+        if self.thread is not None:
+            self.thread.join()
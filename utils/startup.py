@@ -0,0 +1,43 @@
+import sys
+import time
+from contextlib import contextmanager
+
+# optional packages that are slow to import; the report lists which of them a run actually loaded
+HEAVY_MODULES = ('wandb', 'transformers', 'accelerate', 'peft', 'pycocotools', 'cv2', 'torchdata', 'xformers',
+                 'flash_attn', 'torch_fidelity', 'habana_frameworks')
+
+
+class StartupProfiler(object):
+    """
+    Wall time of the startup phases of an entry point (imports, process group, dataset, models, ...).
+
+    start is the perf_counter() value taken before the entry point's first import. mark(name) closes the phase
+    that ran since the previous mark; report() prints the phases and the heavy packages that got imported. Disabled,
+    it only keeps the timestamps.
+    """
+    def __init__(self, enabled=False, start=None):
+        self.enabled = enabled
+        self.start = self.last = start if start is not None else time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        self.last = time.perf_counter()
+        yield
+        self.mark(name)
+
+    def report(self, print_fn=print):
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.start
+        print_fn(f'***** Startup profile: {total:.2f}s *****')
+        for name, seconds in self.phases:
+            print_fn(f'  {name:<24s}{seconds:8.2f}s {100 * seconds / max(total, 1e-9):5.1f}%')
+        loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+        print_fn(f'  heavy modules loaded: {", ".join(loaded) or "none"}')
+        print_fn('  (run with python -X importtime for a per-module import breakdown)')